@@ -0,0 +1,200 @@
+"""Throughput and latency benchmarks for CIFAR-10 classification models.
+
+Sweeps the models in `model_registry` over batch size, thread count, memory format, precision and activation
+checkpointing, timing training steps (forward, backward and optimizer step) and/or inference on synthetic data after a
+number of warmup iterations. Training configurations also report the memory held by activations saved for backward.
+Results are written as JSON. Passing a previous result file with `--compare` flags configurations whose throughput or
+median latency regressed by more than `--tolerance`.
+
+Peak memory is only reported on CUDA. The CPU high-water mark (max RSS) covers the whole process and cannot be reset
+between configurations, so it is recorded as null there; the activation memory of training configurations is exact on
+every device.
+
+Typical usage:
+    $python benchmark.py --models resnet_s20 convmixer256_8_k5_p2 --batch-sizes 1 128 --output baseline.json
+    $python benchmark.py --models resnet_s20 convmixer256_8_k5_p2 --batch-sizes 1 128 --compare baseline.json
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import torch
+
+import utils
+from models import model_registry
+from utils.metrics import percentile, reset_peak_memory, peak_memory_mb, activation_memory_mb
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+parser = argparse.ArgumentParser(description="PyTorch CIFAR-10 Model Benchmark")
+parser.add_argument('--models', nargs='+', default=list(model_registry), metavar='NAME',
+                    help='Model identifiers to benchmark (default: all registered models)')
+parser.add_argument('--modes', nargs='+', default=['inference', 'train'], choices=['inference', 'train'],
+                    help='What to time (default: inference train)')
+parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 64, 256], metavar='N',
+                    help='Batch sizes (default: 1 64 256)')
+parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()], metavar='N',
+                    help='Intra-op thread counts (default: torch default)')
+parser.add_argument('--memory-formats', nargs='+', default=['contiguous'], choices=['contiguous', 'channels_last'],
+                    help='Memory formats (default: contiguous)')
+parser.add_argument('--precisions', nargs='+', default=['fp32'], choices=['fp32', 'amp'],
+                    help='"fp32" or "amp" (bfloat16 autocast on CPU, float16 on CUDA) (default: fp32)')
+parser.add_argument('--checkpoint-segments', nargs='+', type=int, default=[0], metavar='N',
+                    help='Activation checkpointing segments per stage, 0 to disable (default: 0)')
+parser.add_argument('--device', default='cpu', type=str, metavar="DEV",
+                    help='Device to use (default: "cpu")')
+parser.add_argument('--warmup', default=5, type=int, metavar='N',
+                    help='Untimed iterations per configuration (default: 5)')
+parser.add_argument('--reps', default=20, type=int, metavar='N',
+                    help='Timed iterations per configuration (default: 20)')
+parser.add_argument('--output', default='', type=str, metavar='PATH',
+                    help='Path for the JSON results (default: "benchmark_<time>.json")')
+parser.add_argument('--compare', default='', type=str, metavar='PATH',
+                    help='Baseline JSON results to check for regressions (default: None)')
+parser.add_argument('--tolerance', default=0.05, type=float, metavar='TOL',
+                    help='Allowed relative slowdown before a configuration is flagged (default: 0.05)')
+
+CONFIG_KEYS = ('model', 'mode', 'batch_size', 'threads', 'memory_format', 'precision', 'checkpoint_segments')
+# Values of configuration keys missing from older result files
+CONFIG_DEFAULTS = {'checkpoint_segments': 0}
+
+
+def _sync(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _config_key(result: dict) -> tuple:
+    return tuple(result.get(k, CONFIG_DEFAULTS.get(k)) for k in CONFIG_KEYS)
+
+
+def benchmark_config(model_name: str, mode: str, batch_size: int, memory_format: str, precision: str,
+                     device: torch.device, warmup: int, reps: int, checkpoint_segments: int = 0) -> dict:
+    """Times one configuration.
+
+    Returns:
+        dict: images/sec, latency percentiles in ms, peak memory in MB (None on CPU) and, for training, memory saved
+            for backward in MB
+    """
+    channels_last = memory_format == 'channels_last'
+    model = model_registry[model_name](checkpoint_segments=checkpoint_segments).to(device)
+    model = utils.prepare_model(model, channels_last=channels_last)
+    amp = utils.MixedPrecision(device, enabled=precision == 'amp')
+    inputs = utils.prepare_inputs(torch.randn(batch_size, 3, 32, 32, device=device), channels_last)
+    targets = torch.randint(10, (batch_size,), device=device)
+
+    if mode == 'train':
+        model.train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+        loss_fn = torch.nn.CrossEntropyLoss()
+
+        def step():
+            with amp.autocast():
+                loss = loss_fn(model(inputs), targets)
+            optimizer.zero_grad(set_to_none=True)
+            amp.step(loss, optimizer)
+    else:
+        model.eval()
+
+        def step():
+            with torch.no_grad(), amp.autocast():
+                model(inputs)
+
+    reset_peak_memory(device)
+    for _ in range(warmup):
+        step()
+    _sync(device)
+
+    latencies = []
+    for _ in range(reps):
+        start = time.perf_counter()
+        step()
+        _sync(device)
+        latencies.append(time.perf_counter() - start)
+
+    stats = {
+        'images_per_sec': batch_size * len(latencies) / sum(latencies),
+        'latency_ms': {'mean': 1000 * sum(latencies) / len(latencies), 'p50': 1000 * percentile(latencies, 50),
+                       'p90': 1000 * percentile(latencies, 90), 'p99': 1000 * percentile(latencies, 99)},
+        'peak_mem_mb': peak_memory_mb(device) if device.type == 'cuda' else None,
+    }
+    if mode == 'train':
+        with amp.autocast():
+            stats['activation_mb'] = activation_memory_mb(model, inputs)
+    return stats
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """Matches results to baseline configurations.
+
+    Returns:
+        list: (config, metric, baseline value, new value) for every regression beyond `tolerance`
+    """
+    baseline_by_key = {_config_key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        key = _config_key(r)
+        if key not in baseline_by_key:
+            continue
+        base = baseline_by_key[key]
+        if r['images_per_sec'] < base['images_per_sec'] * (1. - tolerance):
+            regressions.append((key, 'images_per_sec', base['images_per_sec'], r['images_per_sec']))
+        if r['latency_ms']['p50'] > base['latency_ms']['p50'] * (1. + tolerance):
+            regressions.append((key, 'latency_p50_ms', base['latency_ms']['p50'], r['latency_ms']['p50']))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    results = []
+    for model_name, mode, batch_size, threads, memory_format, precision, segments in itertools.product(
+            args.models, args.modes, args.batch_sizes, args.threads, args.memory_formats, args.precisions,
+            args.checkpoint_segments):
+        if mode == 'inference' and segments > 0:
+            # checkpointing only affects training
+            continue
+        torch.set_num_threads(threads)
+        config = dict(zip(CONFIG_KEYS, (model_name, mode, batch_size, threads, memory_format, precision, segments)))
+        try:
+            stats = benchmark_config(model_name, mode, batch_size, memory_format, precision, device, args.warmup,
+                                     args.reps, segments)
+        except RuntimeError as e:
+            logging.warning(f"Skipping {config}: {e}")
+            continue
+        results.append({**config, **stats})
+        logging.info(
+            f"{model_name:<24}{mode:<10}bs={batch_size:<5}threads={threads:<3}{memory_format:<14}{precision:<5}"
+            f"ckpt={segments:<3}{stats['images_per_sec']:>10.1f} img/s    p50: {stats['latency_ms']['p50']:.2f}ms    "
+            f"p99: {stats['latency_ms']['p99']:.2f}ms" +
+            (f"    peak: {stats['peak_mem_mb']:.0f}MB" if stats['peak_mem_mb'] is not None else "") +
+            (f"    activations: {stats['activation_mb']:.0f}MB" if 'activation_mb' in stats else ""))
+
+    output = args.output or f"benchmark_{time.time()}.json"
+    meta = {'torch': torch.__version__, 'python': platform.python_version(), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'device': str(device),
+            'warmup': args.warmup, 'reps': args.reps}
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    logging.info(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for key, metric, before, after in regressions:
+            logging.warning(f"REGRESSION {dict(zip(CONFIG_KEYS, key))}: {metric} {before:.2f} -> {after:.2f}")
+        if regressions:
+            sys.exit(1)
+        logging.info(f"No regressions beyond {100 * args.tolerance:.0f}% against {args.compare}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Export PyTorch NN models for inference.
+
+Loads a checkpoint saved by `train.py`, folds BatchNorm layers into adjacent convolutions/linear layers (see
+`utils/fusion.py`), verifies that the logits of the fused model match the unfused model on the CIFAR-10 test split and
+saves the fused model as a TorchScript archive that `test.py` can load directly via `--checkpoint`.
+
+Typical usage:
+    $python export.py --model=<model_name> --checkpoint=<path-to-checkpoint> --output=<path-to-exported-model>
+"""
+
+import argparse
+import logging
+import sys
+
+import torch
+
+import utils
+from models import model_registry
+from utils.fusion import fuse_bn
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+parser = argparse.ArgumentParser(description="PyTorch CIFAR-10 Inference Export")
+parser.add_argument('--model', '-m', metavar='NAME', default='resnet10',
+                    help='Model identifier (default: resnet10)')
+parser.add_argument('--checkpoint', default='', type=str, metavar='CKPT_PATH',
+                    help='Path to checkpoint saved by train.py (default: none)')
+parser.add_argument('--output', default='', type=str, metavar='OUT_PATH',
+                    help='Path for the exported model (default: "<model>_fused.pt")')
+parser.add_argument('--device', default='cpu', type=str, metavar="DEV",
+                    help='Device to use for verification (default: "cpu")')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    metavar='N', help='Batch size (default: 256)')
+parser.add_argument('--atol', default=1e-3, type=float, metavar='TOL',
+                    help='Maximum absolute difference allowed between fused and unfused logits (default: 1e-3)')
+parser.add_argument('--data-cache', default='', type=str, metavar='CACHE_PATH',
+                    help='Directory for the memory-mapped dataset cache, created on first use (default: None)')
+
+
+def verify(model: torch.nn.Module, fused: torch.nn.Module, loader, device: torch.device):
+    """Compares logits of two models over a loader.
+
+    Returns:
+        tuple: max absolute logit difference, accuracy of model, accuracy of fused model
+    """
+    max_diff = torch.zeros((), device=device)
+    meter, fused_meter = utils.MetricAccumulator(device), utils.MetricAccumulator(device)
+    with torch.no_grad():
+        for inputs, targets in loader:
+            inputs, targets = inputs.to(device), targets.to(device)
+            outputs, fused_outputs = model(inputs), fused(inputs)
+            max_diff = torch.maximum(max_diff, (outputs - fused_outputs).abs().max())
+            meter.update(outputs, targets)
+            fused_meter.update(fused_outputs, targets)
+    return max_diff.item(), meter.compute()['acc'], fused_meter.compute()['acc']
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    model = model_registry[args.model]()
+    if args.checkpoint:
+        ckpt = torch.load(args.checkpoint, map_location=device)
+        model.load_state_dict(ckpt['model_state_dict'])
+    model = model.to(device).eval()
+
+    fused, num_folded = fuse_bn(model)
+    num_bn = sum(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules())
+    logging.info(f"Folded {num_folded}/{num_bn} BatchNorm layers of {args.model}.")
+
+    ROOT = ".data"
+    test_data = utils.create_dataset(ROOT, train=False, cache_dir=args.data_cache)
+    mean = (0.4914, 0.4822, 0.4465)
+    std = (0.2471, 0.2435, 0.2616)
+    input_size = (3, 32, 32)
+    test_loader = utils.create_loader(test_data, input_size=input_size, mean=mean, std=std, batch_size=args.batch_size,
+                                      is_training=False)
+
+    max_diff, acc, fused_acc = verify(model, fused, test_loader, device)
+    logging.info(f"Results:\n\tMax abs logit difference: {max_diff:.2e}\n\tAcc: {acc:.4f}\n\t"
+                 f"Fused Acc: {fused_acc:.4f}")
+    if max_diff > args.atol:
+        logging.error(f"Fused logits differ by more than {args.atol:.1e}, not exporting.")
+        sys.exit(1)
+
+    output = args.output or f"{args.model}_fused.pt"
+    torch.jit.save(torch.jit.script(fused), output)
+    logging.info(f"Exported fused model to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Activation checkpointing for sequential stages.
+
+`CheckpointedSequential` behaves like `nn.Sequential` (same submodules and state dict keys), but in training it splits
+`modules[start:end]` into `segments` contiguous segments, only keeps the activations at segment boundaries and
+recomputes the rest segment by segment during the backward pass, trading compute for memory. Unlike
+`checkpoint_sequential`, the last segment is checkpointed too, so a stage of a single block still saves its inner
+activations. Modules outside `[start, end)` (e.g. a stem whose input does not require grad) run normally. Evaluation and
+`torch.no_grad()` forward passes are not checkpointed.
+
+BatchNorm layers inside checkpointed segments update their running statistics twice per step, once in the forward pass
+and once when recomputed, which slightly shifts the running averages towards recent batches.
+
+Typical usage:
+    layer = checkpointed(*blocks, segments=2)  # plain nn.Sequential if segments is 0
+"""
+
+from typing import Optional
+
+import torch
+from torch import nn, Tensor
+from torch.utils.checkpoint import checkpoint
+
+
+class CheckpointedSequential(nn.Sequential):
+    def __init__(self, *modules: nn.Module, segments: int = 1, start: int = 0, end: Optional[int] = None):
+        super().__init__(*modules)
+        self.segments = segments
+        self.start = start
+        self.end = len(self) if end is None else end
+
+    def forward(self, x: Tensor) -> Tensor:
+        if not (self.training and torch.is_grad_enabled()):
+            return super().forward(x)
+        modules = list(self)
+        for module in modules[:self.start]:
+            x = module(x)
+        stage = modules[self.start:self.end]
+        segments = min(self.segments, len(stage))
+        bounds = [round(i * len(stage) / segments) for i in range(segments + 1)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            x = checkpoint(_run_segment(stage[lo:hi]), x)
+        for module in modules[self.end:]:
+            x = module(x)
+        return x
+
+    def extra_repr(self) -> str:
+        return f"segments={self.segments}, start={self.start}, end={self.end}"
+
+
+def _run_segment(modules):
+    def forward(x: Tensor) -> Tensor:
+        for module in modules:
+            x = module(x)
+        return x
+    return forward
+
+
+def checkpointed(*modules: nn.Module, segments: int = 0, start: int = 0, end: Optional[int] = None) -> nn.Sequential:
+    """Returns a `CheckpointedSequential` if `segments` > 0, otherwise a plain (scriptable) `nn.Sequential`."""
+    if segments > 0:
+        return CheckpointedSequential(*modules, segments=segments, start=start, end=end)
+    return nn.Sequential(*modules)
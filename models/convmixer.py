@@ -9,6 +9,8 @@ from typing import Callable
 import torch.nn as nn
 from torch import Tensor
 
+from .checkpoint import checkpointed
+
 
 class Residual(nn.Module):
     def __init__(self, fn: Callable):
@@ -20,8 +22,10 @@ class Residual(nn.Module):
 
 
 def ConvMixer(dim: int = 256, depth: int = 8, kernel_size: int = 9, patch_size: int = 1,
-              n_classes: int = 10) -> nn.Sequential:
-    return nn.Sequential(
+              n_classes: int = 10, checkpoint_segments: int = 0) -> nn.Sequential:
+    """`checkpoint_segments` > 0 recomputes the activations of the `depth` mixer blocks in that many segments during
+    the backward pass instead of storing them (see `models/checkpoint.py`)."""
+    return checkpointed(
         nn.Conv2d(3, dim, kernel_size=patch_size, stride=patch_size),
         nn.GELU(),
         nn.BatchNorm2d(dim),
@@ -36,25 +40,26 @@ def ConvMixer(dim: int = 256, depth: int = 8, kernel_size: int = 9, patch_size:
         ) for _ in range(depth)],
         nn.AdaptiveAvgPool2d((1, 1)),
         nn.Flatten(),
-        nn.Linear(dim, n_classes)
+        nn.Linear(dim, n_classes),
+        segments=checkpoint_segments, start=3, end=3 + depth
     )
 
 
-def ConvMixer256_8_k5_p1():
-    return ConvMixer(depth=8, kernel_size=5, patch_size=1)
+def ConvMixer256_8_k5_p1(**kwargs):
+    return ConvMixer(depth=8, kernel_size=5, patch_size=1, **kwargs)
 
 
-def ConvMixer256_8_k5_p2():
-    return ConvMixer(depth=8, kernel_size=5, patch_size=2)
+def ConvMixer256_8_k5_p2(**kwargs):
+    return ConvMixer(depth=8, kernel_size=5, patch_size=2, **kwargs)
 
 
-def ConvMixer256_8_k9_p1():
-    return ConvMixer(depth=8, kernel_size=9, patch_size=1)
+def ConvMixer256_8_k9_p1(**kwargs):
+    return ConvMixer(depth=8, kernel_size=9, patch_size=1, **kwargs)
 
 
-def ConvMixer256_8_k9_p2():
-    return ConvMixer(depth=8, kernel_size=9, patch_size=2)
+def ConvMixer256_8_k9_p2(**kwargs):
+    return ConvMixer(depth=8, kernel_size=9, patch_size=2, **kwargs)
 
 
-def ConvMixer256_16_k9_p2():
-    return ConvMixer(depth=16, kernel_size=9, patch_size=2)
+def ConvMixer256_16_k9_p2(**kwargs):
+    return ConvMixer(depth=16, kernel_size=9, patch_size=2, **kwargs)
@@ -10,6 +10,8 @@ import torch
 import torch.nn as nn
 from torch import Tensor
 
+from .checkpoint import checkpointed
+
 
 def conv3x3(in_channels: int, out_channels: int, stride: int = 1, groups: int = 1, padding: int = 1) -> nn.Conv2d:
     return nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=stride, padding=padding, groups=groups,
@@ -55,11 +57,9 @@ class ResBlock(nn.Module):
 
         out += identity
 
-        """
-            Inclusion of ReLU after addition has a minor negative effect on test performance. 
-            
-            See http://torch.ch/blog/2016/02/04/resnets.html
-        """
+        # Inclusion of ReLU after addition has a minor negative effect on test performance.
+        #
+        # See http://torch.ch/blog/2016/02/04/resnets.html
         # out = self.relu(out)
 
         return out
@@ -104,13 +104,11 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             identity = self.downsample(x)
         out += identity
-        """
-            Inclusion of ReLU after addition in a standard ResBlock has a minor negative effect on test performance. 
-
-            TODO: Test if above is also true for Bottleneck block.
-            
-            See http://torch.ch/blog/2016/02/04/resnets.html
-        """
+        # Inclusion of ReLU after addition in a standard ResBlock has a minor negative effect on test performance.
+        #
+        # TODO: Test if above is also true for Bottleneck block.
+        #
+        # See http://torch.ch/blog/2016/02/04/resnets.html
         out = self.relu(out)
 
         return out
@@ -123,13 +121,14 @@ class ResNet(nn.Module):
     """
 
     def __init__(self, block: Type[Union[ResBlock, Bottleneck]], layers: List[int], num_classes: int = 10,
-                 groups: int = 1, width_per_group: int = 64):
+                 groups: int = 1, width_per_group: int = 64, checkpoint_segments: int = 0):
         super().__init__()
         assert len(layers) == 4, f"layers requires a list of 4 integers, got {len(layers)}"
 
         self.in_channels = 64
         self.groups = groups
         self.base_width = width_per_group
+        self.checkpoint_segments = checkpoint_segments
         self.conv1 = nn.Conv2d(3, self.in_channels, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(self.in_channels)
         self.relu = nn.ReLU(inplace=True)
@@ -148,7 +147,7 @@ class ResNet(nn.Module):
         self.in_channels = out_channels * block.expansion
         for _ in range(1, blocks):
             layers.append(block(self.in_channels, out_channels, stride, base_width=self.base_width, groups=self.groups))
-        return nn.Sequential(*layers)
+        return checkpointed(*layers, segments=self.checkpoint_segments)
 
     def forward(self, x: Tensor) -> Tensor:
         x = self.conv1(x)
@@ -170,17 +169,17 @@ class ResNet(nn.Module):
     #     return self._forward_impl(x)
 
 
-def ResNet18():
-    return ResNet(ResBlock, [2, 2, 2, 2])
+def ResNet18(**kwargs):
+    return ResNet(ResBlock, [2, 2, 2, 2], **kwargs)
 
 
-def ResNet10():
-    return ResNet(ResBlock, [1, 1, 1, 1])
+def ResNet10(**kwargs):
+    return ResNet(ResBlock, [1, 1, 1, 1], **kwargs)
 
 
-def ResNeXt10_32_2d():
-    return ResNet(Bottleneck, [1, 1, 1, 1], groups=32, width_per_group=2)
+def ResNeXt10_32_2d(**kwargs):
+    return ResNet(Bottleneck, [1, 1, 1, 1], groups=32, width_per_group=2, **kwargs)
 
 
-def ResNet26_2_32d():
-    return ResNet(Bottleneck, [1, 1, 1, 1], groups=1, width_per_group=128)
+def ResNet26_2_32d(**kwargs):
+    return ResNet(Bottleneck, [1, 1, 1, 1], groups=1, width_per_group=128, **kwargs)
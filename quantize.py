@@ -0,0 +1,72 @@
+"""Post-training int8 quantization of PyTorch NN models.
+
+Loads a checkpoint saved by `train.py`, calibrates a statically quantized int8 version of the model on the held-out
+validation split (the same seeded split `train.py` uses) and saves it as a TorchScript archive. The quantized model
+runs on CPU and can be evaluated with `test.py`, side by side with the fp32 checkpoint:
+
+Typical usage:
+    $python quantize.py --model=<model_name> --checkpoint=<path-to-checkpoint> --output=<path-to-int8-model>
+    $python test.py --model=<model_name> --device=cpu --checkpoint=<path-to-int8-model> \
+        --compare-checkpoint=<path-to-checkpoint>
+"""
+
+import argparse
+import logging
+
+import torch
+
+import utils
+from models import model_registry
+from utils.quantization import prepare_quantization, calibrate, convert_quantization
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+parser = argparse.ArgumentParser(description="PyTorch CIFAR-10 Post-Training Quantization")
+parser.add_argument('--model', '-m', metavar='NAME', default='resnet10',
+                    help='Model identifier (default: resnet10)')
+parser.add_argument('--checkpoint', default='', type=str, metavar='CKPT_PATH',
+                    help='Path to checkpoint saved by train.py (default: none)')
+parser.add_argument('--output', default='', type=str, metavar='OUT_PATH',
+                    help='Path for the quantized model (default: "<model>_int8.pt")')
+parser.add_argument('--backend', default='fbgemm', type=str, metavar='BACKEND',
+                    help='Quantized engine, "fbgemm" for x86 or "qnnpack" for ARM (default: "fbgemm")')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    metavar='N', help='Calibration batch size (default: 256)')
+parser.add_argument('--calib-batches', default=0, type=int, metavar='N',
+                    help='Number of validation batches used for calibration, 0 for all (default: 0)')
+parser.add_argument('--val-ratio', type=float, default=0.9, metavar="V_SPLIT",
+                    help='Ratio for train-validation split, must match training (default: 0.9')
+parser.add_argument('--data-cache', default='', type=str, metavar='CACHE_PATH',
+                    help='Directory for the memory-mapped dataset cache, created on first use (default: None)')
+
+
+def main():
+    args = parser.parse_args()
+
+    model = model_registry[args.model]()
+    if args.checkpoint:
+        ckpt = torch.load(args.checkpoint, map_location='cpu')
+        model.load_state_dict(ckpt['model_state_dict'])
+    model.eval()
+
+    # Calibrate on the held-out validation split, never on the test split
+    ROOT = ".data"
+    train_data = utils.create_dataset(ROOT, train=True, cache_dir=args.data_cache)
+    _, val_data = utils.split_train_val(train_data, args.val_ratio)
+    mean = (0.4914, 0.4822, 0.4465)
+    std = (0.2471, 0.2435, 0.2616)
+    input_size = (3, 32, 32)
+    val_loader = utils.create_loader(val_data, input_size=input_size, mean=mean, std=std, batch_size=args.batch_size,
+                                     is_training=False)
+
+    observed = prepare_quantization(model, torch.randn(1, *input_size), backend=args.backend)
+    calibrate(observed, val_loader, num_batches=args.calib_batches)
+    quantized = convert_quantization(observed)
+
+    output = args.output or f"{args.model}_int8.pt"
+    torch.jit.save(torch.jit.script(quantized), output)
+    logging.info(f"Saved int8 model to {output}")
+
+
+if __name__ == '__main__':
+    main()
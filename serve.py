@@ -0,0 +1,146 @@
+"""Local inference server for CIFAR-10 classification models.
+
+Serves predictions for any `model_registry` model (or a model exported by `export.py`/`quantize.py`) over HTTP on
+localhost or a Unix socket. Concurrent single-image requests are coalesced into micro-batches (see
+`utils/serving.py`).
+
+Endpoints:
+    POST /predict   body: an encoded image (PNG, JPEG, ...), resized to 32x32 if needed
+                    returns: {"class": int, "label": str, "probs": [float, ...]}
+    GET  /stats     returns: request count, mean batch size, p50/p99 latency (ms) and throughput (images/sec)
+
+Typical usage:
+    $python serve.py --model=<model_name> --checkpoint=<path-to-checkpoint> --port=8000
+    $curl --data-binary @image.png http://127.0.0.1:8000/predict
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from PIL import Image
+
+import utils
+from utils.execution import COMPILE_MODES
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+CLASSES = ('airplane', 'automobile', 'bird', 'cat', 'deer', 'dog', 'frog', 'horse', 'ship', 'truck')
+
+parser = argparse.ArgumentParser(description="PyTorch CIFAR-10 Inference Server")
+parser.add_argument('--model', '-m', metavar='NAME', default='resnet10',
+                    help='Model identifier (default: resnet10)')
+parser.add_argument('--checkpoint', default='', type=str, metavar='CKPT_PATH',
+                    help='Path to checkpoint or exported model (default: none)')
+parser.add_argument('--device', default='cpu', type=str, metavar="DEV",
+                    help='Device to use (default: "cpu")')
+parser.add_argument('--port', default=8000, type=int, metavar='PORT',
+                    help='Port to listen on, bound to 127.0.0.1 (default: 8000)')
+parser.add_argument('--unix-socket', default='', type=str, metavar='PATH',
+                    help='Listen on a Unix socket instead of a TCP port (default: None)')
+parser.add_argument('--max-batch-size', default=32, type=int, metavar='N',
+                    help='Maximum number of requests per micro-batch (default: 32)')
+parser.add_argument('--max-delay', default=5.0, type=float, metavar='MS',
+                    help='Maximum time a request waits for a micro-batch to fill, in ms (default: 5.0)')
+parser.add_argument('--channels-last', action='store_true', default=False,
+                    help='Use channels_last memory format (default: False)')
+parser.add_argument('--compile', default='none', type=str, metavar='MODE', choices=COMPILE_MODES,
+                    help='Compile model with "compile", "script" or "auto" (default: "none")')
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_handler(batcher: utils.MicroBatcher, transform, input_size):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, payload: dict, status: int = 200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(batcher.stats())
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json({'error': 'not found'}, 404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                image = Image.open(io.BytesIO(self.rfile.read(length))).convert('RGB')
+            except Exception as e:
+                self._send_json({'error': f"invalid image: {e}"}, 400)
+                return
+            if image.size != tuple(input_size[-2:]):
+                image = image.resize(tuple(input_size[-2:]), Image.BILINEAR)
+            try:
+                probs = batcher.submit(transform(image)).result()
+            except Exception as e:
+                logging.error(f"Inference failed: {e}")
+                self._send_json({'error': f"inference failed: {e}"}, 500)
+                return
+            pred = int(probs.argmax())
+            self._send_json({'class': pred, 'label': CLASSES[pred], 'probs': probs.tolist()})
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return str(self.client_address[0]) if self.client_address else 'unix'
+
+        def log_message(self, format, *args):
+            logging.debug(f"{self.address_string()} - {format % args}")
+
+    return Handler
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    model = utils.load_model(args.model, args.checkpoint, device).eval()
+    model = utils.prepare_model(model, channels_last=args.channels_last, compile_mode=args.compile)
+
+    mean = (0.4914, 0.4822, 0.4465)
+    std = (0.2471, 0.2435, 0.2616)
+    input_size = (3, 32, 32)
+    transform = utils.create_transform(input_size=input_size, mean=mean, std=std, is_training=False)
+
+    batcher = utils.MicroBatcher(model, device, max_batch_size=args.max_batch_size, max_delay=args.max_delay / 1000.,
+                                 channels_last=args.channels_last)
+    handler = make_handler(batcher, transform, input_size)
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, handler)
+        logging.info(f"Serving {args.model} on unix:{args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), handler)
+        logging.info(f"Serving {args.model} on http://127.0.0.1:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stats = batcher.stats()
+        logging.info(
+            f"Results:\n\tRequests: {stats['requests']}\n\tMean batch size: {stats['mean_batch_size']:.1f}\n\t"
+            f"Latency p50/p99: {stats['p50_ms']:.1f}/{stats['p99_ms']:.1f}ms\n\t"
+            f"Throughput: {stats['throughput']:.1f} img/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,31 @@
 """Summarize PyTorch NN models.
 
-Quickly output model summary. Optional, save graph for viewing in TensorBoard.
+Quickly output model summary. Optional, save graph for viewing in TensorBoard, or profile per-layer forward/backward
+latency, FLOPs/MACs and activation memory (see `utils/costs.py`).
 
 Typical usage:
     $python summarize.py --config=<model-config-file>
+    $python summarize.py --model=<model_name> --layer-costs --sort-by=fwd_ms --logs=<log-path>
 
 TODO: Add support for saving ONXX models for viewing graph in Netron (https://github.com/lutzroeder/netron).
 """
 
 import argparse
+import copy
+import json
 import os
 
+import torch
 import torchvision
 from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary
 
 from models import model_registry
-from utils import create_loader
+from utils import create_loader, create_dataset, prepare_model, prepare_inputs
+from utils.costs import profile_layers
+from utils.execution import COMPILE_MODES
+
+COST_COLUMNS = ('params', 'macs', 'flops', 'act_mem', 'fwd_ms', 'bwd_ms')
 
 parser = argparse.ArgumentParser(description="PyTorch CIFAR-10 Model Summary Script", add_help=False)
 parser.add_argument('-c', '--config', default='', type=str, metavar='FILE',
@@ -28,6 +37,36 @@ parser.add_argument('--logs', default='', type=str, metavar="LOG_PATH",
                     help='Path to logs (default: None)')
 parser.add_argument('--save-graph', default=False, type=bool, metavar="GRAPH",
                     help="Save tensorboard graph (default: False)")
+parser.add_argument('--data-cache', default='', type=str, metavar='CACHE_PATH',
+                    help='Directory for the memory-mapped dataset cache, created on first use (default: None)')
+parser.add_argument('--channels-last', action='store_true', default=False,
+                    help='Check the model in channels_last memory format (default: False)')
+parser.add_argument('--compile', default='none', type=str, metavar='MODE', choices=COMPILE_MODES,
+                    help='Check the model compiled with "compile", "script" or "auto" (default: "none")')
+parser.add_argument('--layer-costs', action='store_true', default=False,
+                    help='Profile per-layer latency, FLOPs and activation memory (default: False)')
+parser.add_argument('--cost-batch-size', default=64, type=int, metavar='N',
+                    help='Batch size for the per-layer profile (default: 64)')
+parser.add_argument('--cost-reps', default=10, type=int, metavar='N',
+                    help='Number of timed forward/backward passes for the per-layer profile (default: 10)')
+parser.add_argument('--sort-by', default='order', type=str, metavar='COL', choices=('order',) + COST_COLUMNS,
+                    help='Sort the per-layer profile by a column, descending (default: "order", execution order)')
+parser.add_argument('--device', default='cpu', type=str, metavar="DEV",
+                    help='Device for the per-layer profile (default: "cpu")')
+
+
+def print_layer_costs(rows, totals, sort_by='order'):
+    if sort_by != 'order':
+        rows = sorted(rows, key=lambda r: r[sort_by], reverse=True)
+    header = f"{'Layer':<32} {'Type':<18} {'Output shape':<20} {'Params':>10} {'MFLOPs':>10} {'Act (MB)':>9} " \
+             f"{'Fwd (ms)':>9} {'Bwd (ms)':>9}"
+    print(header)
+    print('-' * len(header))
+    for r in rows + [totals]:
+        if r is totals:
+            print('-' * len(header))
+        print(f"{r['name']:<32} {r['type']:<18} {str(r['output_shape']):<20} {r['params']:>10,} "
+              f"{r['flops'] / 1e6:>10.2f} {r['act_mem'] / 2 ** 20:>9.2f} {r['fwd_ms']:>9.3f} {r['bwd_ms']:>9.3f}")
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -38,10 +77,36 @@ if __name__ == "__main__":
 
     summary(model, (3, 32, 32), device="cpu")
 
+    if args.channels_last or args.compile != 'none':
+        model.eval()
+        prepared = prepare_model(copy.deepcopy(model), channels_last=args.channels_last, compile_mode=args.compile)
+        x = torch.randn(8, 3, 32, 32)
+        with torch.no_grad():
+            diff = (prepared(prepare_inputs(x, args.channels_last)) - model(x)).abs().max().item()
+        print(f"Prepared model (channels_last: {args.channels_last}, compile: {args.compile}), "
+              f"max abs difference from eager: {diff:.2e}")
+
+    if args.layer_costs:
+        device = torch.device(args.device)
+        rows = profile_layers(copy.deepcopy(model), input_size=(3, 32, 32), batch_size=args.cost_batch_size,
+                              reps=args.cost_reps, device=device)
+        totals = {'name': 'Total', 'type': '', 'output_shape': ''}
+        totals.update({col: sum(r[col] for r in rows) for col in COST_COLUMNS})
+        print(f"Per-layer costs (batch size {args.cost_batch_size}, {args.cost_reps} reps on {device})")
+        print_layer_costs(rows, totals, args.sort_by)
+
+        if args.logs:
+            os.makedirs(args.logs, exist_ok=True)
+            cost_path = os.path.join(args.logs, f"{args.model}_layer_costs.json")
+            with open(cost_path, 'w') as f:
+                json.dump({'model': args.model, 'batch_size': args.cost_batch_size, 'reps': args.cost_reps,
+                           'device': str(device), 'layers': rows, 'totals': totals}, f, indent=2)
+            print(f"Saved per-layer costs to {cost_path}")
+
     if args.save_graph:
         print(f"Saving graph to {args.logs}/{args.model}")
         ROOT = ".data"
-        test_data = torchvision.datasets.CIFAR10(ROOT, train=False, download=True)
+        test_data = create_dataset(ROOT, train=False, cache_dir=args.data_cache)
 
         mean = (0.4914, 0.4822, 0.4465)
         std = (0.2471, 0.2435, 0.2616)
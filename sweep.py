@@ -0,0 +1,260 @@
+"""Parallel experiment sweeps.
+
+Runs `train.py` for every config matching one or more globs, or for every point of a parameter grid applied to a base
+config, in a pool of concurrent jobs. Each job gets its own set of CPU cores (`sched_setaffinity`) and a matching
+intra-op thread count (`--threads`, `OMP_NUM_THREADS`), so concurrent runs do not oversubscribe the CPU. The dataset
+cache is prepared once and shared by all jobs.
+
+Job status is kept in `<sweep-dir>/state.json`. Restarting the runner skips finished jobs and resumes interrupted or
+failed ones from their latest checkpoint. When all jobs have finished, a summary of best and final validation accuracy,
+wall time and training images/sec per config is printed and written to `<sweep-dir>/summary.json`.
+
+Typical usage:
+    $python sweep.py "experiments/convmixer*.yml" --jobs 4
+    $python sweep.py --base experiments/resnet_s38_default.yml --grid lr=0.05,0.1 batch_size=128,256 --jobs 2
+    $python sweep.py "experiments/*.yml" --jobs 4 -- --epochs 10
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import yaml
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+parser = argparse.ArgumentParser(description="PyTorch CIFAR-10 Experiment Sweep",
+                                 epilog='Arguments after "--" are passed to every train.py run.')
+parser.add_argument('configs', nargs='*', default=[], metavar='GLOB',
+                    help='Config files or globs to run (default: "experiments/*.yml" unless --base is given)')
+parser.add_argument('--base', default='', type=str, metavar='FILE',
+                    help='Base config for a parameter grid (default: None)')
+parser.add_argument('--grid', nargs='+', default=[], metavar='KEY=V1,V2',
+                    help='Config values to sweep over with --base, as YAML scalars (default: None)')
+parser.add_argument('--jobs', default=1, type=int, metavar='N',
+                    help='Number of concurrent runs (default: 1)')
+parser.add_argument('--threads-per-job', default=0, type=int, metavar='N',
+                    help='CPU cores and threads per run (default: 0, available cores split evenly between jobs)')
+parser.add_argument('--data-cache', default='.data/cache', type=str, metavar='CACHE_PATH',
+                    help='Shared memory-mapped dataset cache (default: ".data/cache")')
+parser.add_argument('--sweep-dir', default='sweeps/default', type=str, metavar='PATH',
+                    help='Directory for sweep state, generated configs, job output and summary '
+                         '(default: "sweeps/default")')
+parser.add_argument('--log-dir', default='logs', type=str, metavar='LOG_PATH',
+                    help='Path to training logs (default: "logs")')
+parser.add_argument('--checkpoint-dir', default='checkpoints', type=str, metavar='CKPT_PATH',
+                    help='Path to checkpoints (default: "checkpoints")')
+parser.add_argument('--dry-run', action='store_true', default=False,
+                    help='Print the commands without running them (default: False)')
+
+
+def expand_grid(base: str, grid: List[str], config_dir: str) -> Dict[str, str]:
+    """Writes one config per point of the grid.
+
+    Returns:
+        dict: experiment name -> generated config path
+    """
+    with open(base, 'r') as f:
+        base_cfg = yaml.safe_load(f) or {}
+    keys, values = [], []
+    for item in grid:
+        key, _, options = item.partition('=')
+        if not options:
+            raise ValueError(f"Grid entries must be KEY=V1,V2,..., got {item}")
+        keys.append(key.replace('-', '_'))
+        values.append([yaml.safe_load(v) for v in options.split(',')])
+
+    os.makedirs(config_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(base))[0]
+    configs = {}
+    for point in itertools.product(*values):
+        name = '_'.join([stem] + [f"{k}-{v}" for k, v in zip(keys, point)])
+        path = os.path.join(config_dir, f"{name}.yml")
+        with open(path, 'w') as f:
+            yaml.safe_dump({**base_cfg, **dict(zip(keys, point))}, f, default_flow_style=False)
+        configs[name] = path
+    return configs
+
+
+def core_slots(jobs: int, threads_per_job: int) -> List[List[int]]:
+    """Splits the cores available to this process into one disjoint set per concurrent job."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    per_job = threads_per_job or max(1, len(cores) // jobs)
+    if per_job * jobs > len(cores):
+        logging.warning(f"{jobs} jobs x {per_job} threads oversubscribe {len(cores)} available cores.")
+    return [[cores[(i * per_job + j) % len(cores)] for j in range(per_job)] for i in range(jobs)]
+
+
+def _latest(pattern: str) -> str:
+    paths = glob.glob(pattern)
+    return max(paths, key=os.path.getmtime) if paths else ''
+
+
+class SweepState:
+    """Job status persisted as JSON, written atomically after every change."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.jobs = json.load(f)
+
+    def update(self, name: str, **fields):
+        with self.lock:
+            self.jobs.setdefault(name, {}).update(fields)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.jobs, f, indent=2)
+            os.replace(tmp, self.path)
+
+
+def run_job(name: str, config: str, cores: List[int], args, extra: List[str], state: SweepState,
+            interrupted: threading.Event):
+    cmd = [sys.executable, 'train.py', '--config', config, '--experiment', name, '--threads', str(len(cores)),
+           '--data-cache', args.data_cache, '--log-dir', args.log_dir, '--checkpoint-dir', args.checkpoint_dir]
+    checkpoint = _latest(os.path.join(args.checkpoint_dir, name, '*.pt'))
+    if checkpoint:
+        cmd += ['--resume', checkpoint]
+    cmd += extra
+    if args.dry_run:
+        logging.info(f"[{name}] cores {cores}: {' '.join(cmd)}")
+        return
+
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+    job_dir = os.path.join(args.sweep_dir, 'jobs')
+    os.makedirs(job_dir, exist_ok=True)
+
+    logging.info(f"[{name}] starting on cores {cores}" + (f", resuming {checkpoint}" if checkpoint else ""))
+    attempts = state.jobs.get(name, {}).get('attempts', 0) + 1
+    state.update(name, status='running', config=config, attempts=attempts)
+    start = time.time()
+    with open(os.path.join(job_dir, f"{name}.log"), 'a') as out:
+        # preexec_fn is unsafe in a threaded parent, so the child is pinned right after it starts, before it
+        # creates its intra-op thread pool
+        proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, env=env)
+        if hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except ProcessLookupError:
+                pass
+        returncode = proc.wait()
+    wall_time = time.time() - start + state.jobs[name].get('wall_time', 0.0)
+    # train.py exits cleanly on an interrupt, so a job that was running when the sweep was interrupted is unfinished
+    if interrupted.is_set():
+        status = 'interrupted'
+    else:
+        status = 'done' if returncode == 0 else 'failed'
+    state.update(name, status=status, returncode=returncode, wall_time=wall_time)
+    logging.info(f"[{name}] {status} after {wall_time:.0f}s")
+
+
+def summarize(names: List[str], state: SweepState, log_dir: str) -> List[dict]:
+    """Collects the training metrics of every job.
+
+    Returns:
+        list: one row per job with status, epochs, best and final validation accuracy, wall time and images/sec
+    """
+    rows = []
+    for name in names:
+        job = state.jobs.get(name, {})
+        row = {'name': name, 'status': job.get('status', 'pending'), 'epochs': 0, 'best_acc': None,
+               'final_acc': None, 'wall_time': job.get('wall_time'), 'images_per_sec': None}
+        # A resumed run writes a new metrics file; later files take precedence for repeated epochs
+        by_epoch = {}
+        for path in sorted(glob.glob(os.path.join(log_dir, name, 'train_*')), key=os.path.getmtime):
+            with open(path, 'r') as f:
+                by_epoch.update({int(epoch): m for epoch, m in json.load(f).items()})
+        epochs = [by_epoch[epoch] for epoch in sorted(by_epoch)]
+        if epochs:
+            row['epochs'] = len(epochs)
+            row['best_acc'] = max(m['val_acc'] for m in epochs)
+            row['final_acc'] = epochs[-1]['val_acc']
+            throughput = [m['images_per_sec'] for m in epochs if 'images_per_sec' in m]
+            if throughput:
+                row['images_per_sec'] = sum(throughput) / len(throughput)
+        rows.append(row)
+    return rows
+
+
+def print_summary(rows: List[dict]):
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else format('-', '>9')
+
+    header = (f"{'Config':<44} {'Status':<11} {'Epochs':>6} {'Best acc':>9} {'Final acc':>9} {'Wall (s)':>9} "
+              f"{'img/s':>9}")
+    print(header)
+    print('-' * len(header))
+    for r in rows:
+        print(f"{r['name']:<44} {r['status']:<11} {r['epochs']:>6} {fmt(r['best_acc'], '>9.4f')} "
+              f"{fmt(r['final_acc'], '>9.4f')} {fmt(r['wall_time'], '>9.0f')} {fmt(r['images_per_sec'], '>9.1f')}")
+
+
+def main():
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    if args.base:
+        configs = expand_grid(args.base, args.grid, os.path.join(args.sweep_dir, 'configs'))
+    else:
+        paths = sorted({p for pattern in args.configs or ['experiments/*.yml'] for p in glob.glob(pattern)})
+        configs = {os.path.splitext(os.path.basename(p))[0]: p for p in paths}
+    if not configs:
+        parser.error("No configs to run")
+
+    state = SweepState(os.path.join(args.sweep_dir, 'state.json'))
+    pending = {name: cfg for name, cfg in configs.items() if state.jobs.get(name, {}).get('status') != 'done'}
+    logging.info(f"{len(configs)} configs, {len(configs) - len(pending)} already done, {len(pending)} to run.")
+
+    if pending and not args.dry_run:
+        # Prepare the shared dataset cache once, rather than in every job
+        import utils
+        utils.create_dataset('.data', train=True, cache_dir=args.data_cache)
+
+    slots = core_slots(args.jobs, args.threads_per_job)
+    free = list(range(len(slots)))
+    free_lock = threading.Lock()
+    interrupted = threading.Event()
+
+    def worker(name, config):
+        with free_lock:
+            slot = free.pop()
+        try:
+            run_job(name, config, slots[slot], args, extra, state, interrupted)
+        finally:
+            with free_lock:
+                free.append(slot)
+
+    pool = ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        for future in [pool.submit(worker, name, cfg) for name, cfg in pending.items()]:
+            future.result()
+    except KeyboardInterrupt:
+        # Running jobs receive the interrupt too and are recorded as interrupted; queued jobs are not started
+        interrupted.set()
+        logging.warning("Interrupted; restart the sweep to resume unfinished jobs.")
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    rows = summarize(list(configs), state, args.log_dir)
+    print_summary(rows)
+    with open(os.path.join(args.sweep_dir, 'summary.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,30 @@
 """PyTorch NN testing script for CIFAR-10 classification models.
 
+Per-sample logits, predictions and labels are written to memory-mappable `.npy` files with a JSON summary in
+`<logs>/<experiment>/test_<time>/` (see `utils/predictions.py`). With `--tta`, the model is evaluated again with
+test-time augmentation (see `utils/tta.py`), and the accuracy lift and throughput cost over single-view evaluation are
+reported. With `--ensemble`, several checkpoints are evaluated on a single pass over the test set (see
+`utils/ensemble.py`), and the accuracy of every member and the accuracy and time per batch added by each member are
+reported.
 
 Typical usage:
     $python test.py --model=<model_name> --checkpoint=<path-to-checkpoint> --logs=<path-to-save-logs>
+    $python test.py --model=<model_name> --ensemble <ckpt-1> <model_name>:<ckpt-2> --logs=<path-to-save-logs>
 """
 import argparse
-import json
 import logging
 import os
 import time
+from typing import List, Optional, Tuple
 
 import torch
-import torchvision
-from torch import Tensor
 
 import utils
 from models import model_registry
+from utils.ensemble import Ensemble, EnsembleAccumulator, ENSEMBLE_MODES, member_costs
+from utils.execution import COMPILE_MODES
+from utils.predictions import PredictionWriter, LOGITS_DTYPES
+from utils.tta import TestTimeAugmentation, TTA_MODES, max_chunk_for_budget
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
@@ -33,82 +42,230 @@ parser.add_argument('--log-interval', default=10, type=int,
                     metavar='LOG_I', help='Batch logging frequency (default: 10)')
 parser.add_argument('--logs', default='', type=str, metavar="LOG_PATH",
                     help='Path to logs (default: None)')
+parser.add_argument('--logits-dtype', default='float16', type=str, choices=LOGITS_DTYPES,
+                    help='Precision of the saved per-sample logits (default: "float16")')
+parser.add_argument('--data-backend', default='pil', type=str, metavar='BACKEND',
+                    help='Data backend, "pil" or "tensor" (default: "pil")')
+parser.add_argument('--data-cache', default='', type=str, metavar='CACHE_PATH',
+                    help='Directory for the memory-mapped dataset cache, created on first use (default: None)')
+parser.add_argument('--workers', type=int, default=0, metavar='N',
+                    help='Number of dataloader worker processes, "pil" backend only (default: 0)')
+parser.add_argument('--prefetch', action='store_true', default=False,
+                    help='Load and copy batches to the device on a background thread (default: False)')
+parser.add_argument('--channels-last', action='store_true', default=False,
+                    help='Use channels_last memory format for model and inputs (default: False)')
+parser.add_argument('--compile', default='none', type=str, metavar='MODE', choices=COMPILE_MODES,
+                    help='Compile model with "compile", "script" or "auto" (default: "none")')
+parser.add_argument('--amp', action='store_true', default=False,
+                    help='Mixed precision: bfloat16 autocast on CPU, float16 on CUDA (default: False)')
+parser.add_argument('--tta', default='none', type=str, choices=TTA_MODES,
+                    help='Test-time augmentation views: "flip", "shift" or "flip_shift" (default: "none")')
+parser.add_argument('--tta-shift', default=2, type=int, metavar='PX',
+                    help='Shift of the shifted TTA views in pixels (default: 2)')
+parser.add_argument('--tta-reduce', default='mean', type=str, choices=['mean', 'max'],
+                    help='Reduction of the logits over TTA views (default: "mean")')
+parser.add_argument('--tta-memory-mb', default=0, type=float, metavar='MB',
+                    help='Activation memory budget for one TTA forward pass; the expanded batch is split into chunks '
+                         'to fit (default: 0, no limit)')
+parser.add_argument('--ensemble', nargs='+', default=[], metavar='[NAME:]CKPT_PATH',
+                    help='Checkpoints to evaluate as an ensemble, each optionally prefixed with its model identifier '
+                         '(default: --model); replaces --checkpoint (default: none)')
+parser.add_argument('--ensemble-mode', default='auto', type=str, choices=ENSEMBLE_MODES,
+                    help='Run ensemble members "sequential", in "threads" or "stacked" into one vmapped forward '
+                         '(default: "auto")')
+parser.add_argument('--compare-checkpoint', default='', type=str, metavar='CKPT_PATH',
+                    help='Checkpoint of a second model to evaluate side by side, e.g. fp32 vs. int8 (default: none)')
+parser.add_argument('--compare-model', default='', type=str, metavar='NAME',
+                    help='Model identifier for --compare-checkpoint (default: same as --model)')
 
 
-def accuracy(y_pred: Tensor, y: Tensor):
-    """Calculates accuracy."""
-    top_pred = y_pred.argmax(1, keepdim=True)
-    correct = top_pred.eq(y.view_as(top_pred)).sum()
-    acc = correct.float() / y.shape[0]
-    return acc
+def evaluate(model: torch.nn.Module, loader, args, device: torch.device,
+             writer: Optional[PredictionWriter] = None) -> dict:
+    """Evaluates model over loader, streaming per-sample outputs to `writer` if given.
 
+    Returns:
+        dict: loss, accuracy, number of samples, wall time and throughput in images/sec
+    """
+    model.eval()
+    criterion = torch.nn.CrossEntropyLoss().to(device)
+    amp = utils.MixedPrecision(device, enabled=args.amp)
+    meter = utils.MetricAccumulator(device)
+    data_wait = 0.0
+    num_batches = len(loader)
+    eval_start = time.perf_counter()
+    with torch.no_grad():
+        data_start = time.perf_counter()
+        for batch_idx, (inputs, targets) in enumerate(loader):
+            data_wait += time.perf_counter() - data_start
+            start = time.time()
+            inputs = utils.prepare_inputs(inputs.to(device), args.channels_last)
+            targets = targets.to(device)
 
-# device
-def validate(args):
+            with amp.autocast():
+                outputs = model(inputs)
+                loss = criterion(outputs, targets)
+            end = time.time() - start
+
+            meter.update(outputs, targets, loss)
+
+            if writer is not None:
+                writer.write(outputs, targets)
+
+            if (batch_idx + 1) % args.log_interval == 0:
+                running = meter.compute()
+                logging.info(
+                    f"Test: [{batch_idx + 1}/{num_batches}     "
+                    f"Acc:  {running['acc']:.3f}     "
+                    f"Time: {end:.4f}     "
+                    f"Data: {1000 * data_wait / (batch_idx + 1):.1f}ms/step"
+                )
+            data_start = time.perf_counter()
+
+    metrics = meter.compute()
+    metrics['time'] = time.perf_counter() - eval_start
+    metrics['throughput'] = metrics['count'] / metrics['time']
+    return metrics
+
+
+def parse_members(specs: List[str], default_model: str) -> List[Tuple[str, str]]:
+    """Splits "[NAME:]CKPT_PATH" ensemble member specs.
+
+    Returns:
+        list: (model identifier, checkpoint path) per member
     """
+    members = []
+    for spec in specs:
+        name, sep, path = spec.partition(':')
+        members.append((name, path) if sep and name in model_registry else (default_model, spec))
+    return members
+
+
+def evaluate_ensemble(ensemble: Ensemble, loader, args, device: torch.device,
+                      writer: Optional[PredictionWriter] = None) -> dict:
+    """Evaluates every member and the mean-logit ensemble over one pass of loader, streaming the ensemble outputs to
+    `writer` if given.
+
+    Returns:
+        dict: ensemble loss, accuracy, number of samples, wall time and throughput, with the accuracy of every member
+            ("member_acc") and of the ensembles of the first k members ("prefix_acc")
+    """
+    ensemble.eval()
+    criterion = torch.nn.CrossEntropyLoss().to(device)
+    amp = utils.MixedPrecision(device, enabled=args.amp)
+    meter = utils.MetricAccumulator(device)
+    members_meter = EnsembleAccumulator(len(ensemble.members), device)
+    num_batches = len(loader)
+    eval_start = time.perf_counter()
+    with torch.no_grad():
+        for batch_idx, (inputs, targets) in enumerate(loader):
+            inputs = utils.prepare_inputs(inputs.to(device), args.channels_last)
+            targets = targets.to(device)
+
+            with amp.autocast():
+                member_logits = ensemble(inputs)
+                outputs = member_logits.float().mean(0)
+                loss = criterion(outputs, targets)
+
+            meter.update(outputs, targets, loss)
+            members_meter.update(member_logits, targets)
+            if writer is not None:
+                writer.write(outputs, targets)
+
+            if (batch_idx + 1) % args.log_interval == 0:
+                logging.info(f"Test: [{batch_idx + 1}/{num_batches}     Acc:  {meter.compute()['acc']:.3f}")
+
+    metrics = meter.compute()
+    metrics['time'] = time.perf_counter() - eval_start
+    metrics['throughput'] = metrics['count'] / metrics['time']
+    metrics.update(members_meter.compute())
+    return metrics
+
+
+def validate_ensemble(args, test_loader, writer: PredictionWriter) -> dict:
+    """Loads the --ensemble members, evaluates them on one pass over test_loader and times growing ensembles.
 
     Returns:
-        tuple: loss, accuracy, time
+        dict: ensemble metrics (see `evaluate_ensemble`), with the members, the execution mode and the milliseconds
+            per batch of the ensembles of the first k members ("prefix_ms")
     """
     device = torch.device(args.device)
+    members = parse_members(args.ensemble, args.model)
+    models = []
+    for name, path in members:
+        model = utils.load_model(name, path, device)
+        models.append(utils.prepare_model(model.eval(), channels_last=args.channels_last, compile_mode=args.compile))
 
-    # Load model
-    model = model_registry[args.model]()
+    amp = utils.MixedPrecision(device, enabled=args.amp)
+    ensemble = Ensemble(models, mode=args.ensemble_mode, amp=amp, device=device)
+    logging.info(f"Ensemble of {len(models)} members, run {ensemble.mode}.")
+    try:
+        metrics = evaluate_ensemble(ensemble, test_loader, args, device, writer)
+    finally:
+        ensemble.close()
 
-    # Load checkpoint
-    if args.checkpoint:
-        ckpt = torch.load(args.checkpoint)
-        model.load_state_dict(ckpt['model_state_dict'])
+    inputs, _ = next(iter(test_loader))
+    inputs = utils.prepare_inputs(inputs.to(device), args.channels_last)
+    metrics['prefix_ms'] = member_costs(models, inputs, mode=ensemble.mode, amp=amp)
+    metrics['mode'] = ensemble.mode
+    metrics['members'] = [{'model': name, 'checkpoint': path} for name, path in members]
+    return metrics
 
-    model = model.to(device)
 
-    criterion = torch.nn.CrossEntropyLoss().to(device)
+def validate(args):
+    """
+
+    Returns:
+        dict: evaluation metrics, with those of test-time augmentation under "tta" and of the comparison model under
+            "compare" if requested, or ensemble metrics (see `validate_ensemble`) with --ensemble
+    """
+    device = torch.device(args.device)
 
     ROOT = ".data"
-    test_data = torchvision.datasets.CIFAR10(ROOT,
-                                             train=False,
-                                             download=True)
+    test_data = utils.create_dataset(ROOT, train=False, cache_dir=args.data_cache)
     mean = (0.4914, 0.4822, 0.4465)
     std = (0.2471, 0.2435, 0.2616)
     input_size = (3, 32, 32)
 
     test_loader = utils.create_loader(test_data, input_size=input_size, mean=mean, std=std, batch_size=args.batch_size,
-                                      is_training=False)
+                                      is_training=False, backend=args.data_backend, device=device,
+                                      num_workers=args.workers, prefetch=args.prefetch)
 
-    model.eval()
-    results = {}
-    test_acc = 0
-    m = 0
-    num_batches = len(test_loader)
-    with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(test_loader):
-            start = time.time()
-            inputs = inputs.to(device)
-            targets = targets.to(device)
+    out_dir = os.path.join(args.logs, args.experiment, f"test_{time.time()}")
+    writer = PredictionWriter(out_dir, num_samples=len(test_data), num_classes=10, logits_dtype=args.logits_dtype)
+    if args.ensemble:
+        metrics = validate_ensemble(args, test_loader, writer)
+        summary_path = writer.close(summary={'model': args.model, **metrics})
+        logging.info(f"Saved per-sample ensemble outputs to {out_dir} (summary: {summary_path})")
+        return metrics
 
-            outputs = model(inputs)
-            end = time.time() - start
-
-            criterion(outputs, targets)
-            test_acc += (outputs.max(1)[1] == targets).sum().item()
-            m += targets.size(0)
+    model = utils.load_model(args.model, args.checkpoint, device)
+    model.eval()
+    model = utils.prepare_model(model, channels_last=args.channels_last, compile_mode=args.compile)
+    metrics = evaluate(model, test_loader, args, device, writer)
 
-            results[batch_idx] = {'test_acc': test_acc / m, 'predicted_labels': outputs.tolist()[0],
-                                  'true_labels': targets.tolist()[0]}
+    if args.tta != 'none':
+        max_chunk = max_chunk_for_budget(model, input_size, args.tta_memory_mb, device)
+        tta_model = TestTimeAugmentation(model, mode=args.tta, shift=args.tta_shift, reduction=args.tta_reduce,
+                                         max_chunk=max_chunk, channels_last=args.channels_last)
+        logging.info(f"TTA: {tta_model.num_views} views per image, reduced by {args.tta_reduce}, "
+                     f"{max_chunk or 'unlimited'} images per forward pass.")
+        # The first pass is cold and also writes per-sample outputs, so the single-view baseline is timed again the
+        # same way as the TTA pass: warm and without a writer
+        single = evaluate(model, test_loader, args, device)
+        metrics['tta'] = evaluate(tta_model, test_loader, args, device)
+        metrics['tta'].update({'views': tta_model.num_views, 'acc_lift': metrics['tta']['acc'] - metrics['acc'],
+                               'single_throughput': single['throughput'],
+                               'slowdown': single['throughput'] / metrics['tta']['throughput']})
 
-            if (batch_idx + 1) % args.log_interval == 0:
-                logging.info(
-                    f"Test: [{batch_idx + 1}/{num_batches}     "
-                    f"Acc:  {test_acc / m:.3f}     "
-                    f"Time: {end:.4f}"
-                )
+    summary_path = writer.close(summary={'model': args.model, 'checkpoint': args.checkpoint, **metrics})
+    logging.info(f"Saved per-sample outputs to {out_dir} (summary: {summary_path})")
 
-        if results:
-            data_dump = json.dumps(results)
-            f = open(os.path.join(args.logs, args.experiment, f"test_{time.time()}"), "w")
-            f.write(data_dump)
-            f.close()
-        return test_acc / m
+    if args.compare_checkpoint:
+        compare_model = utils.load_model(args.compare_model or args.model, args.compare_checkpoint, device)
+        compare_model = utils.prepare_model(compare_model.eval(), channels_last=args.channels_last,
+                                            compile_mode=args.compile)
+        metrics['compare'] = evaluate(compare_model, test_loader, args, device)
+    return metrics
 
 
 def main():
@@ -117,8 +274,35 @@ def main():
     if not os.path.exists(args.logs):
         os.makedirs(args.logs)
 
-    test_acc = validate(args)
-    logging.info(f"Results:\n\tTest Acc: {test_acc:.3f}")
+    metrics = validate(args)
+    logging.info(f"Results:\n\tTest Acc: {metrics['acc']:.3f}\n\tThroughput: {metrics['throughput']:.1f} img/s")
+    if 'members' in metrics:
+        lines = [f"{'#':<4}{'Model':<24}{'Acc':>8}{'Ens acc':>9}{'Gain':>9}{'ms/batch':>10}{'+ms':>9}"]
+        for k, member in enumerate(metrics['members']):
+            prev_acc = metrics['prefix_acc'][k - 1] if k else 0.0
+            prev_ms = metrics['prefix_ms'][k - 1] if k else 0.0
+            lines.append(f"{k + 1:<4}{member['model']:<24}{metrics['member_acc'][k]:>8.4f}"
+                         f"{metrics['prefix_acc'][k]:>9.4f}{metrics['prefix_acc'][k] - prev_acc:>+9.4f}"
+                         f"{metrics['prefix_ms'][k]:>10.1f}{metrics['prefix_ms'][k] - prev_ms:>+9.1f}")
+        logging.info('\n'.join(lines))
+    if 'tta' in metrics:
+        tta = metrics['tta']
+        label = f"tta x{tta['views']}"
+        logging.info(
+            f"{'':<12}{'Acc':>8}{'img/s':>12}\n"
+            f"{'single':<12}{metrics['acc']:>8.4f}{tta['single_throughput']:>12.1f}\n"
+            f"{label:<12}{tta['acc']:>8.4f}{tta['throughput']:>12.1f}\n"
+            f"{'lift/cost':<12}{tta['acc_lift']:>+8.4f}{tta['slowdown']:>11.2f}x"
+        )
+    if 'compare' in metrics:
+        compare = metrics['compare']
+        logging.info(
+            f"{'':<12}{'Acc':>8}{'img/s':>12}\n"
+            f"{'model':<12}{metrics['acc']:>8.4f}{metrics['throughput']:>12.1f}\n"
+            f"{'compare':<12}{compare['acc']:>8.4f}{compare['throughput']:>12.1f}\n"
+            f"{'delta':<12}{metrics['acc'] - compare['acc']:>+8.4f}"
+            f"{metrics['throughput'] / compare['throughput']:>11.2f}x"
+        )
 
 
 if __name__ == '__main__':
@@ -6,27 +6,45 @@ arguments will overwrite the defaults provided by the configuration file.
 A rewrite of timm, pared-down for use with CIFAR-10 image dataset. For original timm, see
 https://github.com/rwightman/pytorch-image-models.
 
+With `--nproc-per-node` > 1 (and/or `--nnodes` > 1), training runs data-parallel over that many worker processes per
+node, communicating over gloo. `--batch-size` is per worker and the learning rate is scaled to the global batch size
+according to `--lr-scale`. Only the first worker writes logs and checkpoints.
+
 Typical usage:
     $python train.py --config your-experiment-config.yml
+    $python train.py --config your-experiment-config.yml --nproc-per-node=4
 """
 
 import argparse
+import contextlib
 import json
 import logging
+import math
 import os.path
 import time
-from typing import Tuple, Callable
+from typing import Tuple, Callable, Optional
 
-import numpy as np
 import torch
 import torch.utils.data
-import torchvision as torchvision
 import yaml
-from torch import Tensor
 
 import utils
 from models import model_registry
-from utils import create_optimizer, create_scheduler
+from utils import create_optimizer, create_scheduler, MetricAccumulator, MixedPrecision, prepare_model, \
+    prepare_inputs, param_groups
+from utils.checkpoint_saver import CheckpointSaver, set_rng_state
+from utils.dataloaders import set_epoch, loader_state_dict, load_loader_state_dict
+from utils.distributed import launch, init_distributed, is_primary, get_rank, get_world_size, barrier, cleanup, \
+    scale_lr, min_over_workers
+from utils.execution import COMPILE_MODES
+from utils.metrics import reset_peak_memory, peak_memory_mb
+from utils.micro_batch import accumulation_plan, find_micro_batch_size
+from utils.optimizer import OPTIMIZERS, OPTIMIZER_IMPLS
+from utils.profiler import PhaseTimer, create_profiler
+from utils.progressive_resizing import BATCH_SCALING, ResolutionSchedule, annotate_throughput_gain, \
+    parse_resolution_stages
+from utils.scheduler import optimizer_steps_per_epoch, rescale_lr
+from utils.time_to_accuracy import TimeToAccuracy
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
@@ -44,17 +62,40 @@ group.add_argument('--resume', default='', type=str, metavar='PATH',
                    help='Resume full model and optimizer state from checkpoint (default: none)')
 group.add_argument('-b', '--batch-size', type=int, default=512, metavar='N',
                    help='Input batch size for training (default: 512)')
+group.add_argument('--micro-batch-size', type=int, default=0, metavar='N',
+                   help='Largest batch per forward/backward pass; gradients of micro-batches are accumulated up to '
+                        '--batch-size before each optimizer step (default: 0, the batch size)')
+group.add_argument('--find-micro-batch', action='store_true', default=False,
+                   help='Probe the largest micro-batch that fits in memory, up to --batch-size, by binary search on '
+                        'synthetic training steps (default: False)')
+group.add_argument('--memory-budget-mb', type=float, default=0, metavar='MB',
+                   help='Memory budget for --find-micro-batch: peak CUDA memory, or activation memory on CPU, where '
+                        'running out of memory usually kills the process (default: 0, until out of memory)')
+group.add_argument('--channels-last', action='store_true', default=False,
+                   help='Use channels_last memory format for model and inputs (default: False)')
+group.add_argument('--compile', default='none', type=str, metavar='MODE', choices=COMPILE_MODES,
+                   help='Compile model with "compile" (torch.compile), "script" (TorchScript) or "auto" '
+                        '(default: "none")')
+group.add_argument('--checkpoint-segments', type=int, default=0, metavar='N',
+                   help='Activation checkpointing: recompute each stage (ResNet layer or ConvMixer block stack) in N '
+                        'segments during backward instead of storing activations (default: 0, disabled)')
 
 # Optimizer parameters
 group = parser.add_argument_group('Optimizer parameters')
-group.add_argument('--opt', default='sgd', type=str, metavar='OPTIMIZER',
-                   help='Optimizer (default: "sgd")')
+group.add_argument('--opt', default='sgd', type=str, metavar='OPTIMIZER', choices=OPTIMIZERS,
+                   help='Optimizer, "sgd", "adam", "adamw", or "lars" and "lamb" for large batches (default: "sgd")')
+group.add_argument('--opt-impl', default='auto', type=str, choices=OPTIMIZER_IMPLS,
+                   help='Optimizer implementation: multi-tensor "foreach", "fused" kernels or "for_loop" '
+                        '(default: "auto", fused where available, else foreach)')
 group.add_argument('--opt-eps', default=None, type=float, metavar='EPSILON',
                    help='Optimizer Epsilon (default: None, use opt default)')
 group.add_argument('--momentum', type=float, default=0.9, metavar='M',
                    help='Optimizer momentum (default: 0.9)')
 group.add_argument('--weight-decay', type=float, default=5e-5, metavar="WD",
                    help='Weight decay (default: 5e-5)')
+group.add_argument('--decay-norm-bias', action='store_true', default=False,
+                   help='Also apply weight decay to norm layer weights and biases, in a single parameter group as in '
+                        'checkpoints from earlier versions (default: False)')
 
 # Learning rate schedule parameters
 group = parser.add_argument_group('Learning rate schedule parameters')
@@ -93,22 +134,97 @@ group.add_argument('--ra-n', type=int, default=0, metavar="RAN",
                    help='Number of operations for random augmentation (default: 0)')
 group.add_argument('--ra-m', type=float, default=0.0, metavar="RAM",
                    help='Magnitude of random augmentation operations (default: 0.0')
+group.add_argument('--resize-schedule', nargs='+', default=[], metavar='SIZE:EPOCH',
+                   help='Progressive resizing: train at SIZE pixels from EPOCH on, e.g. "16:0 24:10 32:20"; '
+                        'validation always runs at full resolution (default: full resolution throughout)')
+group.add_argument('--resize-batch-scale', default='area', type=str, choices=BATCH_SCALING,
+                   help='Scale the batch size of reduced-resolution stages by the ratio of image areas ("area") or '
+                        'keep it ("none") (default: "area")')
+group.add_argument('--resize-lr-scale', default='linear', type=str, choices=['linear', 'sqrt', 'none'],
+                   help='Scale the learning rate of a resolution stage with its batch size (default: "linear")')
 group.add_argument('--erase', type=float, default=0.25, metavar="RE", help='Random erase probability (default: 0.25)')
 group.add_argument('--jitter', type=float, default=0.1, metavar="JITTER",
                    help='Color jitter probability (default: 0.1)')
 parser.add_argument('--beta', default=0.0, type=float,
                     help='CutMix beta')
 parser.add_argument('--cutmix-prob', default=0.0, type=float,
-                    help='CutMix probability')
+                    help='CutMix probability, per sample')
+parser.add_argument('--mixup-alpha', default=0.0, type=float,
+                    help='MixUp alpha')
+parser.add_argument('--mixup-prob', default=0.0, type=float,
+                    help='MixUp probability, per sample not selected for CutMix')
+
+# Data pipeline parameters
+group = parser.add_argument_group('Data pipeline parameters')
+group.add_argument('--data-backend', default='pil', type=str, metavar='BACKEND',
+                   help='Data backend, "pil" for per-sample transforms or "tensor" for batched transforms on a '
+                        'tensor-resident dataset (default: "pil")')
+group.add_argument('--data-cache', default='', type=str, metavar='CACHE_PATH',
+                   help='Directory for the memory-mapped dataset cache, created on first use (default: None)')
+group.add_argument('--threads', type=int, default=0, metavar='N',
+                   help='Intra-op CPU threads per training process (default: 0, torch default)')
+group.add_argument('--workers', type=int, default=0, metavar='N',
+                   help='Number of dataloader worker processes, "pil" backend only (default: 0)')
+group.add_argument('--persistent-workers', action='store_true', default=False,
+                   help='Keep dataloader workers alive across epochs (default: False)')
+group.add_argument('--prefetch', action='store_true', default=False,
+                   help='Load and copy batches to the device on a background thread (default: False)')
+
+# Time-to-accuracy parameters
+group = parser.add_argument_group('Time-to-accuracy parameters')
+group.add_argument('--target-acc', type=float, default=0.0, metavar='ACC',
+                   help='Stop as soon as validation accuracy reaches ACC, e.g. 0.94, and write a time-to-accuracy '
+                        'result record (default: 0, train for --epochs)')
+group.add_argument('--time-budget', type=float, default=0.0, metavar='SEC',
+                   help='Stop after the first evaluation past SEC seconds of training (default: 0, no limit)')
+group.add_argument('--eval-interval', type=int, default=0, metavar='STEPS',
+                   help='With --target-acc or --time-budget, also validate every STEPS optimizer steps '
+                        '(default: 0, after every epoch only)')
+group.add_argument('--result-file', type=str, default='', metavar='PATH',
+                   help='Path of the time-to-accuracy result record '
+                        '(default: "<log-dir>/<experiment>/<experiment>_time_to_accuracy.json")')
+
+# Distributed training parameters
+group = parser.add_argument_group('Distributed training parameters')
+group.add_argument('--nproc-per-node', type=int, default=1, metavar='N',
+                   help='Number of data-parallel worker processes to launch on this node (default: 1)')
+group.add_argument('--nnodes', type=int, default=1, metavar='N',
+                   help='Number of nodes (default: 1)')
+group.add_argument('--node-rank', type=int, default=0, metavar='RANK',
+                   help='Rank of this node (default: 0)')
+group.add_argument('--master-addr', default='127.0.0.1', type=str, metavar='ADDR',
+                   help='Address of the rank 0 node (default: "127.0.0.1")')
+group.add_argument('--master-port', type=int, default=29500, metavar='PORT',
+                   help='Port of the rank 0 node (default: 29500)')
+group.add_argument('--dist-backend', default='gloo', type=str, metavar='BACKEND',
+                   help='torch.distributed backend (default: "gloo")')
+group.add_argument('--lr-scale', default='linear', type=str, choices=['linear', 'sqrt', 'none'],
+                   help='Scale --lr, tuned for --batch-size, to the global batch size (default: "linear")')
 
 # Misc
 group = parser.add_argument_group('Miscellaneous parameters')
+group.add_argument('--profile', action='store_true', default=False,
+                   help='Record a torch.profiler trace of a window of training and validation steps (default: False)')
+group.add_argument('--profile-epoch', type=int, default=0, metavar='EPOCH',
+                   help='Epoch to profile (default: 0, the first epoch run)')
+group.add_argument('--profile-wait', type=int, default=1, metavar='N',
+                   help='Steps to skip before profiling (default: 1)')
+group.add_argument('--profile-warmup', type=int, default=1, metavar='N',
+                   help='Profiler warmup steps, not recorded (default: 1)')
+group.add_argument('--profile-steps', type=int, default=5, metavar='N',
+                   help='Steps to record (default: 5)')
+group.add_argument('--amp', action='store_true', default=False,
+                   help='Mixed precision: bfloat16 autocast on CPU, float16 with loss scaling on CUDA (default: False)')
 group.add_argument('--log-interval', type=int, default=50, metavar='LOG_I',
                    help='Batches to wait before logging training status')
 group.add_argument('--recovery-interval', type=int, default=0, metavar='REC_I',
-                   help='Batches to wait before writing recovery checkpoint')
+                   help='Optimizer steps to wait before writing recovery checkpoint (default: 0, disabled)')
+group.add_argument('--recovery-hist', type=int, default=1, metavar='NUM_REC',
+                   help='Most recent recovery checkpoints to keep (default: 1)')
 group.add_argument('--checkpoint-hist', type=int, default=10, metavar='NUM_CKPT',
-                   help='Checkpoints to keep (default: 10)')
+                   help='Best checkpoints (by validation accuracy) to keep (default: 10)')
+group.add_argument('--checkpoint-last', type=int, default=1, metavar='NUM_LAST',
+                   help='Most recent end-of-epoch checkpoints to keep (default: 1)')
 group.add_argument('--checkpoint-dir', default='checkpoints', type=str, metavar='CKPT_PATH',
                    help='Path to checkpoints (default: checkpoints)')
 group.add_argument('--log-dir', default='logs', type=str, metavar='LOG_PATH',
@@ -134,254 +250,469 @@ def _parse_args():
     return args, args_text
 
 
-def rand_bbox(size, lam):
-    """CutMix regularization function.
-
-    See https://github.com/clovaai/CutMix-PyTorch
-
-    """
-    W = size[2]
-    H = size[3]
-    cut_rat = np.sqrt(1. - lam)
-    cut_w = int(W * cut_rat)
-    cut_h = int(H * cut_rat)
-
-    # uniform
-    cx = np.random.randint(W)
-    cy = np.random.randint(H)
-
-    bbx1 = np.clip(cx - cut_w // 2, 0, W)
-    bby1 = np.clip(cy - cut_h // 2, 0, H)
-    bbx2 = np.clip(cx + cut_w // 2, 0, W)
-    bby2 = np.clip(cy + cut_h // 2, 0, H)
-
-    return bbx1, bby1, bbx2, bby2
-
-
-def accuracy(y_pred: Tensor, y: Tensor):
-    """Calculates accuracy."""
-    top_pred = y_pred.argmax(1, keepdim=True)
-    correct = top_pred.eq(y.view_as(top_pred)).sum()
-    acc = correct.float() / y.shape[0]
-    return acc
-
-
 def train_one_epoch(epoch: int, model: torch.nn.Module, loader: torch.utils.data.DataLoader,
                     optimizer: torch.optim.Optimizer, lr_scheduler: Callable, train_loss_fn: Callable, args,
-                    device=torch.device('cuda')
-                    ) -> Tuple[float, float, float]:
+                    device=torch.device('cuda'), amp: Optional[MixedPrecision] = None, profiler=None,
+                    saver: Optional[CheckpointSaver] = None, start_batch: int = 0, accum_steps: int = 1,
+                    tracker: Optional[TimeToAccuracy] = None, eval_fn: Optional[Callable] = None,
+                    recovery_state: Optional[dict] = None, start_step: Optional[int] = None
+                    ) -> Tuple[float, float, float, dict, int]:
     """Trains model for a single epoch.
 
+    Gradients of `accum_steps` consecutive loader batches are accumulated before each optimizer and scheduler step;
+    the last step of an epoch may accumulate fewer. Loss and accuracy are accumulated on the device and only read back
+    every `args.log_interval` batches. If given, `profiler.step()` is called after every batch and `saver` writes a
+    recovery checkpoint, with the extra `recovery_state`, every `args.recovery_interval` optimizer steps. When resuming
+    an epoch, `start_batch` is the index of the first batch the loader yields. `start_step` is the number of optimizer
+    steps before this epoch, if earlier epochs had a different number of steps. If `tracker` is given, it counts the
+    images trained on, and every `tracker.eval_interval` optimizer steps `eval_fn()` is called for validation loss and
+    accuracy; the epoch ends early once the tracker stops training.
+
     Returns:
-        tuple: loss, accuracy
+        tuple: loss, accuracy, learning rate, per-phase timings, number of images (over all workers)
     """
+    if amp is None:
+        amp = MixedPrecision(device, enabled=False)
     num_batches = len(loader)
     last_idx = num_batches - 1
-    num_updates = epoch * num_batches
-    epoch_loss = 0.0
-    epoch_acc = 0.0
+    steps_per_epoch = optimizer_steps_per_epoch(num_batches, accum_steps)
+    if start_step is None:
+        start_step = epoch * steps_per_epoch
+    num_updates = start_step + start_batch // accum_steps
+    world_size = get_world_size()
+    epoch_meter = MetricAccumulator(device)
+    interval_meter = MetricAccumulator(device)
+    timer = PhaseTimer(device, sync=profiler is not None)
 
     model.train()
     lr = None
 
-    for batch_idx, (inputs, targets) in enumerate(loader):
-        inputs = inputs.to(device)
-        targets = targets.to(device)
-
-        # CutMix regularization - See https://github.com/clovaai/CutMix-PyTorch
-        r = np.random.rand(1)
-        if args.beta > 0 and r < args.cutmix_prob:
-            # generate mixed sample
-            lam = np.random.beta(args.beta, args.beta)
-            rand_index = torch.randperm(inputs.size()[0]).cuda()
-            target_a = targets
-            target_b = targets[rand_index]
-            bbx1, bby1, bbx2, bby2 = rand_bbox(inputs.size(), lam)
-            inputs[:, :, bbx1:bbx2, bby1:bby2] = inputs[rand_index, :, bbx1:bbx2, bby1:bby2]
-            # adjust lambda to exactly match pixel ratio
-            lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (inputs.size()[-1] * inputs.size()[-2]))
-            # compute output
-            outputs = model(inputs)
-            loss = train_loss_fn(outputs, target_a) * lam + train_loss_fn(outputs, target_b) * (1. - lam)
-        else:
-            # compute output
-            outputs = model(inputs)
-            loss = train_loss_fn(outputs, targets)
-
-        lr = lr_scheduler.get_last_lr()[0]  # for logging
-
-        acc = accuracy(outputs, targets)
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        # Call lr scheduler with appropriate arguments
-        if args.sched == 'onecycle':
-            lr_scheduler.step()
-        elif args.sched == 'cosine_warm':
-            lr_scheduler.step(epoch + batch_idx / num_batches)
-        num_updates += 1
-
-        epoch_loss += loss.item()
-        epoch_acc += acc.item()
-        if (batch_idx + 1) % args.log_interval == 0:
-            logging.info(
-                f"Epoch: {epoch + 1} [{batch_idx + 1}/{num_batches} ({100 * batch_idx / last_idx:.0f}%)]     "
-                f"Loss: {loss:.3f} ({epoch_loss / (batch_idx + 1):.3f})    "
-                f"Acc: {acc:.3f} ({epoch_acc / (batch_idx + 1):.3f})    "
-                f"lr: {lr:.6f}"
-            )
-
-    return epoch_loss / num_batches, epoch_acc / num_batches, lr
+    end = time.perf_counter()
+    with profiler or contextlib.nullcontext():
+        for batch_idx, (inputs, targets) in enumerate(loader, start_batch):
+            timer.add('data_wait', time.perf_counter() - end)
+            with timer.phase('h2d'):
+                inputs = prepare_inputs(inputs.to(device), args.channels_last)
+                targets = targets.to(device)
+
+            # Batches are accumulated in groups of `accum_steps` from the start of the epoch
+            group_start = batch_idx - batch_idx % accum_steps
+            group_size = min(accum_steps, num_batches - group_start)
+            is_step = batch_idx + 1 == group_start + group_size
+            # DDP only needs to all-reduce gradients on the last micro-batch of a step
+            no_sync = not is_step and hasattr(model, 'no_sync')
+            with model.no_sync() if no_sync else contextlib.nullcontext():
+                # CutMix/MixUp, if enabled, are applied by the loader and targets arrive as soft labels
+                with timer.phase('forward'), amp.autocast():
+                    outputs = model(inputs)
+                    loss = train_loss_fn(outputs, targets)
+
+                lr = optimizer.param_groups[0]['lr']  # for logging
+
+                with timer.phase('backward'):
+                    amp.backward(loss / group_size if group_size > 1 else loss)
+            step_loss = loss.detach() if batch_idx == group_start else step_loss + loss.detach()
+
+            if is_step:
+                with timer.phase('optimizer'):
+                    amp.optimizer_step(optimizer, step_loss)
+                    optimizer.zero_grad(set_to_none=True)
+                # Call lr scheduler with appropriate arguments
+                with timer.phase('scheduler'):
+                    if args.sched == 'onecycle':
+                        lr_scheduler.step()
+                    elif args.sched == 'cosine_warm':
+                        lr_scheduler.step(epoch + batch_idx / num_batches)
+                num_updates += 1
+                if saver is not None and args.recovery_interval and \
+                        (batch_idx // accum_steps + 1) % args.recovery_interval == 0:
+                    with timer.phase('checkpoint'):
+                        saver.save_recovery(epoch, batch_idx, loader_state=loader_state_dict(loader),
+                                            **(recovery_state or {}))
+            timer.step()
+
+            epoch_meter.update(outputs, targets, loss)
+            interval_meter.update(outputs, targets, loss)
+            if (batch_idx + 1) % args.log_interval == 0:
+                interval, running = interval_meter.compute(), epoch_meter.compute()
+                interval_meter.reset()
+                logging.info(
+                    f"Epoch: {epoch + 1} [{batch_idx + 1}/{num_batches} ({100 * batch_idx / last_idx:.0f}%)]     "
+                    f"Loss: {interval['loss']:.3f} ({running['loss']:.3f})    "
+                    f"Acc: {interval['acc']:.3f} ({running['acc']:.3f})    "
+                    f"lr: {lr:.6f}    "
+                    f"Data: {1000 * timer.totals['data_wait'] / (batch_idx + 1):.1f}ms/step"
+                )
+
+            if tracker is not None:
+                tracker.add_images(targets.shape[0] * world_size)
+                if is_step and tracker.should_eval(num_updates):
+                    eval_start = time.perf_counter()
+                    with timer.phase('eval'):
+                        val_loss, val_acc = eval_fn()
+                    model.train()
+                    stop = tracker.update(val_loss, val_acc, num_updates,
+                                          epoch + (num_updates - start_step) / steps_per_epoch,
+                                          time.perf_counter() - eval_start)
+                    logging.info(f"Step {num_updates}: Val Acc: {val_acc:.4f}    Time: {tracker.elapsed:.1f}s    "
+                                 f"Images: {tracker.images:,d}")
+                    if stop:
+                        break
+            if profiler is not None:
+                profiler.step()
+            end = time.perf_counter()
+
+    epoch_meter.all_reduce()
+    results = epoch_meter.compute()
+    return results['loss'], results['acc'], lr, timer.summary(), results['count']
 
 
 def validate(model: torch.nn.Module, loader: torch.utils.data.DataLoader, loss_fn: Callable,
-             device=torch.device('cuda')) -> Tuple[float, float]:
+             device=torch.device('cuda'), amp: Optional[MixedPrecision] = None,
+             channels_last: bool = False, profiler=None) -> Tuple[float, float]:
     """Model validation.
 
     Returns:
         tuple: (loss, accuracy)
     """
+    if amp is None:
+        amp = MixedPrecision(device, enabled=False)
     model.eval()
-    num_batches = len(loader)
-    last_idx = len(loader) - 1
-    val_loss = 0.0
-    val_acc = 0.0
-    with torch.no_grad():
+    meter = MetricAccumulator(device)
+    with torch.no_grad(), profiler or contextlib.nullcontext():
         for batch_idx, (inputs, targets) in enumerate(loader):
-            inputs = inputs.to(device)
+            inputs = prepare_inputs(inputs.to(device), channels_last)
             targets = targets.to(device)
 
-            outputs = model(inputs)
+            with amp.autocast():
+                outputs = model(inputs)
+                loss = loss_fn(outputs, targets)
 
-            loss = loss_fn(outputs, targets)
-            acc = accuracy(outputs, targets)
+            meter.update(outputs, targets, loss)
+            if profiler is not None:
+                profiler.step()
 
-            val_loss += loss
-            val_acc += acc
+    meter.all_reduce()
+    results = meter.compute()
+    return results['loss'], results['acc']
 
-    return val_loss / num_batches, val_acc / num_batches
 
-
-def main():
-    args, args_text = _parse_args()
+def train_worker(local_rank: int, args, args_text: str):
+    device = init_distributed(local_rank, args.nproc_per_node, args.dist_backend)
+    rank, world_size = get_rank(), get_world_size()
+    # Device for small collectives outside DDP, which NCCL only supports on CUDA
+    sync_device = device if args.dist_backend == 'nccl' else torch.device('cpu')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    elif world_size > 1 and device.type == 'cpu':
+        # Share the node's cores between its workers
+        torch.set_num_threads(max(1, torch.get_num_threads() // args.nproc_per_node))
 
     logging.info(f"Preparing experiment {args.experiment}...")
 
     ckpt_path = os.path.join(args.checkpoint_dir, args.experiment)
-    if not os.path.exists(ckpt_path):
-        os.makedirs(ckpt_path)
     log_path = os.path.join(args.log_dir, args.experiment)
-    if not os.path.exists(log_path):
-        os.makedirs(log_path)
-    with open(os.path.join(log_path, f"{args.experiment}_config.yml"), "w") as f:
-        f.write(args_text)
-        f.close()
-
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    #        TODO: Revise model creation to take parameters as kwargs?
-    #           model_registry[args.model] -> model_registry[args.model](**kwargs)
-    #           Requires adding direct call to class definition, e.g., { "resnet": ResNet }
-
-    model = model_registry[args.model]()
+    if is_primary():
+        os.makedirs(ckpt_path, exist_ok=True)
+        os.makedirs(log_path, exist_ok=True)
+        with open(os.path.join(log_path, f"{args.experiment}_config.yml"), "w") as f:
+            f.write(args_text)
+            f.close()
+
+    base_lr = scale_lr(args.lr, world_size, args.lr_scale)
+    if world_size > 1:
+        logging.info(f"Training on {world_size} workers, global batch size {args.batch_size * world_size}, "
+                     f"lr {args.lr} -> {base_lr} ({args.lr_scale} scaling).")
+
+    model = model_registry[args.model](checkpoint_segments=args.checkpoint_segments)
     model = model.to(device)
 
     logging.info(f"{args.model} created, # of params: {sum([m.numel() for m in model.parameters()]):,d}.")
-    optimizer = create_optimizer(params=model.parameters(), opt_name=args.opt, lr=args.lr,
-                                 weight_decay=args.weight_decay)
+    optimizer = create_optimizer(params=param_groups(model, args.weight_decay, args.decay_norm_bias),
+                                 opt_name=args.opt, lr=base_lr, weight_decay=args.weight_decay, eps=args.opt_eps,
+                                 momentum=args.momentum, impl=args.opt_impl, device_type=device.type)
 
     train_loss_fn = torch.nn.CrossEntropyLoss().to(device)
     validate_loss_fn = torch.nn.CrossEntropyLoss().to(device)
 
-    # Create training and validation datasets
-    ROOT = '.data'
-    train_data = torchvision.datasets.CIFAR10(ROOT,
-                                              train=True,
-                                              download=True)
+    amp = MixedPrecision(device, enabled=args.amp)
+    # Shares parameters with `model`, which is kept for the optimizer and checkpoints
+    train_model = prepare_model(model, channels_last=args.channels_last, compile_mode=args.compile)
+
+    # Resume model weights from checkpoint, if provided; the remaining state is restored once the scheduler exists
+    ckpt = None
+    if args.resume:
+        ckpt = torch.load(args.resume, map_location=device)
+        model.load_state_dict(ckpt['model_state_dict'])
 
     # CIFAR-10 statistics
     mean = (0.4914, 0.4822, 0.4465)
     std = (0.2471, 0.2435, 0.2616)
     input_size = (3, 32, 32)
 
-    n_train = int(len(train_data) * args.val_ratio)
-    n_val = len(train_data) - n_train
-    # Seed generator so that, if continuing from checkpoint, we do not have data leakage from the validation set
-    train_data, val_data = torch.utils.data.random_split(train_data, [n_train, n_val],
-                                                         generator=torch.Generator().manual_seed(2766521))
+    # Largest full-resolution micro-batch; a recovery checkpoint keeps its split of the batch, so the loader position
+    # it saved stays valid
+    if ckpt is not None and 'batch_idx' in ckpt:
+        max_micro_batch_size = ckpt.get('max_micro_batch_size') or \
+            math.ceil(args.batch_size / ckpt.get('accum_steps', 1))
+    else:
+        max_micro_batch_size = min(args.micro_batch_size or args.batch_size, args.batch_size)
+        if args.find_micro_batch:
+            max_micro_batch_size = find_micro_batch_size(
+                train_model, train_loss_fn, input_size, max_batch_size=max_micro_batch_size, device=device, amp=amp,
+                channels_last=args.channels_last, budget_mb=args.memory_budget_mb)
+            max_micro_batch_size = min_over_workers(max_micro_batch_size, sync_device)
+            logging.info(f"Largest micro-batch that fits: {max_micro_batch_size}.")
+
+    # Progressive resizing: each stage trains at its own resolution, batch size and learning rate multiplier
+    resolution = ResolutionSchedule(parse_resolution_stages(args.resize_schedule), full_size=input_size[-1],
+                                    batch_size=args.batch_size, batch_scaling=args.resize_batch_scale,
+                                    lr_rule=args.resize_lr_scale)
+
+    def accumulation(epoch: int) -> Tuple[int, int]:
+        # Memory per image scales with its area, so smaller images fit proportionally larger micro-batches
+        batch_size = resolution.batch_size(epoch)
+        max_micro = max(1, int(max_micro_batch_size * resolution.area_ratio(epoch)))
+        return accumulation_plan(batch_size, min(max_micro, batch_size))
+
+    # Create training and validation datasets
+    ROOT = '.data'
+    # The primary worker downloads and caches the dataset before the others read it
+    if is_primary():
+        train_data = utils.create_dataset(ROOT, train=True, cache_dir=args.data_cache)
+    barrier()
+    if not is_primary():
+        train_data = utils.create_dataset(ROOT, train=True, cache_dir=args.data_cache)
+
+    train_data, val_data = utils.split_train_val(train_data, args.val_ratio)
+
+    def loader_length(epoch: int) -> int:
+        samples = math.ceil(len(train_data) / world_size) if world_size > 1 else len(train_data)
+        return math.ceil(samples / accumulation(epoch)[0])
+
+    def optimizer_steps(epochs: int) -> int:
+        """Optimizer steps in the first `epochs` epochs."""
+        return sum(optimizer_steps_per_epoch(loader_length(e), accumulation(e)[1]) for e in range(epochs))
 
     # Create dataloaders w/augmentation pipeline
-    train_loader = utils.create_loader(train_data, input_size=input_size, mean=mean, std=std,
-                                       batch_size=args.batch_size, is_training=True, rand_aug=args.rand_aug,
-                                       ra_n=args.ra_n, ra_m=args.ra_m, jitter=args.jitter, scale=args.scale,
-                                       prob_erase=args.erase)
+    pipeline_args = dict(backend=args.data_backend, device=device, num_workers=args.workers,
+                         persistent_workers=args.persistent_workers, prefetch=args.prefetch,
+                         num_replicas=world_size, rank=rank)
+    mixup_fn = utils.Mixup(cutmix_alpha=args.beta, cutmix_prob=args.cutmix_prob, mixup_alpha=args.mixup_alpha,
+                           mixup_prob=args.mixup_prob, num_classes=10)
+
+    def create_train_loader(epoch: int):
+        # The crop of the training transform emits the resolution of the stage
+        size = resolution.size(epoch)
+        return utils.create_loader(train_data, input_size=(input_size[0], size, size), mean=mean, std=std,
+                                   batch_size=accumulation(epoch)[0], is_training=True, rand_aug=args.rand_aug,
+                                   ra_n=args.ra_n, ra_m=args.ra_m, jitter=args.jitter, scale=args.scale,
+                                   prob_erase=args.erase, batch_fn=mixup_fn if mixup_fn.enabled else None,
+                                   **pipeline_args)
     val_loader = utils.create_loader(val_data, input_size=input_size, mean=mean, std=std, batch_size=args.batch_size,
-                                     is_training=False)
+                                     is_training=False, **pipeline_args)
+
+    # Validation runs on the unwrapped model, as workers may have different numbers of validation batches
+    ddp_model = train_model
+    if world_size > 1:
+        ddp_model = torch.nn.parallel.DistributedDataParallel(
+            train_model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+    # Create scheduler; each worker steps once per optimizer step over its own shard, and the epochs of different
+    # resolution stages may have different numbers of steps
+    lr_scheduler = create_scheduler(optimizer=optimizer, lr=base_lr, sched=args.sched, num_epochs=args.epochs,
+                                    steps_per_epoch=loader_length(0), min_lr=args.min_lr,
+                                    T_0=args.t_initial, T_mult=args.t_mult, plateau_mode=args.plateau_mode,
+                                    patience=args.patience, accum_steps=accumulation(0)[1],
+                                    total_steps=optimizer_steps(args.epochs))
+    # Learning rate multiplier of the resolution stage the optimizer and scheduler are set up for
+    lr_factor = 1.0
 
-    # Resume from checkpoint, if provided
-    start_epoch = 0
+    start_epoch, start_batch = 0, 0
     best_acc = None
-    if args.resume:
-        ckpt = torch.load(args.resume)
-        model.load_state_dict(ckpt['model_state_dict'])
+    if ckpt is not None:
+        # Loaded after creating the scheduler, which resets the learning rate of the optimizer
         optimizer.load_state_dict(ckpt['optimizer_state_dict'])
-        start_epoch = ckpt['epoch']
-        best_acc = ckpt['acc']
-
-    # Create scheduler
-    lr_scheduler = create_scheduler(optimizer=optimizer, lr=args.lr, sched=args.sched, num_epochs=args.epochs,
-                                    steps_per_epoch=len(train_loader), min_lr=args.min_lr,
-                                    T_0=args.t_initial, T_mult=args.t_mult, plateau_mode=args.plateau_mode,
-                                    patience=args.patience)
-    if (lr_scheduler is not None or lr_scheduler != 'custom') and start_epoch > 0:
-        lr_scheduler.step(start_epoch)
+        amp.load_state_dict(ckpt.get('scaler_state_dict'))
+        # Checkpoints written before "best_acc" was recorded only hold their own accuracy
+        best_acc = ckpt.get('best_acc', ckpt['acc'])
+        if 'batch_idx' in ckpt:
+            # Recovery checkpoint, written after batch `batch_idx` of epoch `epoch`
+            start_epoch, start_batch = ckpt['epoch'], ckpt['batch_idx'] + 1
+            if start_batch >= loader_length(start_epoch):
+                start_epoch, start_batch = start_epoch + 1, 0
+        else:
+            # Checkpoint written after validating epoch `epoch`
+            start_epoch = ckpt['epoch'] + 1
+
+        # The optimizer state holds the learning rate of the resolution stage it was saved in
+        lr_factor = resolution.lr_scale(ckpt['epoch'])
+
+        if lr_scheduler is not None and ckpt.get('scheduler_state_dict') is not None:
+            lr_scheduler.load_state_dict(ckpt['scheduler_state_dict'])
+        elif args.sched == 'onecycle':
+            # Checkpoints without scheduler state: replay the per-batch schedule up to the resume position
+            for _ in range(optimizer_steps(start_epoch) + start_batch // accumulation(start_epoch)[1]):
+                lr_scheduler.step()
+        elif args.sched == 'cosine_warm':
+            lr_scheduler.step(start_epoch + start_batch / loader_length(start_epoch))
+
+    train_loader = create_train_loader(start_epoch)
+    if ckpt is not None:
+        if start_batch > 0 and ckpt.get('loader_state') is not None:
+            load_loader_state_dict(train_loader, ckpt['loader_state'], skip_batches=start_batch)
+        # With several workers, each keeps its own random streams. A prefetching loader had already drawn the
+        # augmentations of later batches when the checkpoint was written, so its state at the batch boundary is used
+        rng = (ckpt.get('loader_state') or {}).get('rng_state', ckpt.get('rng_state'))
+        if rng is not None and world_size == 1:
+            set_rng_state(rng)
+        logging.info(f"Resuming from {args.resume} at epoch {start_epoch + 1}, batch {start_batch}.")
+
+    # Only the primary worker writes checkpoints. Retention only carries over from the run being resumed, as runs
+    # without an experiment name share a checkpoint directory
+    saver = None
+    if is_primary():
+        resume_dir = bool(args.resume) and os.path.samefile(os.path.dirname(os.path.abspath(args.resume)), ckpt_path)
+        saver = CheckpointSaver(model, optimizer, amp, ckpt_path, prefix=args.model, max_history=args.checkpoint_hist,
+                                max_recovery=args.recovery_hist, lr_scheduler=lr_scheduler, resume=resume_dir,
+                                max_last=args.checkpoint_last)
+
+    tracker = None
+    if args.target_acc > 0 or args.time_budget > 0:
+        # Workers stop together if any of them runs out of time
+        tracker = TimeToAccuracy(args.target_acc, args.time_budget, args.eval_interval,
+                                 agree=lambda stop: min_over_workers(int(not stop), sync_device) == 0)
+
+        def eval_fn():
+            return validate(train_model, val_loader, validate_loss_fn, device, amp, args.channels_last)
+        tracker.start()
 
     metrics = {}
+    # Also describes the result record of a resumed run that has no epochs left
+    micro_batch_size, accum_steps = accumulation(start_epoch)
     try:
         for epoch in range(start_epoch, args.epochs):
-            start = time.time()
+            new_stage = epoch == start_epoch or resolution.stage(epoch) != resolution.stage(epoch - 1)
+            if new_stage and epoch > start_epoch:
+                train_loader = create_train_loader(epoch)
+            if resolution.lr_scale(epoch) != lr_factor:
+                rescale_lr(lr_scheduler, optimizer, resolution.lr_scale(epoch) / lr_factor)
+                lr_factor = resolution.lr_scale(epoch)
+            micro_batch_size, accum_steps = accumulation(epoch)
+            if new_stage:
+                if resolution.enabled:
+                    logging.info(f"Resolution stage {resolution.stage(epoch) + 1}/{len(resolution.stages)}: "
+                                 f"{resolution.size(epoch)}px, batch size {resolution.batch_size(epoch)}, "
+                                 f"lr x{lr_factor:.2f}.")
+                if accum_steps > 1:
+                    logging.info(f"Accumulating {accum_steps} micro-batches of {micro_batch_size} per optimizer step "
+                                 f"(effective batch size {micro_batch_size * accum_steps}).")
 
-            (train_loss, train_acc, lr) = train_one_epoch(epoch, model, train_loader, optimizer, lr_scheduler,
-                                                          train_loss_fn, args,
-                                                          device)
-            (val_loss, val_acc) = validate(model, val_loader, validate_loss_fn, device)
+            start = time.time()
+            reset_peak_memory(device)
+            set_epoch(train_loader, epoch)
+
+            train_profiler = val_profiler = None
+            if args.profile and is_primary() and epoch == max(args.profile_epoch, start_epoch):
+                trace_dir = os.path.join(log_path, 'traces')
+                train_profiler = create_profiler(os.path.join(trace_dir, 'train'), wait=args.profile_wait,
+                                                 warmup=args.profile_warmup, active=args.profile_steps, device=device)
+                val_profiler = create_profiler(os.path.join(trace_dir, 'val'), wait=args.profile_wait,
+                                               warmup=args.profile_warmup, active=args.profile_steps, device=device)
+
+            (train_loss, train_acc, lr, phases, train_images) = train_one_epoch(
+                epoch, ddp_model, train_loader, optimizer, lr_scheduler, train_loss_fn, args, device, amp,
+                train_profiler, saver, start_batch=start_batch if epoch == start_epoch else 0,
+                accum_steps=accum_steps, tracker=tracker, eval_fn=eval_fn if tracker is not None else None,
+                recovery_state={'accum_steps': accum_steps, 'max_micro_batch_size': max_micro_batch_size},
+                start_step=optimizer_steps(epoch))
+            t_train = time.time() - start
+            end_step = optimizer_steps(epoch + 1)
+            evaluated = tracker is not None and bool(tracker.evaluations) and \
+                tracker.evaluations[-1]['step'] == end_step
+            if tracker is not None and (tracker.done or evaluated):
+                # Stopped within the epoch right after an evaluation, or the last step of the epoch was evaluated
+                (val_loss, val_acc) = tracker.last_eval
+            else:
+                eval_start = time.perf_counter()
+                (val_loss, val_acc) = validate(train_model, val_loader, validate_loss_fn, device, amp,
+                                               args.channels_last, val_profiler)
+                if tracker is not None:
+                    tracker.update(val_loss, val_acc, end_step, epoch + 1, time.perf_counter() - eval_start)
             if args.sched == 'plateau':
                 lr_scheduler.step(val_loss)
 
             t_epoch = time.time() - start
+            # Compute time of a training step, excluding time spent waiting for data
+            step_ms = sum(phase['ms_per_step'] for name, phase in phases.items() if name not in ('data_wait', 'eval'))
+            peak_mem_mb = peak_memory_mb(device)
             logging.info(
                 f"Epoch {epoch + 1} complete:\n\tTrain Acc: {train_acc:.2f}\n\tTest Acc: {val_acc:.2f}\n\t"
-                f"lr: {lr:.5f}\n\tTime: {t_epoch:.1f}s")
-
-            # TODO:
-            #  Find better solution:
-            #       val_loss and val_acc are returned as tensors--they shouldn't be!
-            metrics[epoch] = {'train_loss': train_loss, 'train_acc': train_acc, 'val_loss': val_loss.item(),
-                              'val_acc': val_acc.item(), "lr": lr, "t_epoch": t_epoch}
+                f"lr: {lr:.5f}\n\tTime: {t_epoch:.1f}s (" +
+                ", ".join(f"{name}: {phase['total_s']:.1f}s" for name, phase in phases.items()) + ")\n\t"
+                f"Step: {step_ms:.1f}ms\n\tPeak memory: {peak_mem_mb:.0f}MB")
+
+            metrics[epoch] = {'train_loss': train_loss, 'train_acc': train_acc, 'val_loss': val_loss,
+                              'val_acc': val_acc, "lr": lr, "t_epoch": t_epoch,
+                              "data_wait": phases['data_wait']['total_s'], "phases": phases, "amp": args.amp,
+                              "step_ms": step_ms, "peak_mem_mb": peak_mem_mb,
+                              "checkpoint_segments": args.checkpoint_segments, "world_size": world_size,
+                              "micro_batch_size": micro_batch_size, "accum_steps": accum_steps,
+                              "resolution": resolution.size(epoch), "batch_size": resolution.batch_size(epoch),
+                              "images_per_sec": train_images / t_train, "t_train": t_train}
 
             if best_acc is None or val_acc > best_acc:
                 if best_acc is not None:
-                    logging.info(
-                        f"Accuracy increased ({0.00 if None else best_acc:.2f} -> {val_acc:.2f}). Saving model...")
-                torch.save({
-                    'epoch': epoch,
-                    'loss': val_loss,
-                    'acc': val_acc,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                }, os.path.join(args.checkpoint_dir, args.experiment, f"{args.model}_{epoch}_{time.time()}.pt"))
+                    logging.info(f"Accuracy increased ({best_acc:.2f} -> {val_acc:.2f}).")
                 best_acc = val_acc
-
+            if saver is not None and saver.save_checkpoint(epoch, val_acc, val_loss):
+                logging.info(f"Saving checkpoint (val acc {val_acc:.2f})...")
+            if tracker is not None and tracker.done:
+                logging.info(f"Stopping: {tracker.stopped_by.replace('_', ' ')} reached after {tracker.elapsed:.1f}s.")
+                break
 
     except KeyboardInterrupt:
         pass
+    finally:
+        if saver is not None:
+            saver.close()
+
+    if resolution.enabled and metrics:
+        gain = annotate_throughput_gain(metrics, resolution.full_size)
+        if gain is not None:
+            logging.info(f"Progressive resizing: {gain['speedup']:.2f}x training throughput, "
+                         f"{gain['time_saved_s']:.1f}s saved over training every epoch at full resolution.")
+        else:
+            logging.info("Progressive resizing: no full-resolution epoch to compare throughput with.")
 
     # Dump loss and accuracy metrics to json
-    if metrics:
+    if metrics and is_primary():
         data_dump = json.dumps(metrics)
         f = open(os.path.join(log_path, f"train_{time.time()}"), "w")
         f.write(data_dump)
         f.close()
+    if tracker is not None and is_primary():
+        record = tracker.result(model=args.model, experiment=args.experiment, device=device.type,
+                                world_size=world_size, batch_size=args.batch_size * world_size,
+                                micro_batch_size=micro_batch_size, amp=args.amp, channels_last=args.channels_last,
+                                resumed_from=args.resume or None)
+        result_file = args.result_file or os.path.join(log_path, f"{args.experiment}_time_to_accuracy.json")
+        with open(result_file, 'w') as f:
+            json.dump(record, f, indent=2)
+        if record['reached']:
+            logging.info(f"Target accuracy {args.target_acc} reached in {record['time_to_target_s']:.1f}s after "
+                         f"{record['images']:,d} images.")
+        else:
+            logging.info(f"Stopped by {record['stopped_by'].replace('_', ' ')} after {record['wall_time_s']:.1f}s and "
+                         f"{record['images']:,d} images, best acc {record['best_acc']}.")
+        logging.info(f"Saved time-to-accuracy result to {result_file}")
+    cleanup()
+
+
+def main():
+    args, args_text = _parse_args()
+    launch(train_worker, nproc_per_node=args.nproc_per_node, nnodes=args.nnodes, node_rank=args.node_rank,
+           master_addr=args.master_addr, master_port=args.master_port, args=(args, args_text))
 
 
 if __name__ == '__main__':
@@ -1,4 +1,11 @@
+from .amp import MixedPrecision
+from .batch_transforms import create_batch_transform
 from .dataloaders import create_loader
-from .optimizer import create_optimizer
+from .datasets import create_dataset, split_train_val
+from .execution import prepare_model, prepare_inputs, is_torchscript, load_model
+from .metrics import MetricAccumulator
+from .mixup import Mixup
+from .optimizer import create_optimizer, param_groups
 from .scheduler import create_scheduler
+from .serving import MicroBatcher
 from .transforms import create_transform
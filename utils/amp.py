@@ -0,0 +1,63 @@
+"""Mixed precision.
+
+Wraps `torch.autocast` and loss scaling behind one object, so training and evaluation loops do not need to know which
+device they run on:
+    * CUDA: float16 autocast with a `GradScaler`, which scales the loss and skips steps with inf/NaN gradients
+    * CPU:  bfloat16 autocast; bfloat16 has the float32 exponent range and needs no loss scaling, but steps with a
+            non-finite loss are still skipped
+
+Typical usage:
+    amp = MixedPrecision(device, enabled=True)
+    with amp.autocast():
+        loss = loss_fn(model(inputs), targets)
+    amp.step(loss, optimizer)
+"""
+
+from typing import Dict, Any
+
+import torch
+
+
+class MixedPrecision:
+    def __init__(self, device: torch.device, enabled: bool = False):
+        self.device_type = device.type
+        self.enabled = enabled
+        self.dtype = torch.float16 if self.device_type == 'cuda' else torch.bfloat16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=enabled and self.device_type == 'cuda')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss: torch.Tensor):
+        if self.scaler.is_enabled():
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def optimizer_step(self, optimizer: torch.optim.Optimizer, loss: torch.Tensor) -> bool:
+        """Optimizer step after `backward`, unscaling gradients if needed.
+
+        Returns:
+            bool: False if the step was skipped on the CPU path because of a non-finite loss. Steps skipped by the
+                `GradScaler` are not reported, as detecting them would synchronize with the device.
+        """
+        if self.scaler.is_enabled():
+            self.scaler.step(optimizer)
+            self.scaler.update()
+            return True
+        if self.enabled and self.device_type == 'cpu' and not torch.isfinite(loss):
+            return False
+        optimizer.step()
+        return True
+
+    def step(self, loss: torch.Tensor, optimizer: torch.optim.Optimizer) -> bool:
+        """Backward pass and optimizer step, with loss scaling if enabled."""
+        self.backward(loss)
+        return self.optimizer_step(optimizer, loss)
+
+    def state_dict(self) -> Dict[str, Any]:
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        if state_dict:
+            self.scaler.load_state_dict(state_dict)
@@ -0,0 +1,239 @@
+"""Batched transforms.
+
+Tensor counterparts of the transforms in `transforms.py`. Rather than running a PIL pipeline on one image at a time,
+each stage operates on a whole minibatch of uint8 images and samples its random parameters per image, so the
+augmentation distribution matches that of the per-sample pipeline.
+
+Default transform compositions:
+    Training:   [ ToFloat -> RandomResizedCrop+Flip -> ColorJitter -> Normalize ]
+    Testing:    [ ToFloat -> Normalize ]
+
+Currently available transforms for training:
+    * RandomHorizontalFlip
+    * RandomVerticalFlip
+    * RandAugment (applied image by image, there is no batched implementation)
+    * ColorJitter
+    * RandomErasing
+
+Typical usage:
+    transform = create_batch_transform(input_size, data_mean, data_std, is_training=True)
+    inputs = transform(uint8_images)
+"""
+
+import math
+from typing import Tuple, List, Callable
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from torchvision import transforms
+
+
+class BatchCompose:
+    """Composes several batched transforms together."""
+
+    def __init__(self, transforms_: List[Callable]):
+        self.transforms = transforms_
+
+    def __call__(self, x: Tensor) -> Tensor:
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+
+class ToFloat:
+    """Converts a uint8 NCHW batch to float in [0, 1]."""
+
+    def __call__(self, x: Tensor) -> Tensor:
+        return x.float().div_(255.)
+
+
+class RandomResizedCropFlip:
+    """Per-image random resized crop and horizontal/vertical flip, sampled in a single `grid_sample` call.
+
+    Crop parameters follow `torchvision.transforms.RandomResizedCrop.get_params` (10 attempts, falling back to the
+    full image), flips are folded into the sampling grid.
+    """
+
+    def __init__(self, size: Tuple[int, int], scale: Tuple[float, float] = (0.08, 1.0),
+                 ratio: Tuple[float, float] = (3. / 4., 4. / 3.), hflip: float = 0.0, vflip: float = 0.0,
+                 crop: bool = True, attempts: int = 10):
+        self.size = tuple(size)
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.hflip = hflip
+        self.vflip = vflip
+        self.crop = crop
+        self.attempts = attempts
+
+    def _crop_params(self, n: int, h: int, w: int, device) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        area = h * w * torch.empty(n, self.attempts, device=device).uniform_(*self.scale)
+        aspect = torch.exp(torch.empty(n, self.attempts, device=device).uniform_(*self.log_ratio))
+        cw = torch.sqrt(area * aspect).round()
+        ch = torch.sqrt(area / aspect).round()
+        valid = (cw > 0) & (cw <= w) & (ch > 0) & (ch <= h)
+        # first valid attempt per image, full image if none is valid
+        first = valid.int().argmax(dim=1, keepdim=True)
+        found = valid.any(dim=1)
+        cw = torch.where(found, cw.gather(1, first).squeeze(1), torch.full_like(found, w, dtype=cw.dtype))
+        ch = torch.where(found, ch.gather(1, first).squeeze(1), torch.full_like(found, h, dtype=ch.dtype))
+        i = torch.floor(torch.rand(n, device=device) * (h - ch + 1))
+        j = torch.floor(torch.rand(n, device=device) * (w - cw + 1))
+        return i, j, ch, cw
+
+    def __call__(self, x: Tensor) -> Tensor:
+        n, c, h, w = x.shape
+        device = x.device
+        flip_h = torch.rand(n, device=device) < self.hflip
+        flip_v = torch.rand(n, device=device) < self.vflip
+
+        if not self.crop and self.size == (h, w):
+            # no resampling needed, flips are plain index reversals
+            if self.hflip > 0.0:
+                x = torch.where(flip_h.view(-1, 1, 1, 1), x.flip(3), x)
+            if self.vflip > 0.0:
+                x = torch.where(flip_v.view(-1, 1, 1, 1), x.flip(2), x)
+            return x
+
+        if self.crop:
+            i, j, ch, cw = self._crop_params(n, h, w, device)
+        else:
+            i = j = torch.zeros(n, device=device)
+            ch, cw = torch.full((n,), float(h), device=device), torch.full((n,), float(w), device=device)
+
+        # Affine map from output grid to crop window in normalized coordinates (align_corners=False)
+        sx = torch.where(flip_h, -cw / w, cw / w)
+        sy = torch.where(flip_v, -ch / h, ch / h)
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:, 0, 0] = sx
+        theta[:, 0, 2] = (2 * j + cw) / w - 1
+        theta[:, 1, 1] = sy
+        theta[:, 1, 2] = (2 * i + ch) / h - 1
+        grid = F.affine_grid(theta, [n, c, *self.size], align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+class RandAugment:
+    """Applies `torchvision.transforms.RandAugment` image by image on the uint8 representation of the batch."""
+
+    def __init__(self, num_ops: int = 2, magnitude: int = 9):
+        self.ra = transforms.RandAugment(num_ops=num_ops, magnitude=magnitude)
+
+    def __call__(self, x: Tensor) -> Tensor:
+        x = x.mul(255.).round_().clamp_(0, 255).to(torch.uint8)
+        x = torch.stack([self.ra(img) for img in x])
+        return x.float().div_(255.)
+
+
+def _grayscale(x: Tensor) -> Tensor:
+    return (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+class ColorJitter:
+    """Per-image brightness, contrast and saturation jitter applied in a per-image random order.
+
+    Matches `torchvision.transforms.ColorJitter(brightness, contrast, saturation)` with hue left unchanged.
+    """
+
+    def __init__(self, brightness: float = 0.0, contrast: float = 0.0, saturation: float = 0.0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    @staticmethod
+    def _factor(n: int, value: float, device) -> Tensor:
+        return torch.empty(n, 1, 1, 1, device=device).uniform_(max(0., 1. - value), 1. + value)
+
+    def __call__(self, x: Tensor) -> Tensor:
+        n = x.shape[0]
+        device = x.device
+        b = self._factor(n, self.brightness, device)
+        c = self._factor(n, self.contrast, device)
+        s = self._factor(n, self.saturation, device)
+        # Random permutation of the three operations for each image
+        order = torch.rand(n, 3, device=device).argsort(dim=1).view(n, 3, 1, 1, 1)
+        for slot in range(3):
+            op = order[:, slot]
+            if self.brightness > 0.0:
+                x = torch.where(op == 0, (b * x).clamp_(0, 1), x)
+            if self.contrast > 0.0:
+                mean = _grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+                x = torch.where(op == 1, (c * x + (1 - c) * mean).clamp_(0, 1), x)
+            if self.saturation > 0.0:
+                x = torch.where(op == 2, (s * x + (1 - s) * _grayscale(x)).clamp_(0, 1), x)
+        return x
+
+
+class Normalize:
+    def __init__(self, mean: Tuple[float, float, float], std: Tuple[float, float, float]):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, x: Tensor) -> Tensor:
+        if self.mean.device != x.device:
+            self.mean, self.std = self.mean.to(x.device), self.std.to(x.device)
+        return (x - self.mean) / self.std
+
+
+class RandomErasing:
+    """Per-image random erasing with value 0, matching `torchvision.transforms.RandomErasing` defaults."""
+
+    def __init__(self, p: float = 0.5, scale: Tuple[float, float] = (0.02, 0.33),
+                 ratio: Tuple[float, float] = (0.3, 3.3), attempts: int = 10):
+        self.p = p
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.attempts = attempts
+
+    def __call__(self, x: Tensor) -> Tensor:
+        n, _, h, w = x.shape
+        device = x.device
+        area = h * w * torch.empty(n, self.attempts, device=device).uniform_(*self.scale)
+        aspect = torch.exp(torch.empty(n, self.attempts, device=device).uniform_(*self.log_ratio))
+        eh = torch.sqrt(area * aspect).round()
+        ew = torch.sqrt(area / aspect).round()
+        valid = (eh < h) & (ew < w)
+        first = valid.int().argmax(dim=1, keepdim=True)
+        eh = eh.gather(1, first).squeeze(1)
+        ew = ew.gather(1, first).squeeze(1)
+        erase = valid.any(dim=1) & (torch.rand(n, device=device) < self.p)
+        i = torch.floor(torch.rand(n, device=device) * (h - eh + 1))
+        j = torch.floor(torch.rand(n, device=device) * (w - ew + 1))
+
+        rows = torch.arange(h, device=device).view(1, h)
+        cols = torch.arange(w, device=device).view(1, w)
+        mask_r = (rows >= i.view(-1, 1)) & (rows < (i + eh).view(-1, 1))
+        mask_c = (cols >= j.view(-1, 1)) & (cols < (j + ew).view(-1, 1))
+        mask = mask_r.view(n, 1, h, 1) & mask_c.view(n, 1, 1, w) & erase.view(n, 1, 1, 1)
+        return x.masked_fill(mask, 0.)
+
+
+def create_batch_transform(input_size, mean: Tuple[float, float, float], std: Tuple[float, float, float],
+                           is_training: bool = False, no_aug: bool = False, hflip: float = 0.5, vflip: float = 0.0,
+                           crop_pct: float = 0.0, rand_aug: bool = False, ra_n: int = 1, ra_m: int = 8,
+                           jitter: float = 0.0, scale: float = 0.9, prob_erase: float = 0.0) -> BatchCompose:
+    """Creates batched transform composition, taking the same arguments as `create_transform`.
+
+     Returns:
+         BatchCompose: a callable mapping a uint8 NCHW batch to a normalized float batch
+    """
+    if isinstance(input_size, (tuple, list)):
+        img_size = tuple(input_size[-2:])
+    else:
+        img_size = (input_size, input_size)
+
+    t = [ToFloat()]
+    if is_training and no_aug:
+        t += [RandomResizedCropFlip(img_size, crop=False)]
+    elif is_training:
+        t += [RandomResizedCropFlip(img_size, scale=(scale, 1.0), ratio=(1.0, 1.0), hflip=hflip, vflip=vflip,
+                                    crop=scale < 1.0)]
+        if rand_aug:
+            t += [RandAugment(num_ops=ra_n, magnitude=ra_m)]
+        if jitter > 0.0:
+            t += [ColorJitter(jitter, jitter, jitter)]
+    t += [Normalize(mean=mean, std=std)]
+    if prob_erase > 0.0:
+        t += [RandomErasing(p=prob_erase)]
+
+    return BatchCompose(t)
@@ -0,0 +1,209 @@
+"""Checkpoint saving.
+
+`CheckpointSaver` keeps the `max_history` best checkpoints by validation metric, the `max_last` most recent end-of-epoch
+checkpoints, so a run can resume from its latest epoch once the metric plateaus, and the `max_recovery` most recent
+recovery checkpoints, which are written every few batches so an interrupted run loses little work. The training state is
+copied to host memory on the calling thread and then serialized and written on a background thread, so the training loop
+only waits for the copy. Files are written to a temporary name and renamed into place, so a checkpoint on disk is always
+complete. With `resume`, existing checkpoints with the same prefix in the directory are picked up, so retention carries
+over across a resumed run; otherwise they are left alone, so runs sharing a directory do not prune each other.
+
+Files are named `<prefix>_best_<epoch>_<metric>.pt`, `<prefix>_last_<epoch>.pt` and
+`<prefix>_recovery_<epoch>_<batch>.pt`. End-of-epoch checkpoints hold their own metric and loss as "acc" and "loss", and
+every checkpoint holds the best metric so far as "best_acc". Besides model, optimizer and loss scaler state, every
+checkpoint holds the LR scheduler state and the torch, CUDA, numpy and python RNG states; recovery checkpoints also hold
+the index of the last trained batch and any extra state passed by the caller, e.g. the sample order of the epoch, so
+training can resume from the next batch.
+
+Typical usage:
+    saver = CheckpointSaver(model, optimizer, amp, checkpoint_dir, prefix='resnet10', max_history=3, resume=False)
+    saver.save_recovery(epoch, batch_idx)  # during an epoch
+    saver.save_checkpoint(epoch, val_acc, val_loss)  # after validation, kept if among the best or most recent
+    saver.close()
+"""
+
+import glob
+import logging
+import os
+import queue
+import random
+import re
+import threading
+from typing import Any, Optional, List, Tuple
+
+import numpy as np
+import torch
+
+from .amp import MixedPrecision
+
+
+def to_cpu(obj: Any) -> Any:
+    """Recursively copies the tensors in a (nested) state dict to host memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state() -> dict:
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def scheduler_state_dict(lr_scheduler) -> Optional[dict]:
+    """Scheduler state without callables (e.g. the annealing function of `OneCycleLR`), which the scheduler sets up
+    from its constructor arguments and which would otherwise pickle the scheduler and optimizer along with them."""
+    if lr_scheduler is None:
+        return None
+    return {k: v for k, v in lr_scheduler.state_dict().items() if not callable(v)}
+
+
+class CheckpointSaver:
+    def __init__(self, model: torch.nn.Module, optimizer: torch.optim.Optimizer, amp: Optional[MixedPrecision],
+                 checkpoint_dir: str, prefix: str = 'checkpoint', max_history: int = 10, max_recovery: int = 1,
+                 lr_scheduler=None, resume: bool = False, max_last: int = 1):
+        self.model = model
+        self.optimizer = optimizer
+        self.amp = amp
+        self.lr_scheduler = lr_scheduler
+        self.checkpoint_dir = checkpoint_dir
+        self.prefix = prefix
+        self.max_history = max_history
+        self.max_recovery = max_recovery
+        self.max_last = max_last
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # (metric, path), best first
+        self.checkpoints: List[Tuple[float, str]] = []
+        # paths, oldest first
+        self.last: List[str] = []
+        self.recovery: List[str] = []
+        if resume:
+            self._scan()
+
+        self._queue = queue.Queue()
+        self._pending_recovery = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _scan(self):
+        best = re.compile(rf"{re.escape(self.prefix)}_best_(\d+)_([0-9.]+)\.pt$")
+        last = re.compile(rf"{re.escape(self.prefix)}_last_(\d+)\.pt$")
+        recovery = re.compile(rf"{re.escape(self.prefix)}_recovery_(\d+)_(\d+)\.pt$")
+        for path in glob.glob(os.path.join(self.checkpoint_dir, f"{self.prefix}_*.pt")):
+            name = os.path.basename(path)
+            if best.match(name):
+                self.checkpoints.append((float(best.match(name).group(2)), path))
+            elif last.match(name):
+                self.last.append(path)
+            elif recovery.match(name):
+                self.recovery.append(path)
+        self.checkpoints.sort(key=lambda c: c[0], reverse=True)
+        self.last.sort(key=lambda p: int(last.search(p).group(1)))
+        self.recovery.sort(key=lambda p: tuple(int(g) for g in recovery.search(p).groups()))
+
+    @property
+    def best_metric(self) -> Optional[float]:
+        return self.checkpoints[0][0] if self.checkpoints else None
+
+    def state_dict(self, epoch: int, **extra) -> dict:
+        """Host copy of the training state."""
+        state = {
+            'epoch': epoch,
+            'acc': None,
+            'best_acc': self.best_metric,
+            'model_state_dict': self.model.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'scaler_state_dict': self.amp.state_dict() if self.amp is not None else None,
+            'scheduler_state_dict': scheduler_state_dict(self.lr_scheduler),
+            'rng_state': rng_state(),
+        }
+        state.update(extra)
+        return to_cpu(state)
+
+    def save_checkpoint(self, epoch: int, metric: float, loss: Optional[float] = None) -> bool:
+        """Queues an end-of-epoch checkpoint as the latest of the `max_last` most recent ones and, if `metric` is among
+        the `max_history` best so far, as a best checkpoint, removing the oldest and worst ones if needed. The state is
+        copied to the host once for both.
+
+        Returns:
+            bool: whether a best checkpoint was queued
+        """
+        is_best = self.max_history > 0 and (len(self.checkpoints) < self.max_history or
+                                            metric > self.checkpoints[-1][0])
+        if not is_best and self.max_last <= 0:
+            return False
+        if is_best:
+            path = os.path.join(self.checkpoint_dir, f"{self.prefix}_best_{epoch:03d}_{metric:.4f}.pt")
+            self.checkpoints = [c for c in self.checkpoints if c[1] != path] + [(metric, path)]
+            self.checkpoints.sort(key=lambda c: c[0], reverse=True)
+        state = self.state_dict(epoch, acc=metric, loss=loss)
+        if is_best:
+            stale = [p for _, p in self.checkpoints[self.max_history:]]
+            self.checkpoints = self.checkpoints[:self.max_history]
+            self._queue.put((state, path, stale, False))
+        if self.max_last > 0:
+            path = os.path.join(self.checkpoint_dir, f"{self.prefix}_last_{epoch:03d}.pt")
+            self.last = [p for p in self.last if p != path] + [path]
+            stale = self.last[:-self.max_last]
+            self.last = self.last[-self.max_last:]
+            self._queue.put((state, path, stale, False))
+        return is_best
+
+    def save_recovery(self, epoch: int, batch_idx: int, **extra) -> bool:
+        """Queues a recovery checkpoint, unless the previous one is still being written.
+
+        Returns:
+            bool: whether a checkpoint was queued
+        """
+        if self.max_recovery <= 0 or self._pending_recovery.is_set():
+            return False
+        path = os.path.join(self.checkpoint_dir, f"{self.prefix}_recovery_{epoch:03d}_{batch_idx:05d}.pt")
+        self.recovery = [p for p in self.recovery if p != path] + [path]
+        stale = self.recovery[:-self.max_recovery]
+        self.recovery = self.recovery[-self.max_recovery:]
+        self._pending_recovery.set()
+        self._queue.put((self.state_dict(epoch, batch_idx=batch_idx, **extra), path, stale, True))
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, path, stale, is_recovery = item
+            try:
+                tmp = f"{path}.tmp"
+                torch.save(state, tmp)
+                os.replace(tmp, path)
+                for p in stale:
+                    if os.path.exists(p):
+                        os.remove(p)
+            except Exception as e:
+                logging.error(f"Failed to write checkpoint {path}: {e}")
+            finally:
+                if is_recovery:
+                    self._pending_recovery.clear()
+                self._queue.task_done()
+
+    def wait(self):
+        """Blocks until all queued checkpoints are written."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,122 @@
+"""Per-layer cost profiling.
+
+Measures, for every leaf module of a model, forward and backward latency with hooks, together with analytic
+multiply-accumulate counts (MACs), parameter counts and the size of the output activation kept for backward.
+
+Backward latency is the time between the gradient with respect to a module's output becoming available and the
+gradient with respect to its input being computed. Where a module's input feeds several branches (e.g. the skip path of
+a residual block), the latter also waits for the other branches, so backward times of such modules are upper bounds.
+In-place activations are disabled while profiling so that tensor hooks see the module's own output.
+
+Typical usage:
+    rows = profile_layers(model, input_size=(3, 32, 32), batch_size=64)
+"""
+
+import time
+from typing import List, Dict, Tuple
+
+import torch
+from torch import nn, Tensor
+
+
+def _sync(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def count_macs(module: nn.Module, inputs: Tuple[Tensor, ...], output: Tensor) -> int:
+    """Analytic multiply-accumulate count of one forward call. Elementwise and pooling ops count one MAC per input or
+    output element."""
+    if isinstance(module, nn.Conv2d):
+        kh, kw = module.kernel_size
+        return output.numel() * (module.in_channels // module.groups) * kh * kw
+    if isinstance(module, nn.Linear):
+        return output.numel() * module.in_features
+    if isinstance(module, (nn.BatchNorm2d, nn.ReLU, nn.GELU)):
+        return output.numel()
+    if isinstance(module, (nn.AdaptiveAvgPool2d, nn.MaxPool2d, nn.AvgPool2d)):
+        return inputs[0].numel()
+    return 0
+
+
+def profile_layers(model: nn.Module, input_size=(3, 32, 32), batch_size: int = 64, reps: int = 10,
+                   device: torch.device = torch.device('cpu')) -> List[Dict]:
+    """Profiles leaf modules over `reps` forward/backward passes on random inputs, after one warmup pass.
+
+    Returns:
+        list: one dict per leaf module in execution order with name, type, output shape, params, MACs, FLOPs,
+            activation memory (bytes) and mean forward/backward latency (ms)
+    """
+    model = model.to(device).train()
+    for m in model.modules():
+        if hasattr(m, 'inplace'):
+            m.inplace = False
+
+    leaves = [(name, m) for name, m in model.named_modules() if not list(m.children())]
+    stats = {name: {'name': name, 'type': type(m).__name__, 'params': sum(p.numel() for p in m.parameters()),
+                    'fwd_s': 0.0, 'bwd_s': 0.0, 'macs': 0, 'act_mem': 0} for name, m in leaves}
+    order = []
+    # 0 during warmup, then the index of the timed repetition
+    current_rep = [0]
+    handles = []
+
+    def pre_hook(name):
+        def hook(module, inputs):
+            state = stats[name]
+            state['_fwd_start'] = time.perf_counter()
+            if current_rep[0] and isinstance(inputs[0], Tensor) and inputs[0].requires_grad:
+                inputs[0].register_hook(lambda grad: state.__setitem__('_bwd_end', time.perf_counter()))
+        return hook
+
+    def fwd_hook(name):
+        def hook(module, inputs, output):
+            _sync(device)
+            state = stats[name]
+            if not current_rep[0]:
+                return
+            state['fwd_s'] += time.perf_counter() - state['_fwd_start']
+            if current_rep[0] == 1:
+                # modules called several times per forward pass (e.g. a shared ReLU) accumulate their costs
+                if name not in order:
+                    order.append(name)
+                    state['output_shape'] = list(output.shape)
+                state['macs'] += count_macs(module, inputs, output)
+                state['act_mem'] += output.numel() * output.element_size()
+            if output.requires_grad:
+                output.register_hook(lambda grad: state.__setitem__('_bwd_start', time.perf_counter()))
+        return hook
+
+    for name, m in leaves:
+        handles.append(m.register_forward_pre_hook(pre_hook(name)))
+        handles.append(m.register_forward_hook(fwd_hook(name)))
+
+    inputs = torch.randn(batch_size, *input_size, device=device)
+    targets = torch.randint(10, (batch_size,), device=device)
+    loss_fn = nn.CrossEntropyLoss()
+    try:
+        for rep in range(reps + 1):
+            current_rep[0] = rep
+            model.zero_grad(set_to_none=True)
+            x = inputs.clone().requires_grad_(True)
+            loss = loss_fn(model(x), targets)
+            loss.backward()
+            _sync(device)
+            if rep:
+                for state in stats.values():
+                    if '_bwd_start' in state and '_bwd_end' in state:
+                        state['bwd_s'] += max(state['_bwd_end'] - state['_bwd_start'], 0.0)
+                    state.pop('_bwd_start', None)
+                    state.pop('_bwd_end', None)
+    finally:
+        for h in handles:
+            h.remove()
+
+    rows = []
+    for name in order:
+        state = stats[name]
+        rows.append({
+            'name': name, 'type': state['type'], 'output_shape': state['output_shape'], 'params': state['params'],
+            'macs': state['macs'], 'flops': 2 * state['macs'], 'act_mem': state['act_mem'],
+            'fwd_ms': 1000 * state['fwd_s'] / reps, 'bwd_ms': 1000 * state['bwd_s'] / reps,
+        })
+    return rows
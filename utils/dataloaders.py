@@ -3,14 +3,39 @@
 For reasons, the PyTorch utility `random_split` returns Subset rather than Dataset. The `Dataset` class below is
 used to "revert" the given Subset into a subclass of Dataset.
 
+Two backends are available:
+    * "pil":    samples are decoded to PIL images and transformed one at a time by a `torch.utils.data.DataLoader`
+    * "tensor": the whole split is held as a single uint8 tensor and the augmentations run on whole minibatches
+
+Either loader can be wrapped in a `PrefetchLoader`, which prepares the next batch and copies it to the target device on
+a background thread while the current batch is being processed.
+
+For distributed training, `num_replicas` and `rank` shard the data across workers. Training shards are shuffled with a
+permutation shared by all workers and padded to equal length, so every worker runs the same number of steps; call
+`set_epoch` before each epoch to reshuffle. Evaluation shards are disjoint and unpadded, so summed metrics cover every
+sample exactly once.
+
+Training loaders are resumable: `loader_state_dict` captures the sample order of the current epoch, and
+`load_loader_state_dict` makes the next epoch replay that order, skipping the batches that were already trained on. A
+`PrefetchLoader` draws the augmentation randomness of later batches ahead of the training loop, so its state also holds
+the RNG states as they were right after producing the last yielded batch.
+
 Typical usage:
     loader = create_loader(dataset, input_size, data_mean, data_std, is_training=True)
 """
 
-from typing import Tuple
+import math
+import queue
+import threading
+from typing import Tuple, Callable, Optional
 
+import numpy as np
 import torch.utils.data
+from torch import Tensor
 
+from .batch_transforms import create_batch_transform
+from .checkpoint_saver import rng_state
+from .mixup import MixupCollate
 from .transforms import create_transform
 
 
@@ -31,20 +56,299 @@ class Dataset(torch.utils.data.Dataset):
         return len(self.subset)
 
 
+def _epoch_order(n: int, shuffle: bool, num_replicas: int = 1, rank: int = 0, seed: int = 0, epoch: int = 0) -> Tensor:
+    """Sample order of one worker for one epoch. Without sharding, shuffling draws from the global torch RNG."""
+    if num_replicas == 1:
+        return torch.randperm(n) if shuffle else torch.arange(n)
+    if not shuffle:
+        return torch.arange(rank, n, num_replicas)
+    # Same permutation on every worker, padded by wrapping around to a multiple of the number of workers
+    generator = torch.Generator().manual_seed(seed + epoch)
+    order = torch.randperm(n, generator=generator)
+    padded = math.ceil(n / num_replicas) * num_replicas
+    order = torch.cat([order, order[:padded - n]])
+    return order[rank::num_replicas]
+
+
+class _Resumable:
+    """Epoch-based sample order that can be captured and replayed from a given batch."""
+
+    def _init_order(self, num_samples: int, batch_size: int, shuffle: bool, num_replicas: int, rank: int, seed: int):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.order = None
+        self._resume = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _next_order(self) -> Tuple[Tensor, int]:
+        order, start = self._resume or (None, 0)
+        self._resume = None
+        if order is None:
+            order = _epoch_order(self.num_samples, self.shuffle, self.num_replicas, self.rank, self.seed, self.epoch)
+        self.order = order
+        return order, start
+
+    def state_dict(self) -> dict:
+        return {'epoch': self.epoch, 'order': self.order}
+
+    def load_state_dict(self, state: dict, skip_batches: int = 0):
+        """Replays `state['order']` in the next epoch, starting after `skip_batches` batches. Sharded orders only
+        depend on the epoch and are regenerated, as a checkpoint holds the order of the primary worker only."""
+        self.epoch = state['epoch']
+        order = state['order'] if self.num_replicas == 1 else None
+        self._resume = (order, skip_batches * self.batch_size)
+
+    def _len(self) -> int:
+        if self.shuffle:
+            return math.ceil(self.num_samples / self.num_replicas)
+        return len(range(self.rank, self.num_samples, self.num_replicas))
+
+
+class EpochSampler(_Resumable, torch.utils.data.Sampler):
+    """Training sampler: shuffled, optionally sharded across workers, and resumable mid-epoch.
+
+    Always reports the full epoch length, also when an epoch is resumed part way.
+    """
+
+    def __init__(self, num_samples: int, batch_size: int, num_replicas: int = 1, rank: int = 0, seed: int = 0):
+        self._init_order(num_samples, batch_size, True, num_replicas, rank, seed)
+
+    def __iter__(self):
+        order, start = self._next_order()
+        return iter(order[start:].tolist())
+
+    def __len__(self):
+        return self._len()
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """Sequential, unpadded shard of `rank` out of `num_replicas` workers, for evaluation."""
+
+    def __init__(self, num_samples: int, num_replicas: int = 1, rank: int = 0):
+        self.indices = range(rank, num_samples, num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class TensorLoader(_Resumable):
+    """Iterable over a uint8 NCHW image tensor, transforming each minibatch as a whole."""
+
+    def __init__(self, images: Tensor, targets: Tensor, batch_size: int = 128, shuffle: bool = False,
+                 transform: Optional[Callable] = None, batch_fn: Optional[Callable] = None, num_replicas: int = 1,
+                 rank: int = 0, seed: int = 0):
+        self.images = images
+        self.targets = targets
+        self.transform = transform
+        self.batch_fn = batch_fn
+        self._init_order(len(images), batch_size, shuffle, num_replicas, rank, seed)
+
+    def __iter__(self):
+        order, first = self._next_order()
+        order = order.to(self.images.device)
+        n = len(order)
+        for start in range(first, n, self.batch_size):
+            idx = order[start:start + self.batch_size]
+            inputs = self.images.index_select(0, idx)
+            targets = self.targets.index_select(0, idx)
+            if self.transform:
+                inputs = self.transform(inputs)
+            if self.batch_fn:
+                inputs, targets = self.batch_fn(inputs, targets)
+            yield inputs, targets
+
+    def __len__(self):
+        return math.ceil(self._len() / self.batch_size)
+
+
+class PrefetchLoader:
+    """Wraps a loader, producing batches on a background thread and moving them to `device` ahead of use.
+
+    Up to `depth` batches are buffered, so with the default of 2 batch N+1 is loaded and copied while batch N is
+    consumed. On CUDA devices, copies are issued on a side stream from pinned memory. If given, `batch_fn` is applied to
+    each batch once it is on the device. `rng_state` holds the RNG states captured after producing the last yielded
+    batch, i.e. those a loader without prefetching would have at that point.
+    """
+
+    _end = object()
+
+    def __init__(self, loader, device: torch.device, depth: int = 2, batch_fn: Optional[Callable] = None):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.batch_fn = batch_fn
+        self.rng_state = None
+
+    def _copy(self, batch, stream):
+        inputs, targets = batch
+        if stream is None:
+            inputs, targets = inputs.to(self.device), targets.to(self.device)
+            if self.batch_fn:
+                inputs, targets = self.batch_fn(inputs, targets)
+            return inputs, targets, None
+        with torch.cuda.stream(stream):
+            inputs = inputs.to(self.device, non_blocking=True)
+            targets = targets.to(self.device, non_blocking=True)
+            if self.batch_fn:
+                inputs, targets = self.batch_fn(inputs, targets)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return inputs, targets, event
+
+    def _produce(self, buffer: queue.Queue, stop: threading.Event):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                item = self._copy(batch, stream) + (rng_state(),)
+                while not stop.is_set():
+                    try:
+                        buffer.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            buffer.put(self._end)
+        except Exception as e:
+            buffer.put(e)
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=max(self.depth - 1, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(buffer, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is self._end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                inputs, targets, event, self.rng_state = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    inputs.record_stream(current)
+                    targets.record_stream(current)
+                yield inputs, targets
+        finally:
+            stop.set()
+
+    def __len__(self):
+        return len(self.loader)
+
+
+def _resumable(loader) -> Optional[_Resumable]:
+    if isinstance(loader, PrefetchLoader):
+        loader = loader.loader
+    if isinstance(loader, TensorLoader):
+        return loader
+    sampler = getattr(loader, 'sampler', None)
+    return sampler if isinstance(sampler, EpochSampler) else None
+
+
+def set_epoch(loader, epoch: int):
+    """Reshuffles the training shard of a distributed loader for `epoch`. No-op for other loaders."""
+    resumable = _resumable(loader)
+    if resumable is not None:
+        resumable.set_epoch(epoch)
+
+
+def loader_state_dict(loader) -> Optional[dict]:
+    """Returns:
+        dict: epoch and sample order of the current epoch of a training loader, and with prefetching the RNG states at
+            the last yielded batch ("rng_state"); None for other loaders
+    """
+    resumable = _resumable(loader)
+    if resumable is None:
+        return None
+    state = resumable.state_dict()
+    if isinstance(loader, PrefetchLoader) and loader.rng_state is not None:
+        state['rng_state'] = loader.rng_state
+    return state
+
+
+def load_loader_state_dict(loader, state: dict, skip_batches: int = 0):
+    """Makes the next epoch of a training loader replay the order in `state`, skipping `skip_batches` batches."""
+    resumable = _resumable(loader)
+    if resumable is None:
+        raise ValueError(f"Loader of type {type(loader).__name__} cannot be resumed")
+    resumable.load_state_dict(state, skip_batches)
+
+
+def _to_tensors(dataset) -> Tuple[Tensor, Tensor]:
+    """Collects a dataset (or subset) of images into a uint8 NCHW tensor and an int64 target tensor."""
+    indices = None
+    if isinstance(dataset, torch.utils.data.Subset):
+        indices = np.asarray(dataset.indices)
+        dataset = dataset.dataset
+    if hasattr(dataset, 'data') and hasattr(dataset, 'targets'):
+        # torchvision.datasets.CIFAR10 keeps the decoded split as a uint8 NHWC array
+        images = np.asarray(dataset.data)
+        targets = np.asarray(dataset.targets)
+        if indices is not None:
+            images, targets = images[indices], targets[indices]
+        images = torch.from_numpy(images).permute(0, 3, 1, 2).contiguous()
+        return images, torch.from_numpy(targets).long()
+    if indices is None:
+        indices = range(len(dataset))
+    samples = [dataset[i] for i in indices]
+    images = torch.stack([torch.from_numpy(np.asarray(x)).permute(2, 0, 1) for x, _ in samples])
+    return images, torch.tensor([y for _, y in samples], dtype=torch.long)
+
+
 def create_loader(dataset, input_size, mean: Tuple[float, float, float], std: Tuple[float, float, float],
                   batch_size: int = 128, is_training: bool = False,
                   no_aug: bool = False, hflip: float = 0.5, vflip: float = 0.0,
                   crop_pct: float = 0.0, rand_aug: bool = False, ra_n: int = 1, ra_m: int = 8, jitter: float = 0.0,
-                  scale: float = 0.9, prob_erase: float = 0.0) -> torch.utils.data.DataLoader:
+                  scale: float = 0.9, prob_erase: float = 0.0, backend: str = 'pil',
+                  device: torch.device = torch.device('cpu'), num_workers: int = 0, persistent_workers: bool = False,
+                  prefetch: bool = False, prefetch_depth: int = 2, batch_fn: Optional[Callable] = None,
+                  num_replicas: int = 1, rank: int = 0):
     """Create dataloader from dataset or data subset.
 
+    Worker processes only apply to the "pil" backend. With `prefetch`, batches are yielded already on `device`.
+    `batch_fn` is a batch-level stage, e.g. `Mixup`, run on `device` when prefetching or the tensor backend is used,
+    and in the collate function otherwise. With `num_replicas` > 1, only the shard of worker `rank` is loaded.
+
     Returns:
         Dataloader: provides an iterable for the dataset with given parameters for augmentation
     """
-    if isinstance(dataset, torch.utils.data.Subset):
-        dataset = Dataset(dataset)
-    dataset.transform = create_transform(input_size=input_size, mean=mean, std=std, is_training=is_training,
-                                         no_aug=no_aug, hflip=hflip, vflip=vflip, crop_pct=crop_pct, rand_aug=rand_aug,
-                                         ra_n=ra_n, ra_m=ra_m, jitter=jitter, scale=scale, prob_erase=prob_erase)
-    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=is_training)
+    transform_args = dict(input_size=input_size, mean=mean, std=std, is_training=is_training, no_aug=no_aug,
+                          hflip=hflip, vflip=vflip, crop_pct=crop_pct, rand_aug=rand_aug, ra_n=ra_n, ra_m=ra_m,
+                          jitter=jitter, scale=scale, prob_erase=prob_erase)
+    if backend == 'tensor':
+        images, targets = _to_tensors(dataset)
+        loader = TensorLoader(images.to(device), targets.to(device), batch_size=batch_size, shuffle=is_training,
+                              transform=create_batch_transform(**transform_args),
+                              batch_fn=None if prefetch else batch_fn, num_replicas=num_replicas, rank=rank)
+    elif backend == 'pil':
+        if isinstance(dataset, torch.utils.data.Subset):
+            dataset = Dataset(dataset)
+        dataset.transform = create_transform(**transform_args)
+        sampler = None
+        if is_training:
+            sampler = EpochSampler(len(dataset), batch_size, num_replicas=num_replicas, rank=rank)
+        elif num_replicas > 1:
+            sampler = ShardSampler(len(dataset), num_replicas=num_replicas, rank=rank)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                             num_workers=num_workers,
+                                             persistent_workers=persistent_workers and num_workers > 0,
+                                             pin_memory=prefetch and device.type == 'cuda',
+                                             collate_fn=MixupCollate(batch_fn) if batch_fn and not prefetch else None)
+    else:
+        raise ValueError(f"Unknown data backend: {backend}")
+
+    if prefetch:
+        loader = PrefetchLoader(loader, device, depth=prefetch_depth, batch_fn=batch_fn)
     return loader
@@ -0,0 +1,120 @@
+"""Datasets.
+
+CIFAR-10 is either read through `torchvision.datasets.CIFAR10`, which unpickles the batch files in every process, or
+from a pre-decoded cache of uint8 NHWC `.npy` arrays that is memory-mapped on access. The cache is written once, on
+first use, and all processes on a host then share the same page-cached copy.
+
+Typical usage:
+    train_data = create_dataset('.data', train=True, cache_dir='.data/cache')
+    train_data, val_data = split_train_val(train_data, val_ratio=0.9)
+"""
+
+import logging
+import os
+from typing import Tuple
+
+import numpy as np
+import torch.utils.data
+import torchvision
+from PIL import Image
+
+# Seed for the train-validation split, fixed so that runs and tools agree on which samples are held out
+SPLIT_SEED = 2766521
+
+
+def _cache_paths(cache_dir: str, train: bool) -> Tuple[str, str]:
+    split = 'train' if train else 'test'
+    return (os.path.join(cache_dir, f"cifar10_{split}_images.npy"),
+            os.path.join(cache_dir, f"cifar10_{split}_labels.npy"))
+
+
+def _save_atomic(path: str, array: np.ndarray):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def prepare_cache(root: str, cache_dir: str, train: bool = True) -> Tuple[str, str]:
+    """Converts a CIFAR-10 split to uint8 NHWC image and int64 label arrays, if not already cached.
+
+    Returns:
+        tuple: paths to the image and label arrays
+    """
+    images_path, labels_path = _cache_paths(cache_dir, train)
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+        logging.info(f"Writing {'train' if train else 'test'} split cache to {cache_dir}...")
+        os.makedirs(cache_dir, exist_ok=True)
+        data = torchvision.datasets.CIFAR10(root, train=train, download=True)
+        _save_atomic(labels_path, np.asarray(data.targets, dtype=np.int64))
+        _save_atomic(images_path, np.ascontiguousarray(data.data, dtype=np.uint8))
+    return images_path, labels_path
+
+
+class MemmapCIFAR10(torch.utils.data.Dataset):
+    """CIFAR-10 split backed by memory-mapped `.npy` arrays.
+
+    Exposes `data` and `targets` like `torchvision.datasets.CIFAR10`. The arrays are opened lazily and are not pickled,
+    so dataloader workers map the same files rather than receiving copies.
+    """
+
+    def __init__(self, images_path: str, labels_path: str, transform=None):
+        self.images_path = images_path
+        self.labels_path = labels_path
+        self.transform = transform
+        self._data = None
+        self._targets = None
+
+    @property
+    def data(self) -> np.ndarray:
+        if self._data is None:
+            self._data = np.load(self.images_path, mmap_mode='r')
+        return self._data
+
+    @property
+    def targets(self) -> np.ndarray:
+        if self._targets is None:
+            self._targets = np.load(self.labels_path, mmap_mode='r')
+        return self._targets
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_targets'] = None
+        return state
+
+    def __getitem__(self, index):
+        x = Image.fromarray(self.data[index])
+        y = int(self.targets[index])
+        if self.transform:
+            x = self.transform(x)
+        return x, y
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def create_dataset(root: str = '.data', train: bool = True, cache_dir: str = ''):
+    """Creates CIFAR-10 dataset, memory-mapped from `cache_dir` if given.
+
+    Returns:
+        Dataset: the requested CIFAR-10 split
+    """
+    if cache_dir:
+        return MemmapCIFAR10(*prepare_cache(root, cache_dir, train=train))
+    return torchvision.datasets.CIFAR10(root, train=train, download=True)
+
+
+def split_train_val(dataset, val_ratio: float = 0.9) -> Tuple[torch.utils.data.Subset, torch.utils.data.Subset]:
+    """Splits dataset into training and validation subsets using the fixed split seed.
+
+    Note that `val_ratio` is the fraction of samples kept for training.
+
+    Returns:
+        tuple: training and validation subsets
+    """
+    n_train = int(len(dataset) * val_ratio)
+    n_val = len(dataset) - n_train
+    # Seed generator so that, if continuing from checkpoint, we do not have data leakage from the validation set
+    return torch.utils.data.random_split(dataset, [n_train, n_val],
+                                         generator=torch.Generator().manual_seed(SPLIT_SEED))
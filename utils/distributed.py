@@ -0,0 +1,109 @@
+"""Multi-process data-parallel training.
+
+Training scripts launch one process per worker with `launch`, either for a single host or, with a shared master
+address, as one of several nodes. Each worker joins the default process group through `init_distributed`; the
+model is then wrapped in `DistributedDataParallel`, the data is sharded by rank (see `create_loader`) and metrics are
+summed across workers (see `MetricAccumulator.all_reduce`). Processes started by `torchrun` are also supported, as it
+sets the same environment variables.
+
+Typical usage:
+    launch(worker_fn, nproc_per_node=4, args=(args,))
+    # in worker_fn(local_rank, args):
+    init_distributed(local_rank, nproc_per_node=4)
+"""
+
+import logging
+import math
+import os
+from typing import Callable
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def launch(fn: Callable, nproc_per_node: int = 1, nnodes: int = 1, node_rank: int = 0,
+           master_addr: str = '127.0.0.1', master_port: int = 29500, args: tuple = ()):
+    """Runs `fn(local_rank, *args)` in `nproc_per_node` processes, or in the current process if there is only one
+    worker in total."""
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    os.environ.setdefault('WORLD_SIZE', str(nproc_per_node * nnodes))
+    os.environ.setdefault('NODE_RANK', str(node_rank))
+    if nproc_per_node == 1:
+        fn(int(os.environ.get('LOCAL_RANK', 0)), *args)
+    else:
+        mp.spawn(fn, args=args, nprocs=nproc_per_node, join=True)
+
+
+def init_distributed(local_rank: int, nproc_per_node: int = 1, backend: str = 'gloo') -> torch.device:
+    """Joins the default process group if there is more than one worker, and pins CUDA workers to a device.
+
+    Returns:
+        device: the device this worker should train on
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if torch.cuda.is_available():
+        device = torch.device('cuda', local_rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+    if world_size > 1:
+        rank = int(os.environ.get('RANK', int(os.environ.get('NODE_RANK', 0)) * nproc_per_node + local_rank))
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+        if rank != 0:
+            logging.getLogger().setLevel(logging.WARNING)
+    return device
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_primary() -> bool:
+    """Only the primary worker writes logs, checkpoints and traces."""
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def min_over_workers(value: int, device: torch.device = torch.device('cpu')) -> int:
+    """Returns the smallest `value` passed by any worker, e.g. to agree on a setting probed on every worker. `device`
+    must be supported by the process group backend."""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.int64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return int(tensor.item())
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def scale_lr(lr: float, world_size: int, rule: str = 'linear') -> float:
+    """Scales a learning rate tuned for the per-worker batch size to the global batch size, `world_size` times larger
+    (or to any batch size a non-integer factor larger).
+
+    Returns:
+        float: `lr` scaled by `world_size` ("linear"), its square root ("sqrt") or unchanged ("none")
+    """
+    if rule == 'linear':
+        return lr * world_size
+    if rule == 'sqrt':
+        return lr * math.sqrt(world_size)
+    if rule == 'none':
+        return lr
+    raise ValueError(f"Unknown learning rate scaling rule: {rule}")
@@ -0,0 +1,117 @@
+"""Model execution modes.
+
+Prepares a model from `model_registry` for execution in channels_last memory format and/or as a compiled graph, used
+by the training, testing and summary scripts. Compilation uses `torch.compile` where the installed torch provides it
+and TorchScript otherwise; if neither succeeds, the eager model is used. `torch.compile` is lazy and only compiles on
+the first call, so a compiled model is run once on a tiny batch before it is returned, which surfaces compile errors
+where the fallback can handle them.
+
+The prepared model shares its parameters with the original, so optimizers and checkpoints should keep referring to the
+original module (`torch.compile` prefixes state dict keys).
+
+Typical usage:
+    fast_model = prepare_model(model, channels_last=True, compile_mode='auto')
+    outputs = fast_model(prepare_inputs(inputs, channels_last=True))
+"""
+
+import logging
+import zipfile
+from typing import Tuple
+
+import torch
+from torch import Tensor
+
+from models import model_registry
+
+COMPILE_MODES = ('none', 'auto', 'compile', 'script')
+
+
+def _trial_forward(model: torch.nn.Module, prepared: torch.nn.Module, input_size: Tuple[int, int, int],
+                   channels_last: bool):
+    """Runs `prepared` on two random images in the current train/eval and grad mode of `model`, restoring buffers such
+    as batch norm statistics afterwards."""
+    param = next(model.parameters(), None)
+    device = param.device if param is not None else torch.device('cpu')
+    buffers = {name: b.detach().clone() for name, b in model.named_buffers()}
+    try:
+        with torch.set_grad_enabled(model.training):
+            prepared(prepare_inputs(torch.randn(2, *input_size, device=device), channels_last))
+    finally:
+        with torch.no_grad():
+            for name, b in model.named_buffers():
+                b.copy_(buffers[name])
+
+
+def _compile(model: torch.nn.Module, input_size: Tuple[int, int, int], channels_last: bool) -> torch.nn.Module:
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError(f"torch.compile is not available in torch {torch.__version__}")
+    compiled = torch.compile(model)
+    _trial_forward(model, compiled, input_size, channels_last)
+    return compiled
+
+
+def _script(model: torch.nn.Module, input_size: Tuple[int, int, int], channels_last: bool) -> torch.nn.Module:
+    return torch.jit.script(model)
+
+
+def prepare_model(model: torch.nn.Module, channels_last: bool = False, compile_mode: str = 'none',
+                  input_size: Tuple[int, int, int] = (3, 32, 32)) -> torch.nn.Module:
+    """Converts model to channels_last and compiles or scripts it.
+
+    `compile_mode` is one of "none", "compile", "script" or "auto" (torch.compile if available, else TorchScript).
+    `input_size` is the CHW size of the trial batch a `torch.compile`d model is run on.
+
+    Returns:
+        Module: the prepared model, or the eager model if compilation is not supported
+    """
+    if compile_mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode: {compile_mode}")
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if compile_mode == 'none':
+        return model
+    if compile_mode == 'auto':
+        compilers = [_compile, _script] if hasattr(torch, 'compile') else [_script]
+    else:
+        compilers = [_compile] if compile_mode == 'compile' else [_script]
+    for compiler in compilers:
+        try:
+            prepared = compiler(model, input_size, channels_last)
+            logging.info(f"Model prepared with {compiler.__name__.strip('_')} (channels_last: {channels_last}).")
+            return prepared
+        except Exception as e:
+            logging.warning(f"Unable to {compiler.__name__.strip('_')} model, falling back: {e}")
+    logging.info(f"Running model eagerly (channels_last: {channels_last}).")
+    return model
+
+
+def prepare_inputs(inputs: Tensor, channels_last: bool = False) -> Tensor:
+    """Converts a batch of images to the memory format expected by a prepared model."""
+    if channels_last:
+        return inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
+
+
+def is_torchscript(path: str) -> bool:
+    """Checks whether a file is a TorchScript archive (as written by `torch.jit.save`) rather than a checkpoint."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as f:
+        return any(name.endswith('constants.pkl') for name in f.namelist())
+
+
+def load_model(model_name: str, checkpoint: str = '', device: torch.device = torch.device('cpu')) -> torch.nn.Module:
+    """Creates a registry model and loads its checkpoint. Models exported by export.py or quantize.py are
+    self-contained TorchScript archives and are loaded as is.
+
+    Returns:
+        Module: the model on `device`
+    """
+    if checkpoint and is_torchscript(checkpoint):
+        return torch.jit.load(checkpoint, map_location=device)
+    model = model_registry[model_name]()
+    if checkpoint:
+        ckpt = torch.load(checkpoint, map_location=device)
+        model.load_state_dict(ckpt['model_state_dict'])
+    return model.to(device)
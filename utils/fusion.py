@@ -0,0 +1,105 @@
+"""Conv-BatchNorm folding for inference.
+
+Traces a model with `torch.fx` and folds every eval-mode BatchNorm2d into an adjacent linear layer:
+    * Conv2d -> BatchNorm2d:    BN is folded into the preceding conv (ResNet, ResNet/S, ResNeXt blocks and stems)
+    * BatchNorm2d -> AdaptiveAvgPool2d -> Flatten -> Linear:    BN is folded into the following classifier, as average
+        pooling commutes with a per-channel affine map (the final BN of ConvMixer)
+
+ConvMixer's other BNs follow a GELU and feed both a zero-padded depthwise conv and a residual addition, so folding them
+forward would change the padded border values and the skip path; they are left in place.
+
+Typical usage:
+    fused, num_folded = fuse_bn(model)
+"""
+
+import copy
+from typing import Tuple, Optional
+
+import torch
+import torch.fx
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def _module(modules, node: torch.fx.Node, cls) -> Optional[nn.Module]:
+    if node.op == 'call_module' and isinstance(modules[node.target], cls):
+        return modules[node.target]
+    return None
+
+
+def _replace_module(gm: torch.fx.GraphModule, modules, target: str, new_module: nn.Module):
+    parent, _, name = target.rpartition('.')
+    setattr(modules[parent] if parent else gm, name, new_module)
+    modules[target] = new_module
+
+
+def _is_flatten(modules, node: torch.fx.Node) -> bool:
+    if _module(modules, node, nn.Flatten) is not None:
+        return True
+    if (node.op == 'call_function' and node.target is torch.flatten) or \
+            (node.op == 'call_method' and node.target == 'flatten'):
+        return node.kwargs.get('start_dim', node.args[1] if len(node.args) > 1 else 0) == 1
+    return False
+
+
+def _single_user(node: torch.fx.Node) -> Optional[torch.fx.Node]:
+    return next(iter(node.users)) if len(node.users) == 1 else None
+
+
+@torch.no_grad()
+def fold_bn_into_linear(bn: nn.BatchNorm2d, linear: nn.Linear) -> nn.Linear:
+    """Folds a BatchNorm2d applied before global average pooling into the following Linear layer."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    fused = copy.deepcopy(linear)
+    fused.weight.copy_(linear.weight * scale.view(1, -1))
+    bias = linear.bias if linear.bias is not None else torch.zeros_like(fused.weight[:, 0])
+    fused.bias = nn.Parameter(bias + linear.weight @ shift)
+    return fused
+
+
+def fuse_bn(model: nn.Module) -> Tuple[torch.fx.GraphModule, int]:
+    """Returns an eval-mode copy of `model` with BatchNorm layers folded into adjacent convs/linears where valid.
+
+    Returns:
+        tuple: fused GraphModule, number of BatchNorm layers folded
+    """
+    model = copy.deepcopy(model).eval()
+    gm = torch.fx.symbolic_trace(model)
+    modules = dict(gm.named_modules())
+    num_folded = 0
+
+    for node in list(gm.graph.nodes):
+        bn = _module(modules, node, nn.BatchNorm2d)
+        if bn is None or not bn.track_running_stats:
+            continue
+        prev = node.args[0]
+        conv = _module(modules, prev, nn.Conv2d)
+        if conv is not None and len(prev.users) == 1:
+            _replace_module(gm, modules, prev.target, fuse_conv_bn_eval(conv, bn))
+            node.replace_all_uses_with(prev)
+            gm.graph.erase_node(node)
+            num_folded += 1
+            continue
+
+        # BN -> global average pool -> flatten -> linear
+        pool = _single_user(node)
+        if pool is None or _module(modules, pool, nn.AdaptiveAvgPool2d) is None or \
+                modules[pool.target].output_size not in (1, (1, 1)):
+            continue
+        flatten = _single_user(pool)
+        if flatten is None or not _is_flatten(modules, flatten):
+            continue
+        fc = _single_user(flatten)
+        linear = _module(modules, fc, nn.Linear) if fc is not None else None
+        if linear is None:
+            continue
+        _replace_module(gm, modules, fc.target, fold_bn_into_linear(bn, linear))
+        node.replace_all_uses_with(prev)
+        gm.graph.erase_node(node)
+        num_folded += 1
+
+    gm.graph.lint()
+    gm.delete_all_unused_submodules()
+    gm.recompile()
+    return gm, num_folded
@@ -0,0 +1,112 @@
+"""Metrics.
+
+Loss and accuracy are accumulated on the device the model runs on and only copied to the host when `compute` is
+called, so that training and evaluation loops do not synchronize with an accelerator on every batch.
+
+Typical usage:
+    meter = MetricAccumulator(device)
+    for inputs, targets in loader:
+        ...
+        meter.update(outputs, targets, loss)
+    meter.all_reduce()  # when training with several workers
+    results = meter.compute()  # {'loss': ..., 'acc': ..., 'count': ...}
+
+`percentile` summarizes host-side timings such as per-request or per-step latencies, `peak_memory_mb` reports the
+memory high-water mark of a device and `activation_memory_mb` the memory held by tensors saved for backward.
+"""
+
+import math
+import resource
+from typing import Dict, Optional, Sequence
+
+import torch
+import torch.distributed as dist
+from torch import Tensor
+
+
+class MetricAccumulator:
+    """Accumulates summed loss, correct predictions and sample count.
+
+    Targets may be class indices or soft labels, in which case the highest weighted class counts as correct.
+    """
+
+    def __init__(self, device: torch.device = torch.device('cpu')):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self._loss_sum = torch.zeros((), device=self.device)
+        self._correct = torch.zeros((), device=self.device)
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, outputs: Tensor, targets: Tensor, loss: Optional[Tensor] = None):
+        """Adds a batch. `loss` is the mean loss over the batch."""
+        n = targets.shape[0]
+        if targets.dim() > 1:
+            targets = targets.argmax(1)
+        self._correct += outputs.argmax(1).eq(targets).sum()
+        if loss is not None:
+            self._loss_sum += loss.detach().float() * n
+        self.count += n
+
+    def all_reduce(self):
+        """Sums the accumulated values over all workers of the default process group, if initialized."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        totals = torch.stack([self._loss_sum, self._correct, torch.tensor(float(self.count), device=self.device)])
+        dist.all_reduce(totals)
+        self._loss_sum, self._correct = totals[0], totals[1]
+        self.count = int(totals[2].item())
+
+    def compute(self) -> Dict[str, float]:
+        """Copies the accumulated values to the host in a single transfer.
+
+        Returns:
+            dict: mean loss, accuracy and number of samples
+        """
+        if self.count == 0:
+            return {'loss': 0.0, 'acc': 0.0, 'count': 0}
+        loss_sum, correct = torch.stack([self._loss_sum, self._correct]).tolist()
+        return {'loss': loss_sum / self.count, 'acc': correct / self.count, 'count': self.count}
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100. * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def reset_peak_memory(device: torch.device):
+    """Resets the CUDA peak memory counter. The CPU high-water mark (max RSS) cannot be reset within a process."""
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    """Returns peak allocated CUDA memory since the last reset, or the peak resident set size of the process on CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def activation_memory_mb(model: torch.nn.Module, inputs: Tensor) -> float:
+    """Runs one forward pass and returns the size of the distinct non-parameter tensors autograd saves for backward.
+
+    Unlike `peak_memory_mb`, this is exact on every device, and reflects savings from activation checkpointing.
+    """
+    param_ptrs = {p.data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(t: Tensor) -> Tensor:
+        if t.data_ptr() not in param_ptrs:
+            saved[t.data_ptr()] = max(saved.get(t.data_ptr(), 0), t.numel() * t.element_size())
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        model(inputs)
+    return sum(saved.values()) / 2 ** 20
@@ -0,0 +1,119 @@
+"""Micro-batching for gradient accumulation.
+
+`find_micro_batch_size` probes the largest micro-batch a model can train on by binary search over a few synthetic
+forward and backward passes, treating an out-of-memory error, or a measured footprint above `budget_mb`, as a
+failure. Out-of-memory errors are only raised reliably on CUDA; on CPU the process is usually killed instead, so a
+memory budget should be given there. It is then measured as the activation memory saved for backward (see
+`activation_memory_mb`).
+
+`accumulation_plan` splits the configured batch size into equal micro-batches that fit, so the optimizer steps on the
+same effective batch size regardless of memory.
+
+Typical usage:
+    micro = find_micro_batch_size(model, loss_fn, (3, 32, 32), max_batch_size=1024, device=device)
+    micro_batch_size, accum_steps = accumulation_plan(1024, micro)
+"""
+
+import logging
+import math
+from typing import Callable, Optional, Tuple
+
+import torch
+from torch import nn
+
+from .amp import MixedPrecision
+from .metrics import activation_memory_mb, peak_memory_mb, reset_peak_memory
+
+
+def is_oom_error(e: Exception) -> bool:
+    """Checks whether an exception is a CUDA or host out-of-memory error."""
+    message = str(e).lower()
+    return isinstance(e, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def _fits(model: nn.Module, loss_fn: Callable, input_size, batch_size: int, device: torch.device,
+          amp: MixedPrecision, channels_last: bool, budget_mb: float, steps: int, num_classes: int) -> bool:
+    inputs = torch.randn(batch_size, *input_size, device=device)
+    if channels_last:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    targets = torch.randint(0, num_classes, (batch_size,), device=device)
+    try:
+        reset_peak_memory(device)
+        if budget_mb > 0 and device.type != 'cuda':
+            with amp.autocast():
+                used_mb = activation_memory_mb(model, inputs)
+            if used_mb > budget_mb:
+                return False
+        for _ in range(steps):
+            with amp.autocast():
+                loss = loss_fn(model(inputs), targets)
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+        if budget_mb > 0 and device.type == 'cuda':
+            return peak_memory_mb(device) <= budget_mb
+        return True
+    except RuntimeError as e:
+        if not is_oom_error(e):
+            raise
+        return False
+    finally:
+        model.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def find_micro_batch_size(model: nn.Module, loss_fn: Callable, input_size=(3, 32, 32), max_batch_size: int = 1024,
+                          device: torch.device = torch.device('cpu'), amp: Optional[MixedPrecision] = None,
+                          channels_last: bool = False, budget_mb: float = 0., steps: int = 2,
+                          num_classes: int = 10) -> int:
+    """Binary search for the largest micro-batch, up to `max_batch_size`, for which `steps` synthetic training steps
+    (forward, loss and backward, without optimizer updates) succeed within `budget_mb`. Batch norm statistics and
+    gradients are restored afterwards.
+
+    Returns:
+        int: the largest micro-batch size found, at least 1
+    """
+    amp = amp or MixedPrecision(device, enabled=False)
+    was_training = model.training
+    buffers = {name: b.detach().clone() for name, b in model.named_buffers()}
+    model.train()
+
+    def fits(size: int) -> bool:
+        return _fits(model, loss_fn, input_size, size, device, amp, channels_last, budget_mb, steps, num_classes)
+
+    # Doubling from the smallest size brackets the limit without attempting huge batches first
+    low, size = 0, 1
+    while size < max_batch_size and fits(size):
+        low, size = size, size * 2
+    high = size - 1
+    if size >= max_batch_size:
+        if fits(max_batch_size):
+            low = high = max_batch_size
+        else:
+            high = max_batch_size - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid - 1
+
+    with torch.no_grad():
+        for name, b in model.named_buffers():
+            b.copy_(buffers[name])
+    model.train(was_training)
+    if low == 0:
+        logging.warning("No micro-batch size fits in memory, using 1.")
+        low = 1
+    return low
+
+
+def accumulation_plan(batch_size: int, max_micro_batch_size: int) -> Tuple[int, int]:
+    """Splits `batch_size` into the fewest equal micro-batches of at most `max_micro_batch_size`. If it does not
+    divide evenly, the effective batch size (micro-batch size x steps) is rounded up by less than the number of steps.
+
+    Returns:
+        tuple: (micro-batch size, accumulation steps)
+    """
+    accum_steps = math.ceil(batch_size / max(1, max_micro_batch_size))
+    return math.ceil(batch_size / accum_steps), accum_steps
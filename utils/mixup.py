@@ -0,0 +1,113 @@
+"""CutMix and MixUp batch augmentations.
+
+Both operate on a whole batch on the batch's device. Every sample draws its own mixing decision, lambda and (for
+CutMix) box in a single vectorized pass, and is mixed with a sample from a random permutation of the batch. Targets are
+returned as soft labels, so the loss is computed with one `CrossEntropyLoss` call on probability targets.
+
+See https://github.com/clovaai/CutMix-PyTorch and https://arxiv.org/abs/1710.09412
+
+Typical usage:
+    mixup_fn = Mixup(cutmix_alpha=1.0, cutmix_prob=0.5, num_classes=10)
+    inputs, targets = mixup_fn(inputs, targets)
+"""
+
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+from torch import Tensor
+
+
+def _sample_beta(alpha: float, n: int, device) -> Tensor:
+    concentration = torch.full((n,), alpha, device=device)
+    return torch.distributions.Beta(concentration, concentration).sample()
+
+
+def rand_bbox_mask(size: torch.Size, lam: Tensor) -> Tuple[Tensor, Tensor]:
+    """Samples one CutMix box per sample, with area ratio of roughly `1 - lam`.
+
+    Returns:
+        tuple: boolean box mask of shape (N, 1, H, W), and lambda adjusted to exactly match the pixel ratio
+    """
+    n, _, h, w = size
+    device = lam.device
+    cut_rat = torch.sqrt(1. - lam)
+    cut_h = (h * cut_rat).floor()
+    cut_w = (w * cut_rat).floor()
+
+    # uniform
+    cy = torch.randint(h, (n,), device=device)
+    cx = torch.randint(w, (n,), device=device)
+
+    y1 = (cy - torch.div(cut_h, 2, rounding_mode='floor')).clamp(0, h)
+    y2 = (cy + torch.div(cut_h, 2, rounding_mode='floor')).clamp(0, h)
+    x1 = (cx - torch.div(cut_w, 2, rounding_mode='floor')).clamp(0, w)
+    x2 = (cx + torch.div(cut_w, 2, rounding_mode='floor')).clamp(0, w)
+
+    rows = torch.arange(h, device=device).view(1, h)
+    cols = torch.arange(w, device=device).view(1, w)
+    mask_r = (rows >= y1.view(-1, 1)) & (rows < y2.view(-1, 1))
+    mask_c = (cols >= x1.view(-1, 1)) & (cols < x2.view(-1, 1))
+    mask = mask_r.view(n, 1, h, 1) & mask_c.view(n, 1, 1, w)
+
+    lam = 1. - (y2 - y1) * (x2 - x1) / (h * w)
+    return mask, lam
+
+
+class Mixup:
+    """Per-sample CutMix/MixUp.
+
+    Each sample is cut-mixed with probability `cutmix_prob` and otherwise mixed-up with probability `mixup_prob`; a
+    mode is only used if its alpha is positive.
+    """
+
+    def __init__(self, cutmix_alpha: float = 0.0, cutmix_prob: float = 0.0, mixup_alpha: float = 0.0,
+                 mixup_prob: float = 0.0, num_classes: int = 10):
+        self.cutmix_alpha = cutmix_alpha
+        self.cutmix_prob = cutmix_prob if cutmix_alpha > 0.0 else 0.0
+        self.mixup_alpha = mixup_alpha
+        self.mixup_prob = mixup_prob if mixup_alpha > 0.0 else 0.0
+        self.num_classes = num_classes
+
+    @property
+    def enabled(self) -> bool:
+        return self.cutmix_prob > 0.0 or self.mixup_prob > 0.0
+
+    def __call__(self, inputs: Tensor, targets: Tensor) -> Tuple[Tensor, Tensor]:
+        n = inputs.shape[0]
+        device = inputs.device
+        r = torch.rand(n, device=device)
+        use_cutmix = r < self.cutmix_prob
+        use_mixup = ~use_cutmix & (r < self.cutmix_prob + self.mixup_prob)
+
+        perm = torch.randperm(n, device=device)
+        shuffled = inputs[perm]
+        lam = torch.ones(n, device=device)
+        mixed = inputs
+        if self.cutmix_prob > 0.0:
+            mask, lam_cutmix = rand_bbox_mask(inputs.shape, _sample_beta(self.cutmix_alpha, n, device))
+            mask &= use_cutmix.view(-1, 1, 1, 1)
+            mixed = torch.where(mask, shuffled, mixed)
+            lam = torch.where(use_cutmix, lam_cutmix.to(lam.dtype), lam)
+        if self.mixup_prob > 0.0:
+            lam_mixup = _sample_beta(self.mixup_alpha, n, device)
+            lam = torch.where(use_mixup, lam_mixup, lam)
+            weight = torch.where(use_mixup, lam_mixup, torch.ones_like(lam_mixup)).view(-1, 1, 1, 1).to(inputs.dtype)
+            mixed = weight * mixed + (1. - weight) * shuffled
+
+        lam = lam.view(-1, 1)
+        soft_targets = F.one_hot(targets, self.num_classes).to(lam.dtype)
+        soft_targets = lam * soft_targets + (1. - lam) * soft_targets[perm]
+        return mixed, soft_targets
+
+
+class MixupCollate:
+    """Collate function applying a batch augmentation after default collation, for use in a DataLoader."""
+
+    def __init__(self, batch_fn):
+        self.batch_fn = batch_fn
+
+    def __call__(self, batch):
+        inputs, targets = torch.utils.data.default_collate(batch)
+        return self.batch_fn(inputs, targets)
@@ -1,27 +1,208 @@
 """Optimizers.
 
 Currently available optimizers:
-    * SGD
+    * SGD (with momentum)
     * Adam
     * AdamW
+    * LARS, layer-wise adaptive SGD for large batches
+    * LAMB, layer-wise adaptive AdamW for large batches
+
+Parameter updates use the multi-tensor implementations ("foreach", or "fused" kernels where torch provides them for the
+optimizer), which update all parameters of a group in a few kernel launches rather than a few per parameter. LARS and
+LAMB are implemented here with the same `torch._foreach_*` ops.
+
+`param_groups` splits a model's parameters so that weight decay is not applied to norm layer weights and biases.
+
+Typical usage:
+    optimizer = create_optimizer(param_groups(model, weight_decay=5e-5), opt_name='lamb', lr=0.01)
 """
 
+import inspect
+import logging
+from typing import Iterable, List, Optional, Tuple
+
 import torch
+from torch import nn, Tensor
+
+OPTIMIZERS = ('sgd', 'adam', 'adamw', 'lars', 'lamb')
+OPTIMIZER_IMPLS = ('auto', 'foreach', 'fused', 'for_loop')
+
+
+def param_groups(model: nn.Module, weight_decay: float = 0.0, decay_norm_bias: bool = False) -> List[dict]:
+    """Splits trainable parameters into a decayed group and a group of one-dimensional parameters (norm layer weights
+    and biases) without weight decay, or LARS/LAMB trust ratio adaptation. The split does not depend on `weight_decay`,
+    so the trust ratio is applied to the same parameters whether or not weight decay is zero.
+
+    Returns:
+        list: parameter groups, a single group with `weight_decay` if `decay_norm_bias`
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    if decay_norm_bias:
+        return [{'params': params, 'weight_decay': weight_decay}]
+    decay = [p for p in params if p.ndim > 1]
+    no_decay = [p for p in params if p.ndim <= 1]
+    return [{'params': decay, 'weight_decay': weight_decay},
+            {'params': no_decay, 'weight_decay': 0.0, 'trust_ratio': False}]
+
+
+def _norms(tensors: List[Tensor]) -> Tensor:
+    if hasattr(torch, '_foreach_norm'):
+        return torch.stack(torch._foreach_norm(tensors))
+    return torch.stack([t.norm() for t in tensors])
+
+
+def _trust_ratios(param_norms: Tensor, update_norms: Tensor, coefficient: float = 1.0) -> List[Tensor]:
+    """Per-parameter `coefficient * ||w|| / ||update||`, or 1 where either norm is zero."""
+    ratios = torch.where((param_norms > 0) & (update_norms > 0), coefficient * param_norms / update_norms,
+                         torch.ones_like(param_norms))
+    return list(ratios.unbind())
+
 
+class Lars(torch.optim.Optimizer):
+    """SGD with momentum and layer-wise adaptive rate scaling (You et al., 2017): the update of every parameter
+    tensor is scaled by `trust_coefficient * ||w|| / (||g|| + weight_decay * ||w||)`."""
 
-def create_optimizer(params, opt_name: str = "sgd", lr: float = 0.01, weight_decay: float = 0.0,
-                     eps: float = 0.0) -> torch.optim.Optimizer:
+    def __init__(self, params, lr: float = 0.1, momentum: float = 0.9, weight_decay: float = 0.0,
+                 trust_coefficient: float = 0.001, eps: float = 1e-8, nesterov: bool = False):
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay, trust_coefficient=trust_coefficient,
+                        eps=eps, nesterov=nesterov, trust_ratio=True)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            if group['trust_ratio']:
+                param_norms, grad_norms = _norms(params), _norms(grads)
+                ratios = _trust_ratios(param_norms, grad_norms + group['weight_decay'] * param_norms + group['eps'],
+                                       group['trust_coefficient'])
+            if group['weight_decay'] != 0:
+                grads = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+            if group['trust_ratio']:
+                grads = torch._foreach_mul(grads, ratios)
+
+            if group['momentum'] != 0:
+                bufs = []
+                for p, g in zip(params, grads):
+                    state = self.state[p]
+                    if 'momentum_buffer' not in state:
+                        state['momentum_buffer'] = torch.clone(g).detach()
+                    else:
+                        state['momentum_buffer'].mul_(group['momentum']).add_(g)
+                    bufs.append(state['momentum_buffer'])
+                if group['nesterov']:
+                    grads = torch._foreach_add(grads, bufs, alpha=group['momentum'])
+                else:
+                    grads = bufs
+            torch._foreach_add_(params, grads, alpha=-group['lr'])
+        return loss
+
+
+class Lamb(torch.optim.Optimizer):
+    """AdamW with layer-wise adaptive moments (You et al., 2019): the Adam update of every parameter tensor, including
+    decoupled weight decay, is scaled by `||w|| / ||update||`."""
+
+    def __init__(self, params, lr: float = 1e-3, betas: Tuple[float, float] = (0.9, 0.999), eps: float = 1e-6,
+                 weight_decay: float = 0.0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, trust_ratio=True)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            beta1, beta2 = group['betas']
+            grads = [p.grad for p in params]
+            for p in params:
+                state = self.state[p]
+                if not state:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                    state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                state['step'] += 1
+            exp_avgs = [self.state[p]['exp_avg'] for p in params]
+            exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+            # Parameters of a group are created and stepped together, so they share the step count
+            step = self.state[params[0]]['step']
+
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+            bias_correction1 = 1 - beta1 ** step
+            bias_correction2 = 1 - beta2 ** step
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_div_(denom, bias_correction2 ** 0.5)
+            torch._foreach_add_(denom, group['eps'])
+            updates = torch._foreach_div(exp_avgs, denom)
+            torch._foreach_div_(updates, bias_correction1)
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(updates, params, alpha=group['weight_decay'])
+            if group['trust_ratio']:
+                torch._foreach_mul_(updates, _trust_ratios(_norms(params), _norms(updates)))
+            torch._foreach_add_(params, updates, alpha=-group['lr'])
+        return loss
+
+
+def _impl_kwargs(optimizer_cls, impl: str, device_type: str) -> dict:
+    """Selects the multi-tensor implementation of a torch optimizer, if its signature in the installed torch offers
+    it. "auto" uses fused kernels on CUDA where available and foreach otherwise."""
+    supported = inspect.signature(optimizer_cls).parameters
+    if impl == 'auto':
+        impl = 'fused' if device_type == 'cuda' and 'fused' in supported else 'foreach'
+    if impl == 'for_loop':
+        return {'foreach': False} if 'foreach' in supported else {}
+    if impl in supported:
+        return {impl: True}
+    fallback = 'foreach' if 'foreach' in supported else 'for_loop'
+    logging.warning(f"{optimizer_cls.__name__} has no {impl} implementation in torch {torch.__version__}, "
+                    f"using {fallback}.")
+    return {'foreach': True} if fallback == 'foreach' else {}
+
+
+def create_optimizer(params: Iterable, opt_name: str = "sgd", lr: float = 0.01, weight_decay: float = 0.0,
+                     eps: Optional[float] = None, momentum: float = 0.9, impl: str = 'auto',
+                     device_type: str = 'cpu') -> torch.optim.Optimizer:
     """Creates optimizer.
 
+    `params` may be an iterable of parameters or of parameter groups (see `param_groups`); `weight_decay` applies to
+    groups that do not set their own. `eps` of None keeps the optimizer's default. `impl` selects the "foreach",
+    "fused" or "for_loop" implementation of the torch optimizers; "auto" picks the fastest available on `device_type`.
+
     Returns:
          Optimizer: a learning optimizer, subclassing torch.optim.Optimizer
     """
+    if impl not in OPTIMIZER_IMPLS:
+        raise ValueError(f"Unknown optimizer implementation: {impl}")
+    eps_kwargs = {'eps': eps} if eps is not None else {}
     optimizer = None
     if opt_name == "sgd":
-        optimizer = torch.optim.SGD(params=params, lr=lr, weight_decay=weight_decay)
+        optimizer = torch.optim.SGD(params=params, lr=lr, momentum=momentum, weight_decay=weight_decay,
+                                    **_impl_kwargs(torch.optim.SGD, impl, device_type))
     elif opt_name == "adam":
-        optimizer = torch.optim.Adam(params=params, lr=lr, eps=eps,
-                                     weight_decay=weight_decay)
+        optimizer = torch.optim.Adam(params=params, lr=lr, weight_decay=weight_decay, **eps_kwargs,
+                                     **_impl_kwargs(torch.optim.Adam, impl, device_type))
     elif opt_name == "adamw":
-        optimizer = torch.optim.AdamW(params=params, lr=lr, weight_decay=weight_decay)
+        optimizer = torch.optim.AdamW(params=params, lr=lr, weight_decay=weight_decay, **eps_kwargs,
+                                      **_impl_kwargs(torch.optim.AdamW, impl, device_type))
+    elif opt_name == "lars":
+        optimizer = Lars(params=params, lr=lr, momentum=momentum, weight_decay=weight_decay, **eps_kwargs)
+    elif opt_name == "lamb":
+        optimizer = Lamb(params=params, lr=lr, weight_decay=weight_decay, **eps_kwargs)
     return optimizer
@@ -0,0 +1,79 @@
+"""Per-sample evaluation outputs.
+
+`PredictionWriter` streams the logits, predicted classes and true labels of every evaluated sample into preallocated,
+memory-mappable `.npy` files, one batch at a time, so memory use stays flat on large evaluation sets. A small JSON
+summary is written alongside on `close`. The arrays can be opened without loading them into memory:
+
+    logits = np.load('<out_dir>/logits.npy', mmap_mode='r')  # (N, num_classes), float16 or float32
+    labels = np.load('<out_dir>/labels.npy', mmap_mode='r')  # (N,), int16
+
+Typical usage:
+    writer = PredictionWriter(out_dir, num_samples=len(dataset), num_classes=10)
+    for inputs, targets in loader:
+        writer.write(model(inputs), targets)
+    writer.close(summary={'acc': ...})
+"""
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+
+LOGITS_DTYPES = ('float16', 'float32')
+
+
+class PredictionWriter:
+    def __init__(self, out_dir: str, num_samples: int, num_classes: int = 10, logits_dtype: str = 'float16'):
+        if logits_dtype not in LOGITS_DTYPES:
+            raise ValueError(f"Unknown logits dtype: {logits_dtype}")
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.num_samples = num_samples
+        self.logits_dtype = logits_dtype
+        open_memmap = np.lib.format.open_memmap
+        self.logits = open_memmap(os.path.join(out_dir, 'logits.npy'), mode='w+', dtype=logits_dtype,
+                                  shape=(num_samples, num_classes))
+        self.predictions = open_memmap(os.path.join(out_dir, 'predictions.npy'), mode='w+', dtype=np.int16,
+                                       shape=(num_samples,))
+        self.labels = open_memmap(os.path.join(out_dir, 'labels.npy'), mode='w+', dtype=np.int16,
+                                  shape=(num_samples,))
+        self.count = 0
+
+    @torch.no_grad()
+    def write(self, outputs: Tensor, targets: Tensor):
+        """Appends a batch of logits and class index (or soft) targets."""
+        n = outputs.shape[0]
+        if self.count + n > self.num_samples:
+            raise ValueError(f"More than the {self.num_samples} expected samples written")
+        if targets.dim() > 1:
+            targets = targets.argmax(1)
+        end = self.count + n
+        self.logits[self.count:end] = outputs.float().cpu().numpy()
+        self.predictions[self.count:end] = outputs.argmax(1).cpu().numpy()
+        self.labels[self.count:end] = targets.cpu().numpy()
+        self.count = end
+
+    def close(self, summary: Optional[dict] = None) -> str:
+        """Flushes the arrays and writes `summary.json` with the given fields, array shapes and dtypes.
+
+        Returns:
+            str: path of the summary
+        """
+        for array in (self.logits, self.predictions, self.labels):
+            array.flush()
+        summary = dict(summary or {})
+        summary.update({
+            'num_samples': self.count,
+            'arrays': {name: {'file': f"{name}.npy", 'shape': list(array.shape), 'dtype': str(array.dtype)}
+                       for name, array in (('logits', self.logits), ('predictions', self.predictions),
+                                           ('labels', self.labels))},
+        })
+        if self.count != self.num_samples:
+            summary['incomplete'] = True
+        path = os.path.join(self.out_dir, 'summary.json')
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return path
@@ -0,0 +1,71 @@
+"""Step profiling.
+
+`PhaseTimer` always records cheap wall-clock timers for the phases of a training step (data wait, host-to-device copy,
+forward, backward, optimizer and scheduler). By default it does not synchronize with the device, so on an accelerator
+asynchronous work is attributed to the phase that next waits on it; with `sync=True` each phase is synchronized for
+exact attribution at some cost in throughput.
+
+`create_profiler` wraps a window of steps in `torch.profiler`, exporting Chrome/TensorBoard traces.
+
+Typical usage:
+    timer = PhaseTimer(device)
+    with timer.phase('forward'):
+        outputs = model(inputs)
+    timer.summary()  # {'forward': {'total_s': ..., 'ms_per_step': ...}, ...}
+"""
+
+import contextlib
+import os
+import time
+from typing import Dict
+
+import torch
+
+PHASES = ('data_wait', 'h2d', 'forward', 'backward', 'optimizer', 'scheduler')
+
+
+class PhaseTimer:
+    def __init__(self, device: torch.device = torch.device('cpu'), sync: bool = False):
+        self.sync = sync and device.type == 'cuda'
+        self.device = device
+        self.totals = {name: 0.0 for name in PHASES}
+        self.steps = 0
+
+    def add(self, name: str, seconds: float):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.add(name, time.perf_counter() - start)
+
+    def step(self):
+        self.steps += 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Returns:
+            dict: total seconds and milliseconds per step for each phase
+        """
+        return {name: {'total_s': total, 'ms_per_step': 1000 * total / max(self.steps, 1)}
+                for name, total in self.totals.items()}
+
+
+def create_profiler(trace_dir: str, wait: int = 1, warmup: int = 1, active: int = 5,
+                    device: torch.device = torch.device('cpu')) -> torch.profiler.profile:
+    """Creates a `torch.profiler.profile` that skips `wait` steps, warms up for `warmup` steps and records `active`
+    steps, writing the trace to `trace_dir`. Call `step()` on it after every training step.
+
+    Returns:
+        profile: the profiler, to be used as a context manager
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                                  record_shapes=True, profile_memory=True)
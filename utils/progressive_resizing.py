@@ -0,0 +1,99 @@
+"""Progressive resizing.
+
+`ResolutionSchedule` trains early epochs at reduced resolution and ramps up to the full input size, e.g. 16 -> 24 -> 32,
+given as "SIZE:START_EPOCH" stages. The cost of a training step scales roughly with the number of pixels, so with
+`batch_scaling='area'` the batch size of a stage is scaled by (full size / size)^2, keeping the memory per batch about
+constant, and its learning rate is scaled with the batch size by `lr_rule` (see `scale_lr`). The training loader is
+rebuilt at each stage so the crop in `create_transform` / `create_batch_transform` emits the scheduled size; validation
+stays at full resolution.
+
+Typical usage:
+    schedule = ResolutionSchedule(parse_resolution_stages(['16:0', '24:10', '32:20']), full_size=32, batch_size=512)
+    schedule.size(epoch), schedule.batch_size(epoch), schedule.lr_scale(epoch)
+
+After training, `annotate_throughput_gain` compares the training throughput of the reduced-resolution epochs with that
+of the full-resolution epochs.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .distributed import scale_lr
+
+BATCH_SCALING = ('none', 'area')
+
+
+def parse_resolution_stages(specs: Sequence[str]) -> List[Tuple[int, int]]:
+    """Parses "SIZE:START_EPOCH" stages.
+
+    Returns:
+        list: (size, start epoch) per stage, by start epoch
+    """
+    stages = []
+    for spec in specs:
+        size, sep, start = str(spec).partition(':')
+        if not sep:
+            raise ValueError(f"Resolution stages must be SIZE:START_EPOCH, got {spec}")
+        stages.append((int(size), int(start)))
+    return sorted(stages, key=lambda s: s[1])
+
+
+class ResolutionSchedule:
+    def __init__(self, stages: Sequence[Tuple[int, int]] = (), full_size: int = 32, batch_size: int = 512,
+                 batch_scaling: str = 'area', lr_rule: str = 'linear'):
+        if batch_scaling not in BATCH_SCALING:
+            raise ValueError(f"Unknown batch scaling: {batch_scaling}")
+        self.stages = list(stages) or [(full_size, 0)]
+        if self.stages[0][1] != 0:
+            raise ValueError("The first resolution stage must start at epoch 0")
+        if any(size <= 0 or size > full_size for size, _ in self.stages):
+            raise ValueError(f"Resolution stages must be between 1 and the input size {full_size}")
+        self.full_size = full_size
+        self.base_batch_size = batch_size
+        self.batch_scaling = batch_scaling
+        self.lr_rule = lr_rule
+
+    @property
+    def enabled(self) -> bool:
+        return any(size != self.full_size for size, _ in self.stages)
+
+    def stage(self, epoch: int) -> int:
+        """Index of the stage `epoch` belongs to."""
+        return max(i for i, (_, start) in enumerate(self.stages) if start <= epoch)
+
+    def size(self, epoch: int) -> int:
+        return self.stages[self.stage(epoch)][0]
+
+    def area_ratio(self, epoch: int) -> float:
+        """Pixels per full-resolution image over pixels per image of the stage."""
+        return (self.full_size / self.size(epoch)) ** 2
+
+    def batch_size(self, epoch: int) -> int:
+        if self.batch_scaling == 'area':
+            return int(self.base_batch_size * self.area_ratio(epoch))
+        return self.base_batch_size
+
+    def lr_scale(self, epoch: int) -> float:
+        """Learning rate multiplier of the stage, for its batch size relative to the configured one."""
+        return scale_lr(1.0, self.batch_size(epoch) / self.base_batch_size, self.lr_rule)
+
+
+def annotate_throughput_gain(metrics: Dict[int, dict], full_size: int = 32) -> Optional[dict]:
+    """Adds the training throughput of every epoch relative to full-resolution epochs ("resize_speedup") and the
+    cumulative training time saved ("resize_time_saved_s") to per-epoch metrics with "resolution", "images_per_sec"
+    and "t_train" entries.
+
+    Returns:
+        dict: overall speedup and time saved, or None if no epoch ran at full resolution
+    """
+    full = [m['images_per_sec'] for m in metrics.values() if m['resolution'] == full_size]
+    if not full:
+        return None
+    full_ips = sum(full) / len(full)
+    saved = 0.0
+    for epoch in sorted(metrics):
+        m = metrics[epoch]
+        m['resize_speedup'] = m['images_per_sec'] / full_ips
+        saved += m['t_train'] * (m['resize_speedup'] - 1)
+        m['resize_time_saved_s'] = saved
+    t_train = sum(m['t_train'] for m in metrics.values())
+    return {'speedup': (t_train + saved) / t_train, 'time_saved_s': saved, 'full_images_per_sec': full_ips}
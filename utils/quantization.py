@@ -0,0 +1,56 @@
+"""Post-training static int8 quantization.
+
+Uses FX graph mode quantization: the model is traced, Conv-BN(-ReLU) patterns are fused, observers are inserted and
+calibrated on held-out data, and the result is converted to a model with quantize/dequantize nodes at the int8
+boundaries. Residual additions are quantized as part of the graph, and ops without an int8 kernel (e.g. ConvMixer's
+GELU, depending on the torch version) run in float between dequantize/quantize nodes.
+
+Typical usage:
+    model = prepare_quantization(model, example_inputs)
+    calibrate(model, loader)
+    model = convert_quantization(model)
+"""
+
+import copy
+import logging
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def _explicit_padding(model: nn.Module) -> nn.Module:
+    """Replaces `padding="same"` on odd-sized, stride 1 convolutions with the equivalent integer padding, which the
+    quantized conv modules require."""
+    for m in model.modules():
+        if isinstance(m, nn.Conv2d) and m.padding == 'same':
+            if any(k % 2 == 0 for k in m.kernel_size) or any(d != 1 for d in m.dilation):
+                raise ValueError(f"Cannot convert padding='same' for kernel size {m.kernel_size}")
+            m.padding = tuple(k // 2 for k in m.kernel_size)
+    return model
+
+
+def prepare_quantization(model: nn.Module, example_inputs: torch.Tensor, backend: str = 'fbgemm') -> nn.Module:
+    """Returns a fused copy of `model` with observers inserted, ready for calibration."""
+    torch.backends.quantized.engine = backend
+    model = _explicit_padding(copy.deepcopy(model).cpu().eval())
+    return prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(example_inputs,))
+
+
+@torch.no_grad()
+def calibrate(model: nn.Module, loader, num_batches: int = 0):
+    """Runs batches (all batches if `num_batches` is 0) through an observed model to collect activation ranges."""
+    model.eval()
+    seen = 0
+    for inputs, _ in loader:
+        if num_batches and seen >= num_batches:
+            break
+        model(inputs.cpu())
+        seen += 1
+    logging.info(f"Calibrated on {seen} batches.")
+
+
+def convert_quantization(model: nn.Module) -> nn.Module:
+    """Converts a calibrated model to int8."""
+    return convert_fx(model)
@@ -4,14 +4,29 @@ Currently available schedulers:
     * CosineAnnealingWarmRestarts
     * ReduceLROnPlateau
     * OneCycleLR
+
+Per-step schedulers are stepped once per optimizer step. With gradient accumulation, an optimizer step spans
+`accum_steps` loader batches.
 """
 
+import math
+from typing import Optional
+
 import torch.optim
 
 
+def optimizer_steps_per_epoch(num_batches: int, accum_steps: int = 1) -> int:
+    """Number of optimizer steps in an epoch of `num_batches` loader batches, counting a shorter final accumulation."""
+    return math.ceil(num_batches / max(1, accum_steps))
+
+
 def create_scheduler(optimizer: torch.optim.Optimizer, lr: float, sched: str = 'cosine_warm', num_epochs: int = 300,
                      steps_per_epoch: int = 10, min_lr: float = 0.0, T_0: int = 200, T_mult: int = 1,
-                     plateau_mode: str = 'min', patience: int = 10):
+                     plateau_mode: str = 'min', patience: int = 10, accum_steps: int = 1,
+                     total_steps: Optional[int] = None):
+    """Creates scheduler. `steps_per_epoch` is the number of loader batches per epoch, of which every `accum_steps`
+    make up one optimizer step. If epochs differ in length, pass the total number of optimizer steps as
+    `total_steps`."""
     lr_scheduler = None
     if sched == 'cosine_warm':
         lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(optimizer=optimizer,
@@ -23,6 +38,21 @@ def create_scheduler(optimizer: torch.optim.Optimizer, lr: float, sched: str = '
                                                                   patience=patience)
     elif sched == 'onecycle':
         # lr_scheduler = oneCycleLR(num_epochs, lr)
-        lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer=optimizer, max_lr=lr, epochs=num_epochs,
-                                                           steps_per_epoch=steps_per_epoch)
+        lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
+            optimizer=optimizer, max_lr=lr, epochs=num_epochs,
+            steps_per_epoch=optimizer_steps_per_epoch(steps_per_epoch, accum_steps), total_steps=total_steps)
     return lr_scheduler
+
+
+def rescale_lr(lr_scheduler, optimizer: torch.optim.Optimizer, factor: float):
+    """Multiplies the current learning rate and the rest of the schedule by `factor`."""
+    if factor == 1.0:
+        return
+    for group in optimizer.param_groups:
+        group['lr'] *= factor
+        # OneCycleLR keeps its schedule in the parameter groups
+        for key in ('initial_lr', 'max_lr', 'min_lr'):
+            if key in group:
+                group[key] *= factor
+    if hasattr(lr_scheduler, 'base_lrs'):
+        lr_scheduler.base_lrs = [lr * factor for lr in lr_scheduler.base_lrs]
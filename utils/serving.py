@@ -0,0 +1,102 @@
+"""Dynamic micro-batching for inference.
+
+`MicroBatcher` accepts single preprocessed images from any number of threads and runs them through the model on a
+dedicated worker thread, coalescing requests that arrive within `max_delay` seconds of the first waiting request into
+one batch of at most `max_batch_size` images. With `channels_last`, batches are converted to the memory format of a
+model prepared with `prepare_model(..., channels_last=True)`.
+
+Typical usage:
+    batcher = MicroBatcher(model, device, max_batch_size=32, max_delay=0.005)
+    probs = batcher.submit(image_tensor).result()
+"""
+
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict
+
+import torch
+from torch import Tensor
+
+from .execution import prepare_inputs
+from .metrics import percentile
+
+
+class MicroBatcher:
+    def __init__(self, model: torch.nn.Module, device: torch.device, max_batch_size: int = 32,
+                 max_delay: float = 0.005, history: int = 10000, channels_last: bool = False):
+        self.model = model
+        self.device = device
+        self.channels_last = channels_last
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._requests = queue.Queue()
+        self._latencies = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._num_images = 0
+        self._num_batches = 0
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image: Tensor) -> Future:
+        """Queues a single CHW image.
+
+        Returns:
+            Future: resolves to the class probabilities for the image
+        """
+        future = Future()
+        self._requests.put((image, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self._requests.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                inputs = torch.stack([image for image, _, _ in batch]).to(self.device)
+                inputs = prepare_inputs(inputs, self.channels_last)
+                with torch.no_grad():
+                    probs = torch.softmax(self.model(inputs).float(), dim=1).cpu()
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            for (_, future, submitted), p in zip(batch, probs):
+                future.set_result(p)
+            with self._lock:
+                self._latencies.extend(done - submitted for _, _, submitted in batch)
+                self._num_images += len(batch)
+                self._num_batches += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Returns:
+            dict: latency percentiles (ms) over recent requests, throughput (images/sec) and mean batch size
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+            num_images, num_batches = self._num_images, self._num_batches
+        elapsed = time.perf_counter() - self._start
+        return {
+            'requests': num_images,
+            'batches': num_batches,
+            'mean_batch_size': num_images / num_batches if num_batches else 0.0,
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p99_ms': 1000 * percentile(latencies, 99),
+            'throughput': num_images / elapsed if elapsed > 0 else 0.0,
+        }
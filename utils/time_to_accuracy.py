@@ -0,0 +1,123 @@
+"""Time-to-accuracy measurement.
+
+`TimeToAccuracy` tracks a DAWNBench-style run: training stops as soon as validation accuracy reaches `target_acc`, or
+once `time_budget` seconds have passed, and the run is summarized in a standardized result record with the time to
+target, the number of training images processed and every evaluation on the way. Validation can run every
+`eval_interval` optimizer steps, so the measurement is not quantized to whole epochs.
+
+Wall time is measured from `start()`; the time spent evaluating is also reported separately. The time budget is only
+checked after an evaluation. With several workers, pass `agree`, which returns True on every worker if any worker
+stops, so all workers stop at the same step.
+
+Typical usage:
+    tracker = TimeToAccuracy(target_acc=0.94, time_budget=3600, eval_interval=200)
+    tracker.start()
+    # after every training batch:
+    tracker.add_images(batch_size)
+    # after every evaluation:
+    if tracker.update(val_loss, val_acc, step, epoch, eval_seconds):
+        break
+    record = tracker.result(model='convmixer256_8_k5_p2', ...)
+"""
+
+import platform
+import time
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+RESULT_VERSION = 1
+
+
+class TimeToAccuracy:
+    def __init__(self, target_acc: float = 0.0, time_budget: float = 0.0, eval_interval: int = 0,
+                 agree: Optional[Callable[[bool], bool]] = None):
+        self.target_acc = target_acc
+        self.time_budget = time_budget
+        self.eval_interval = eval_interval
+        self.agree = agree or (lambda stop: stop)
+        self.images = 0
+        self.eval_time = 0.0
+        self.evaluations: List[dict] = []
+        self.stopped_by: Optional[str] = None
+        self.time_to_target: Optional[float] = None
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start if self._start is not None else 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.stopped_by is not None
+
+    @property
+    def last_eval(self) -> Tuple[float, float]:
+        """Returns:
+            tuple: (loss, accuracy) of the latest evaluation
+        """
+        return self.evaluations[-1]['val_loss'], self.evaluations[-1]['val_acc']
+
+    def should_eval(self, step: int) -> bool:
+        """Whether to evaluate after optimizer step `step` (counted from 1) within an epoch-based schedule."""
+        return self.eval_interval > 0 and step % self.eval_interval == 0
+
+    def add_images(self, n: int):
+        self.images += n
+
+    def update(self, val_loss: float, val_acc: float, step: int, epoch: float, eval_seconds: float = 0.0) -> bool:
+        """Records an evaluation after optimizer step `step` (`epoch` epochs of training, possibly fractional).
+
+        Returns:
+            bool: whether training should stop
+        """
+        elapsed = self.elapsed
+        self.eval_time += eval_seconds
+        self.evaluations.append({'step': step, 'epoch': epoch, 'time_s': elapsed, 'images': self.images,
+                                 'val_loss': val_loss, 'val_acc': val_acc})
+        if self.target_acc > 0 and val_acc >= self.target_acc:
+            reason = 'target'
+            self.time_to_target = elapsed
+        elif self.time_budget > 0 and elapsed >= self.time_budget:
+            reason = 'time_budget'
+        else:
+            reason = None
+        # Accuracy is the same on all workers, so a worker that did not stop is behind another worker's clock
+        if self.agree(reason is not None) and reason is None:
+            reason = 'time_budget'
+        self.stopped_by = reason
+        return self.done
+
+    def result(self, **run) -> dict:
+        """Standardized result record of the run; `run` adds descriptive fields such as model and batch size.
+
+        Returns:
+            dict: target, whether and when it was reached, images processed, timings and all evaluations
+        """
+        accs = [e['val_acc'] for e in self.evaluations]
+        last = self.evaluations[-1] if self.evaluations else {}
+        return {
+            'version': RESULT_VERSION,
+            'task': 'cifar10',
+            **run,
+            'target_acc': self.target_acc or None,
+            'time_budget_s': self.time_budget or None,
+            'reached': self.time_to_target is not None,
+            'stopped_by': self.stopped_by or 'epochs',
+            'time_to_target_s': self.time_to_target,
+            'wall_time_s': self.elapsed,
+            'eval_time_s': self.eval_time,
+            'images': last.get('images', self.images),
+            'steps': last.get('step'),
+            'epochs': last.get('epoch'),
+            'best_acc': max(accs) if accs else None,
+            'final_acc': accs[-1] if accs else None,
+            'eval_interval': self.eval_interval or 'epoch',
+            'environment': {'torch': torch.__version__, 'python': platform.python_version(),
+                            'threads': torch.get_num_threads(),
+                            'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None},
+            'evaluations': self.evaluations,
+        }
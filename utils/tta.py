@@ -0,0 +1,107 @@
+"""Test-time augmentation.
+
+`TestTimeAugmentation` wraps a model so that every input batch is expanded on its device into a stack of views
+(horizontal flip and/or shifted crops), run through the model in a single forward pass over the expanded batch, or
+in chunks of at most `max_chunk` images, and the logits of the views of each image are reduced by mean or max.
+
+Views per mode:
+    * "flip":       identity, horizontal flip
+    * "shift":      identity, shifted by `shift` pixels left, right, up and down (zero padded)
+    * "flip_shift": each of the 5 "shift" views, with and without horizontal flip
+
+Typical usage:
+    tta_model = TestTimeAugmentation(model, mode='flip_shift', reduction='mean',
+                                     max_chunk=max_chunk_for_budget(model, (3, 32, 32), budget_mb=512))
+    logits = tta_model(inputs)
+"""
+
+import logging
+from typing import List, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+
+TTA_MODES = ('none', 'flip', 'shift', 'flip_shift')
+
+
+def _shift(x: Tensor, dx: int, dy: int) -> Tensor:
+    """Translates a batch by (dx, dy) pixels, filling with zeros."""
+    pad = max(abs(dx), abs(dy))
+    if pad == 0:
+        return x
+    h, w = x.shape[-2:]
+    padded = F.pad(x, (pad, pad, pad, pad))
+    return padded[:, :, pad - dy:pad - dy + h, pad - dx:pad - dx + w]
+
+
+class TestTimeAugmentation(nn.Module):
+    def __init__(self, model: nn.Module, mode: str = 'flip', shift: int = 2, reduction: str = 'mean',
+                 max_chunk: int = 0, channels_last: bool = False):
+        super().__init__()
+        if mode not in TTA_MODES[1:]:
+            raise ValueError(f"Unknown TTA mode: {mode}")
+        if reduction not in ('mean', 'max'):
+            raise ValueError(f"Unknown TTA reduction: {reduction}")
+        self.model = model
+        self.reduction = reduction
+        self.max_chunk = max_chunk
+        self.channels_last = channels_last
+        self.shifts: List[Tuple[int, int]] = [(0, 0)]
+        if mode in ('shift', 'flip_shift'):
+            self.shifts += [(-shift, 0), (shift, 0), (0, -shift), (0, shift)]
+        self.flips = [False, True] if mode in ('flip', 'flip_shift') else [False]
+
+    @property
+    def num_views(self) -> int:
+        return len(self.shifts) * len(self.flips)
+
+    def expand(self, x: Tensor) -> Tensor:
+        """Stacks the views of a batch of B images, view-major, into a batch of `num_views` * B images."""
+        flipped = x.flip(-1) if True in self.flips else None
+        views = [_shift(flipped if flip else x, dx, dy) for flip in self.flips for dx, dy in self.shifts]
+        views = torch.cat(views)
+        if self.channels_last:
+            views = views.contiguous(memory_format=torch.channels_last)
+        return views
+
+    def forward(self, x: Tensor) -> Tensor:
+        batch_size = x.shape[0]
+        views = self.expand(x)
+        chunk = self.max_chunk or len(views)
+        logits = torch.cat([self.model(views[i:i + chunk]) for i in range(0, len(views), chunk)])
+        logits = logits.view(self.num_views, batch_size, -1)
+        return logits.mean(0) if self.reduction == 'mean' else logits.amax(0)
+
+
+@torch.no_grad()
+def max_chunk_for_budget(model: nn.Module, input_size=(3, 32, 32), budget_mb: float = 0.,
+                         device: torch.device = torch.device('cpu'), probe_batch: int = 8) -> int:
+    """Estimates how many images fit in one inference forward pass within `budget_mb` of activation memory, from the
+    largest input plus output of any leaf module on a probe batch.
+
+    Returns:
+        int: images per forward pass, or 0 (no limit) if `budget_mb` is 0 or the model cannot be probed with hooks,
+            e.g. a TorchScript model
+    """
+    if budget_mb <= 0:
+        return 0
+    peak = [0]
+
+    def hook(module, inputs, output):
+        in_bytes = sum(t.numel() * t.element_size() for t in inputs if isinstance(t, Tensor))
+        peak[0] = max(peak[0], in_bytes + output.numel() * output.element_size())
+
+    try:
+        handles = [m.register_forward_hook(hook) for m in model.modules() if not list(m.children())]
+    except Exception as e:
+        logging.warning(f"Cannot estimate TTA memory use, running views unchunked: {e}")
+        return 0
+    try:
+        model(torch.zeros(probe_batch, *input_size, device=device))
+    finally:
+        for h in handles:
+            h.remove()
+    if peak[0] == 0:
+        return 0
+    return max(1, int(budget_mb * 2 ** 20 * probe_batch // peak[0]))